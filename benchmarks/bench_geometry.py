@@ -0,0 +1,100 @@
+import bpy
+import os
+import sys
+import time
+from random import uniform
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from geometry_builder import GeometryBatch
+
+'''
+Compare scene setup time of bpy.ops against GeometryBatch
+
+Run with:
+    blender -b -P benchmarks/bench_geometry.py
+
+For 10, 100 and 1000 objects of each kind (cubes, cylinders, cameras)
+the scene is emptied, the objects are created once through the
+operators used by haze_generator_new.py and once through GeometryBatch,
+and the wall time of both is printed.
+'''
+
+COUNTS = [10, 100, 1000]
+
+
+def clear_scene():
+    scene = bpy.context.scene
+    for obj in list(scene.objects):
+        scene.objects.unlink(obj)
+    for obj in list(bpy.data.objects):
+        bpy.data.objects.remove(obj)
+    for mesh in list(bpy.data.meshes):
+        bpy.data.meshes.remove(mesh)
+    for camera in list(bpy.data.cameras):
+        bpy.data.cameras.remove(camera)
+    for mat in list(bpy.data.materials):
+        bpy.data.materials.remove(mat)
+    scene.update()
+
+def random_locations(n):
+    return [(uniform(-10, 10), uniform(-10, 10), uniform(0, 5)) for _ in range(n)]
+
+def new_material(name):
+    mat = bpy.data.materials.new(name=name)
+    mat.diffuse_color = (uniform(0, 1), uniform(0, 1), uniform(0, 1))
+    return mat
+
+def ops_cubes(locations):
+    for loc in locations:
+        bpy.ops.mesh.primitive_cube_add(radius=0.5, location=loc)
+        bpy.context.active_object.data.materials.append(new_material("Material"))
+
+def batch_cubes(locations):
+    batch = GeometryBatch()
+    batch.cubes(locations, 0.5, [new_material("Material") for _ in locations])
+    batch.link()
+
+def ops_cylinders(locations):
+    for loc in locations:
+        bpy.ops.mesh.primitive_cylinder_add(radius=0.3, depth=2, location=loc)
+        bpy.context.active_object.data.materials.append(new_material("Building"))
+
+def batch_cylinders(locations):
+    batch = GeometryBatch()
+    batch.cylinders(locations, [0.3] * len(locations), [2] * len(locations),
+                    [new_material("Building") for _ in locations])
+    batch.link()
+
+def ops_cameras(locations):
+    for loc in locations:
+        bpy.ops.object.camera_add(view_align=False, location=loc)
+
+def batch_cameras(locations):
+    batch = GeometryBatch()
+    batch.cameras(locations)
+    batch.link()
+
+def timed(build, locations):
+    clear_scene()
+    start = time.perf_counter()
+    build(locations)
+    bpy.context.scene.update()
+    return time.perf_counter() - start
+
+def main():
+    cases = [("cubes", ops_cubes, batch_cubes),
+             ("cylinders", ops_cylinders, batch_cylinders),
+             ("cameras", ops_cameras, batch_cameras)]
+    print("%-10s %6s %10s %10s %8s" % ("kind", "count", "ops [s]", "batch [s]", "speedup"))
+    for name, ops_build, batch_build in cases:
+        for n in COUNTS:
+            locations = random_locations(n)
+            ops_time = timed(ops_build, locations)
+            batch_time = timed(batch_build, locations)
+            print("%-10s %6d %10.3f %10.3f %7.1fx"
+                  % (name, n, ops_time, batch_time, ops_time / max(batch_time, 1e-9)))
+    clear_scene()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+import bpy
+import argparse
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import haze_generator_new as generator
+from haze_io import write_bundle
+
+'''
+Compare the time per camera with and without persistent render data
+
+Run with:
+    blender -b -P benchmarks/bench_persistent_data.py -- --rounds 3 --cameras 4
+
+The same rounds (a seeded bundle of 8x8x8 haze fields, one per round)
+are rendered by haze_generator_new.run() twice, once with
+PERSISTENT_DATA off and once on. Renders use a single sample at low
+resolution, so the time of a render is mostly the Cycles scene sync.
+Render start and end are taken from the render_pre and render_post
+handlers; the first camera of a round, which syncs the changed
+densities and buildings, is reported apart from the others.
+'''
+
+SEED = 7
+DIM = (8, 8, 8)
+
+
+def parse_args():
+    argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+    parser = argparse.ArgumentParser(prog="bench_persistent_data.py")
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--cameras', type=int, default=4)
+    parser.add_argument('--resolution', type=int, default=25, help="resolution percentage")
+    return parser.parse_args(argv)
+
+class RenderTimer(object):
+    '''
+    Collect the wall time of every render through the render handlers
+    '''
+    def __init__(self):
+        self.times = []
+        self.start = None
+
+    def pre(self, *args):
+        self.start = time.perf_counter()
+
+    def post(self, *args):
+        self.times.append(time.perf_counter() - self.start)
+
+def timed_rounds(directory, bundle, persistent, args):
+    '''
+    Render every round, return the render times as (rounds, cameras)
+    '''
+    generator.SAVE_DIRECTORY = os.path.join(directory, 'persistent' if persistent else 'plain')
+    generator.PERSISTENT_DATA = persistent
+    timer = RenderTimer()
+    bpy.app.handlers.render_pre.append(timer.pre)
+    bpy.app.handlers.render_post.append(timer.post)
+    rig = None
+    try:
+        for round in range(args.rounds):
+            rig = generator.run(bundle, round, rig=rig)
+    finally:
+        bpy.app.handlers.render_pre.remove(timer.pre)
+        bpy.app.handlers.render_post.remove(timer.post)
+    return np.array(timer.times).reshape(args.rounds, -1)
+
+def main():
+    args = parse_args()
+    directory = tempfile.mkdtemp(prefix='bench_persistent_data_')
+    fields = np.random.RandomState(SEED).uniform(0.1, 0.3, (args.rounds,) + DIM[::-1])
+    bundle = os.path.join(directory, 'fields.npy')
+    write_bundle(bundle, fields)
+
+    generator.INPUT_FILE_MODE = True
+    generator.NUM_CAMERAS = args.cameras
+    generator.SEED = SEED
+    # a single sample makes the render time mostly scene sync
+    generator.RENDER_PROFILES['sync'] = dict(generator.RENDER_PROFILES['preview'], samples=1)
+    generator.RENDER_PROFILE = 'sync'
+    bpy.context.scene.render.resolution_percentage = args.resolution
+
+    print("%-12s %18s %18s %10s" % ("persistent", "first camera [s]", "other cameras [s]", "total [s]"))
+    for persistent in (False, True):
+        times = timed_rounds(directory, bundle, persistent, args)
+        others = times[:, 1:].mean() if times.shape[1] > 1 else float('nan')
+        print("%-12s %18.3f %18.3f %10.2f" % (persistent, times[:, 0].mean(), others, times.sum()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,105 @@
+import bpy
+import argparse
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import haze_generator_new as generator
+from haze_io import write_text_field
+
+'''
+Measure render time against noise for every render profile
+
+Run with:
+    blender -b -P benchmarks/bench_render_profiles.py -- --budget 0.01
+
+A fixed scene (seeded 5x5x5 haze field, buildings and one camera) is
+built once by haze_generator_new.run(). The camera is then rendered
+under each profile of RENDER_PROFILES and the best of --repeats wall
+times is printed with the RMSE and PSNR of the image against the
+reference profile rendered with another Cycles seed. The reference
+row is therefore the noise floor of the reference itself. With
+--budget the cheapest profile whose RMSE is within it is printed.
+'''
+
+SEED = 7
+DIM = (5, 5, 5)
+
+
+def parse_args():
+    argv = sys.argv[sys.argv.index('--') + 1:] if '--' in sys.argv else []
+    parser = argparse.ArgumentParser(prog="bench_render_profiles.py")
+    parser.add_argument('--profiles', nargs='+', default=sorted(generator.RENDER_PROFILES),
+                        choices=sorted(generator.RENDER_PROFILES))
+    parser.add_argument('--repeats', type=int, default=1, help="renders per profile, the fastest counts")
+    parser.add_argument('--resolution', type=int, default=50, help="resolution percentage")
+    parser.add_argument('--budget', type=float, help="largest acceptable RMSE against reference")
+    return parser.parse_args(argv)
+
+def build_scene(directory):
+    '''
+    Build the reference scene with the generator and return its camera
+    '''
+    density = np.random.RandomState(SEED).uniform(0.1, 0.3, DIM[::-1])
+    field = os.path.join(directory, 'field.txt')
+    write_text_field(field, density)
+    generator.SAVE_DIRECTORY = directory
+    generator.INPUT_FILE_MODE = True
+    generator.NUM_CAMERAS = 1
+    generator.SEED = SEED
+    generator.RENDER_PROFILE = 'preview'
+    generator.run(field, 0)
+    return [ob for ob in bpy.context.scene.objects if ob.type == 'CAMERA'][0]
+
+def render(path, cycles_seed):
+    '''
+    Render the active camera to path, return (seconds, pixels)
+    '''
+    scene = bpy.context.scene
+    scene.cycles.seed = cycles_seed
+    scene.render.filepath = path
+    start = time.perf_counter()
+    bpy.ops.render.render(write_still=True)
+    elapsed = time.perf_counter() - start
+    image = bpy.data.images.load(path + scene.render.file_extension)
+    pixels = np.array(image.pixels[:]).reshape(image.size[1], image.size[0], -1)[:, :, :3]
+    bpy.data.images.remove(image)
+    return elapsed, pixels
+
+def main():
+    args = parse_args()
+    directory = tempfile.mkdtemp(prefix='bench_render_profiles_')
+    scene = bpy.context.scene
+    scene.camera = build_scene(directory)
+    scene.render.resolution_percentage = args.resolution
+
+    generator.apply_render_profile('reference')
+    _, reference = render(os.path.join(directory, 'target'), 0)
+
+    results = []
+    for name in args.profiles:
+        generator.apply_render_profile(name)
+        times = []
+        for _ in range(args.repeats):
+            elapsed, pixels = render(os.path.join(directory, name), 1)
+            times.append(elapsed)
+        rmse = np.sqrt(np.mean((pixels - reference) ** 2))
+        results.append((min(times), rmse, name))
+
+    print("%-10s %12s %10s %10s" % ("profile", "s/image", "RMSE", "PSNR [dB]"))
+    for seconds, rmse, name in sorted(results):
+        psnr = 20 * np.log10(1.0 / rmse) if rmse > 0 else float('inf')
+        print("%-10s %12.2f %10.5f %10.2f" % (name, seconds, rmse, psnr))
+    if args.budget is not None:
+        within = [result for result in sorted(results) if result[1] <= args.budget]
+        if within:
+            print("cheapest profile within RMSE %g: %s" % (args.budget, within[0][2]))
+        else:
+            print("no profile is within RMSE %g" % args.budget)
+
+
+if __name__ == '__main__':
+    main()
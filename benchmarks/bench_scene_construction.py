@@ -0,0 +1,243 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from collections import Counter
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import blender_standin
+blender_standin.install()
+import haze_generator_new as generator
+from haze_io import write_bundle
+
+'''
+Measure scene construction without Blender
+
+Run with plain CPython:
+    python benchmarks/bench_scene_construction.py
+    python benchmarks/bench_scene_construction.py --quick --max-exponent 1.5
+
+bpy and mathutils are replaced by blender_standin.py, so nothing is
+rendered and the seconds are those of haze_generator_new.py itself
+plus the bookkeeping of the stand-in; what Blender does inside an
+operator is not measured, but every operator call is counted.
+
+The grid sweep runs haze_generator_new.run() on seeded n x n x n
+fields, once to build the scene and once more to update it like a
+following round, and splits the first round into stages by wrapping
+the functions run() calls. The building sweep calls create_scene()
+and update_scene() for 1 to 1000 buildings. For each size the calls
+into bpy, the operator calls, the objects, materials and nodes made
+and the seconds are printed, followed by how seconds and calls grow
+between the two largest sizes. With --max-exponent the script exits
+with 1 when seconds grow faster than size to that power.
+'''
+
+SEED = 7
+GRID_SIZES = [1, 2, 4, 8, 16, 32]
+BUILDING_COUNTS = [1, 10, 100, 1000]
+QUICK_GRID_SIZES = [1, 2, 4, 8]
+QUICK_BUILDING_COUNTS = [1, 10, 100]
+# function of haze_generator_new.py -> stage it is timed under
+STAGES = [('delete_all', 'rig'), ('build_rig', 'rig'), ('edit_node', 'cubes'),
+          ('voxel_material', 'cubes'), ('update_voxels', 'cubes'), ('create_scene', 'buildings'),
+          ('update_scene', 'buildings'), ('align_camera', 'cameras'), ('write_label', 'labels'),
+          ('generate_camera_views', 'render'), ('generate_camera_view', 'render')]
+STAGE_NAMES = ['rig', 'cubes', 'buildings', 'cameras', 'labels', 'render', 'other']
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="bench_scene_construction.py")
+    parser.add_argument('--grid-sizes', type=int, nargs='+', default=None,
+                        help="edge lengths n of the n^3 grids, default %s" % GRID_SIZES)
+    parser.add_argument('--buildings', type=int, nargs='+', default=None,
+                        help="building counts, default %s" % BUILDING_COUNTS)
+    parser.add_argument('--quick', action='store_true',
+                        help="small sizes only, %s and %s" % (QUICK_GRID_SIZES, QUICK_BUILDING_COUNTS))
+    parser.add_argument('--geometry', choices=["batch", "ops", "both"], default="both",
+                        help="BATCH_GEOMETRY on, off or both")
+    parser.add_argument('--haze-mode', choices=["cubes", "volume"], default="cubes")
+    parser.add_argument('--cameras', type=int, default=4)
+    parser.add_argument('--json', help="also write every row to this file")
+    parser.add_argument('--max-exponent', type=float,
+                        help="fail when seconds grow faster than size to this power")
+    return parser.parse_args(argv)
+
+
+class StageTimer(object):
+    '''
+    Wrap functions of haze_generator_new.py to add up the wall time
+    spent in each stage. A wrapped function called from another one
+    counts for its own stage only
+    '''
+    def __init__(self):
+        self.seconds = Counter()
+        self.stack = []
+
+    def wrap(self, name, stage):
+        function = getattr(generator, name)
+        def wrapper(*args, **kwargs):
+            self.stack.append(0.0)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.seconds[stage] += elapsed - self.stack.pop()
+                if self.stack:
+                    self.stack[-1] += elapsed
+        wrapper.original = function
+        setattr(generator, name, wrapper)
+
+    def install(self):
+        for name, stage in STAGES:
+            self.wrap(name, stage)
+
+    def remove(self):
+        for name, _ in STAGES:
+            setattr(generator, name, getattr(generator, name).original)
+
+def snapshot(seconds, size):
+    recorder = blender_standin.RECORDER
+    row = {'size': size, 'seconds': seconds, 'calls': recorder.total(),
+           'ops': recorder.total('ops.')}
+    row.update(blender_standin.datablock_counts())
+    return row
+
+def quiet(function, *args):
+    '''
+    Call function without the prints of run() between the tables
+    '''
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        return function(*args)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+def grid_row(n, geometry, directory):
+    '''
+    Run two rounds on an n^3 grid, return the counts after the first
+    and the time of both
+    '''
+    fields = np.random.RandomState(SEED).uniform(0.1, 0.3, (2, n, n, n))
+    bundle = os.path.join(directory, 'fields_%d.npy' % n)
+    write_bundle(bundle, fields)
+    generator.SAVE_DIRECTORY = os.path.join(directory, 'output')
+    generator.BATCH_GEOMETRY = geometry == "batch"
+
+    blender_standin.reset()
+    timer = StageTimer()
+    timer.install()
+    try:
+        start = time.perf_counter()
+        rig = generator.run(bundle, 0, generator.MaterialCache(generator.MATERIAL_TOLERANCE,
+                                                              generator.MATERIAL_CACHE_SIZE))
+        elapsed = time.perf_counter() - start
+    finally:
+        timer.remove()
+    row = snapshot(elapsed, n ** 3)
+    row['stages'] = dict(timer.seconds)
+    row['stages']['other'] = elapsed - sum(timer.seconds.values())
+
+    calls = blender_standin.RECORDER.total()
+    start = time.perf_counter()
+    generator.run(bundle, 1, rig=rig)
+    row['update_seconds'] = time.perf_counter() - start
+    row['update_calls'] = blender_standin.RECORDER.total() - calls
+    shutil.rmtree(generator.SAVE_DIRECTORY, ignore_errors=True)
+    return row
+
+def building_row(count, geometry):
+    '''
+    Create count buildings and move them once, like two rounds do
+    '''
+    blender_standin.reset()
+    generator.seed(SEED)
+    batch = generator.GeometryBatch() if geometry == "batch" else None
+    start = time.perf_counter()
+    buildings = generator.create_scene(5.6, 2.7, num=count, batch=batch)
+    if batch is not None:
+        batch.link()
+    elapsed = time.perf_counter() - start
+    row = snapshot(elapsed, count)
+    calls = blender_standin.RECORDER.total()
+    start = time.perf_counter()
+    generator.update_scene(buildings, 5.6, 2.7)
+    row['update_seconds'] = time.perf_counter() - start
+    row['update_calls'] = blender_standin.RECORDER.total() - calls
+    return row
+
+def exponent(rows, key):
+    '''
+    p in key ~ size^p between the two largest sizes
+    '''
+    if len(rows) < 2:
+        return float('nan')
+    small, large = rows[-2], rows[-1]
+    if small['size'] == large['size'] or small[key] <= 0 or large[key] <= 0:
+        return float('nan')
+    return np.log(large[key] / float(small[key])) / np.log(large['size'] / float(small['size']))
+
+def print_rows(title, unit, rows, stages=False):
+    print(title)
+    print("%9s %8s %7s %8s %8s %10s %8s %10s %10s %12s"
+          % (unit, "calls", "ops", "objects", "meshes", "materials", "nodes",
+             "seconds", "update [s]", "update calls"))
+    for row in rows:
+        print("%9d %8d %7d %8d %8d %10d %8d %10.4f %10.4f %12d"
+              % (row['size'], row['calls'], row['ops'], row['objects'], row['meshes'],
+                 row['materials'], row['nodes'], row['seconds'], row['update_seconds'],
+                 row['update_calls']))
+    if stages:
+        print("%9s" % unit + "".join(" %10s" % stage for stage in STAGE_NAMES))
+        for row in rows:
+            print("%9d" % row['size']
+                  + "".join(" %10.4f" % row['stages'].get(stage, 0.0) for stage in STAGE_NAMES))
+    print("seconds grow as %s^%.2f, calls as %s^%.2f\n"
+          % (unit, exponent(rows, 'seconds'), unit, exponent(rows, 'calls')))
+
+def main(argv=None):
+    args = parse_args(argv)
+    grid_sizes = args.grid_sizes or (QUICK_GRID_SIZES if args.quick else GRID_SIZES)
+    building_counts = args.buildings or (QUICK_BUILDING_COUNTS if args.quick else BUILDING_COUNTS)
+    geometries = ["batch", "ops"] if args.geometry == "both" else [args.geometry]
+
+    generator.INPUT_FILE_MODE = True
+    generator.NUM_CAMERAS = args.cameras
+    generator.HAZE_MODE = args.haze_mode
+    generator.SEED = SEED
+    directory = tempfile.mkdtemp(prefix='bench_scene_construction_')
+    results = []
+    failed = False
+    try:
+        for geometry in geometries:
+            grid_rows = [quiet(grid_row, n, geometry, directory) for n in grid_sizes]
+            building_rows = [quiet(building_row, count, geometry) for count in building_counts]
+            print_rows("grid sweep, %s geometry, %s haze, %d cameras"
+                       % (geometry, args.haze_mode, args.cameras), "voxels", grid_rows, stages=True)
+            print_rows("building sweep, %s geometry" % geometry, "buildings", building_rows)
+            for sweep, rows in (('grid', grid_rows), ('buildings', building_rows)):
+                for row in rows:
+                    results.append(dict(row, sweep=sweep, geometry=geometry))
+                if args.max_exponent is not None and exponent(rows, 'seconds') > args.max_exponent:
+                    print("FAIL: %s sweep with %s geometry grows faster than size^%.2f"
+                          % (sweep, geometry, args.max_exponent))
+                    failed = True
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    if args.json:
+        f = open(args.json, 'w')
+        json.dump(results, f, indent=1)
+        f.close()
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,857 @@
+import os
+import re
+import sys
+import time
+import types
+from collections import Counter, OrderedDict
+
+'''
+A stand-in for bpy and mathutils that runs under plain CPython
+
+Only the part of the Blender 2.7x API used by haze_generator_new.py
+and geometry_builder.py is modelled: datablock collections with
+Blender's unique names ("Cube", "Cube.001", ...) and user counts,
+objects linked to a scene, material slots, shader and compositor node
+trees, the primitive and camera operators, object deletion and a
+render operator that writes empty files where Blender would write
+images. Nothing is drawn or rendered.
+
+Every operator, datablock creation and removal, scene update and node
+link goes through RECORDER, which counts the calls and adds up the
+time spent in them, and datablock_counts() gives the number of
+datablocks of each kind. bench_scene_construction.py uses both to
+measure scene construction without Blender.
+
+Usage:
+    import blender_standin
+    blender_standin.install()
+    import haze_generator_new as generator
+    blender_standin.reset()
+    generator.build_rig([8, 8, 8], None)
+    print(blender_standin.RECORDER.calls, blender_standin.datablock_counts())
+'''
+
+BLENDER_VERSION = (2, 79, 0)
+COLLECTIONS = ('objects', 'meshes', 'materials', 'cameras', 'lamps', 'images')
+
+
+class Recorder(object):
+    '''
+    Count calls into the stand-in and the seconds spent in them
+    '''
+    def __init__(self):
+        self.calls = Counter()
+        self.seconds = Counter()
+
+    def clear(self):
+        self.calls.clear()
+        self.seconds.clear()
+
+    def total(self, prefix=''):
+        return sum(count for name, count in self.calls.items() if name.startswith(prefix))
+
+RECORDER = Recorder()
+
+def recorded(name):
+    '''
+    Decorator counting every call of a function under name
+    '''
+    def decorate(function):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                RECORDER.calls[name] += 1
+                RECORDER.seconds[name] += time.perf_counter() - start
+        wrapper.__name__ = function.__name__
+        return wrapper
+    return decorate
+
+
+class Settings(object):
+    '''
+    Plain attribute container; attributes it was not given do not
+    exist, so hasattr() checks behave as in a Blender version
+    without them
+    '''
+    def __init__(self, **values):
+        self.__dict__.update(values)
+
+
+class Vector(object):
+    def __init__(self, values=(0.0, 0.0, 0.0)):
+        self._values = [float(v) for v in values]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def __getitem__(self, k):
+        return self._values[k]
+
+    def __setitem__(self, k, value):
+        self._values[k] = float(value)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __repr__(self):
+        return '%s(%r)' % (type(self).__name__, tuple(self._values))
+
+    x = property(lambda self: self[0], lambda self, v: self.__setitem__(0, v))
+    y = property(lambda self: self[1], lambda self, v: self.__setitem__(1, v))
+    z = property(lambda self: self[2], lambda self, v: self.__setitem__(2, v))
+
+class Euler(Vector):
+    def __init__(self, values=(0.0, 0.0, 0.0), order='XYZ'):
+        Vector.__init__(self, values)
+        self.order = order
+
+class Color(Vector):
+    r = property(lambda self: self[0], lambda self, v: self.__setitem__(0, v))
+    g = property(lambda self: self[1], lambda self, v: self.__setitem__(1, v))
+    b = property(lambda self: self[2], lambda self, v: self.__setitem__(2, v))
+
+class Matrix(object):
+    def __init__(self, rows=None):
+        if rows is None:
+            rows = [[float(i == j) for j in range(4)] for i in range(4)]
+        self.rows = [list(row) for row in rows]
+
+    def __getitem__(self, k):
+        return self.rows[k]
+
+    def __iter__(self):
+        return iter(self.rows)
+
+
+class ID(object):
+    '''
+    A datablock. Using it after bpy.data.<kind>.remove() raises
+    ReferenceError like a removed Blender datablock does
+    '''
+    def __init__(self, name):
+        self._name = name
+        self._collection = None
+        self.users = 0
+        self.use_fake_user = False
+        self.removed = False
+
+    @property
+    def name(self):
+        if self.removed:
+            raise ReferenceError("StructRNA of type %s has been removed" % type(self).__name__)
+        return self._name
+
+    @name.setter
+    def name(self, value):
+        if self._collection is not None:
+            self._collection._rename(self, value)
+        else:
+            self._name = value
+
+    def as_pointer(self):
+        return id(self)
+
+    def _release(self):
+        '''
+        Drop the users this datablock holds on others
+        '''
+
+    def __repr__(self):
+        return '<%s "%s">' % (type(self).__name__, self._name)
+
+class Collection(object):
+    '''
+    bpy.data.<kind>: datablocks by unique name, in creation order
+    '''
+    def __init__(self, kind, factory):
+        self.kind = kind
+        self.factory = factory
+        self.items = OrderedDict()
+        self.suffixes = Counter()
+
+    def _unique(self, name):
+        if name not in self.items:
+            return name
+        base = re.sub(r'\.\d{3,}$', '', name)
+        while True:
+            self.suffixes[base] += 1
+            candidate = '%s.%03d' % (base, self.suffixes[base])
+            if candidate not in self.items:
+                return candidate
+
+    def _add(self, item):
+        item._name = self._unique(item._name)
+        item._collection = self
+        self.items[item._name] = item
+        return item
+
+    def _rename(self, item, name):
+        del self.items[item._name]
+        item._name = name
+        self._add(item)
+
+    def new(self, name, *args, **kwargs):
+        start = time.perf_counter()
+        item = self._add(self.factory(name, *args, **kwargs))
+        RECORDER.calls['data.%s.new' % self.kind] += 1
+        RECORDER.seconds['data.%s.new' % self.kind] += time.perf_counter() - start
+        return item
+
+    def remove(self, item, do_unlink=True):
+        start = time.perf_counter()
+        del self.items[item._name]
+        item._release()
+        item.removed = True
+        RECORDER.calls['data.%s.remove' % self.kind] += 1
+        RECORDER.seconds['data.%s.remove' % self.kind] += time.perf_counter() - start
+
+    def get(self, name, default=None):
+        return self.items.get(name, default)
+
+    def keys(self):
+        return list(self.items)
+
+    def values(self):
+        return list(self.items.values())
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return list(self.items.values())[key]
+        return self.items[key]
+
+    def __contains__(self, name):
+        return name in self.items
+
+    def __iter__(self):
+        # a copy, so removing while iterating works as in Blender
+        return iter(list(self.items.values()))
+
+    def __len__(self):
+        return len(self.items)
+
+
+class Socket(object):
+    def __init__(self, name, node):
+        self.name = name
+        self.node = node
+        self.default_value = 0.0
+        self.links = []
+
+class Sockets(object):
+    '''
+    Inputs or outputs of a node, looked up by index or name. Sockets
+    are made on first use, as every node type has its own
+    '''
+    def __init__(self, node):
+        self.node = node
+        self.sockets = []
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            while len(self.sockets) <= key:
+                self.sockets.append(Socket(str(len(self.sockets)), self.node))
+            return self.sockets[key]
+        for socket in self.sockets:
+            if socket.name == key:
+                return socket
+        self.sockets.append(Socket(key, self.node))
+        return self.sockets[-1]
+
+    def __iter__(self):
+        return iter(self.sockets)
+
+    def __len__(self):
+        return len(self.sockets)
+
+# default names Blender gives nodes whose type name does not spell them
+NODE_NAMES = {'CompositorNodeRLayers': 'Render Layers', 'ShaderNodeOutputMaterial': 'Material Output',
+              'ShaderNodeOutputLamp': 'Lamp Output', 'CompositorNodeOutputFile': 'File Output',
+              'ShaderNodeBsdfDiffuse': 'Diffuse BSDF', 'ShaderNodeTexCoord': 'Texture Coordinate',
+              'ShaderNodeTexImage': 'Image Texture'}
+
+def node_name(kind):
+    if kind in NODE_NAMES:
+        return NODE_NAMES[kind]
+    words = re.sub(r'^(ShaderNode|CompositorNode)', '', kind)
+    return ' '.join(re.findall(r'[A-Z][a-z]+|[A-Z]+(?![a-z])', words))
+
+class Node(object):
+    def __init__(self, kind, name):
+        self.bl_idname = kind
+        self.name = name
+        self.label = ''
+        self.location = (0.0, 0.0)
+        self.mute = False
+        self.inputs = Sockets(self)
+        self.outputs = Sockets(self)
+        if kind == 'CompositorNodeOutputFile':
+            self.base_path = '/tmp/'
+            self.format = Settings(file_format='PNG', color_mode='BW', color_depth='8', compression=15)
+            self.file_slots = [Settings(path='Image')]
+        elif kind == 'CompositorNodeViewer':
+            self.use_alpha = True
+
+    def as_pointer(self):
+        return id(self)
+
+class Nodes(object):
+    def __init__(self):
+        self.nodes = OrderedDict()
+
+    @recorded('nodes.new')
+    def new(self, type):
+        name = node_name(type)
+        base, k = name, 0
+        while name in self.nodes:
+            k += 1
+            name = '%s.%03d' % (base, k)
+        node = Node(type, name)
+        self.nodes[name] = node
+        return node
+
+    @recorded('nodes.remove')
+    def remove(self, node):
+        for key, value in list(self.nodes.items()):
+            if value is node:
+                del self.nodes[key]
+
+    def get(self, name, default=None):
+        for node in self.nodes.values():
+            if node.name == name:
+                return node
+        return default
+
+    def keys(self):
+        return [node.name for node in self.nodes.values()]
+
+    def __getitem__(self, key):
+        if isinstance(key, int):
+            return list(self.nodes.values())[key]
+        node = self.get(key)
+        if node is None:
+            raise KeyError('bpy_prop_collection[key]: key "%s" not found' % key)
+        return node
+
+    def __iter__(self):
+        return iter(list(self.nodes.values()))
+
+    def __len__(self):
+        return len(self.nodes)
+
+class Links(object):
+    def __init__(self):
+        self.links = []
+
+    @recorded('links.new')
+    def new(self, output, input):
+        # an input takes one link, a new one replaces the old
+        self.links = [link for link in self.links if link.to_socket is not input]
+        link = Settings(from_socket=output, to_socket=input, from_node=output.node, to_node=input.node)
+        self.links.append(link)
+        return link
+
+    def remove(self, link):
+        self.links.remove(link)
+
+    def __iter__(self):
+        return iter(list(self.links))
+
+    def __len__(self):
+        return len(self.links)
+
+class NodeTree(object):
+    def __init__(self, kind, defaults):
+        self.type = kind
+        self.nodes = Nodes()
+        self.links = Links()
+        for node_type in defaults:
+            self.nodes.new(node_type)
+
+def node_count():
+    '''
+    Nodes in every node tree of bpy.data and the scene
+    '''
+    count = 0
+    for item in list(DATA.materials) + list(DATA.lamps):
+        if item.node_tree is not None:
+            count += len(item.node_tree.nodes)
+    scene = CONTEXT.scene
+    if scene.node_tree is not None:
+        count += len(scene.node_tree.nodes)
+    return count
+
+
+class NodeOwner(ID):
+    '''
+    A datablock with a node tree made when use_nodes is set
+    '''
+    TREE = 'SHADER'
+    DEFAULT_NODES = ()
+
+    def __init__(self, name):
+        ID.__init__(self, name)
+        self.node_tree = None
+        self._use_nodes = False
+
+    @property
+    def use_nodes(self):
+        return self._use_nodes
+
+    @use_nodes.setter
+    def use_nodes(self, value):
+        self._use_nodes = bool(value)
+        if value and self.node_tree is None:
+            self.node_tree = NodeTree(self.TREE, self.DEFAULT_NODES)
+            nodes = self.node_tree.nodes
+            if len(nodes) == 2:
+                self.node_tree.links.new(nodes[0].outputs[0], nodes[1].inputs[0])
+
+class Material(NodeOwner):
+    DEFAULT_NODES = ('ShaderNodeBsdfDiffuse', 'ShaderNodeOutputMaterial')
+
+    def __init__(self, name):
+        NodeOwner.__init__(self, name)
+        self.diffuse_color = Color((0.8, 0.8, 0.8))
+
+class Lamp(NodeOwner):
+    DEFAULT_NODES = ('ShaderNodeEmission', 'ShaderNodeOutputLamp')
+
+    def __init__(self, name, type='POINT'):
+        NodeOwner.__init__(self, name)
+        self.type = type
+
+class Camera(ID):
+    def __init__(self, name):
+        ID.__init__(self, name)
+        self.lens = 35.0
+        self.sensor_width = 32.0
+        self.sensor_height = 18.0
+        self.sensor_fit = 'AUTO'
+
+class Pixels(object):
+    '''
+    Image.pixels: flat RGBA floats
+    '''
+    def __init__(self, count):
+        self.values = [0.0] * count
+
+    def __len__(self):
+        return len(self.values)
+
+    def __getitem__(self, k):
+        return self.values[k]
+
+    def __setitem__(self, k, values):
+        self.values[k] = values
+
+    def foreach_get(self, array):
+        array[:] = self.values
+
+class Image(ID):
+    def __init__(self, name, width=0, height=0, alpha=False, float_buffer=False):
+        ID.__init__(self, name)
+        self.size = (width, height)
+        self.pixels = Pixels(width * height * 4)
+        self.colorspace_settings = Settings(name='sRGB')
+        self.use_alpha = alpha
+        self.is_float = float_buffer
+        self.type = 'GENERATED'
+
+class Elements(object):
+    '''
+    Vertices, loops or polygons of a mesh; only their number is kept
+    '''
+    def __init__(self):
+        self.count = 0
+
+    def add(self, count):
+        self.count += count
+
+    def foreach_set(self, attribute, values):
+        pass
+
+    def __len__(self):
+        return self.count
+
+class MaterialList(object):
+    '''
+    Mesh.materials, holding a user on every material in it
+    '''
+    def __init__(self):
+        self.materials = []
+
+    @recorded('materials.append')
+    def append(self, material):
+        if material is not None:
+            material.users += 1
+        self.materials.append(material)
+
+    def __getitem__(self, k):
+        return self.materials[k]
+
+    def __setitem__(self, k, material):
+        if self.materials[k] is not None:
+            self.materials[k].users -= 1
+        if material is not None:
+            material.users += 1
+        self.materials[k] = material
+
+    def __iter__(self):
+        return iter(self.materials)
+
+    def __len__(self):
+        return len(self.materials)
+
+class Mesh(ID):
+    def __init__(self, name):
+        ID.__init__(self, name)
+        self.materials = MaterialList()
+        self.vertices = Elements()
+        self.loops = Elements()
+        self.polygons = Elements()
+
+    @recorded('mesh.update')
+    def update(self, calc_edges=False):
+        pass
+
+    def _release(self):
+        for material in self.materials:
+            if material is not None:
+                material.users -= 1
+
+class MaterialSlot(object):
+    '''
+    Slot k of an object: its material comes from the mesh unless
+    link is 'OBJECT'
+    '''
+    def __init__(self, obj, k):
+        self.obj = obj
+        self.k = k
+
+    @property
+    def link(self):
+        return self.obj._slot_links.get(self.k, 'DATA')
+
+    @link.setter
+    def link(self, value):
+        self.obj._slot_links[self.k] = value
+
+    @property
+    def material(self):
+        if self.link == 'OBJECT':
+            return self.obj._slot_materials.get(self.k)
+        return self.obj.data.materials[self.k]
+
+    @material.setter
+    def material(self, material):
+        if self.link != 'OBJECT':
+            self.obj.data.materials[self.k] = material
+            return
+        old = self.obj._slot_materials.get(self.k)
+        if old is not None:
+            old.users -= 1
+        if material is not None:
+            material.users += 1
+        self.obj._slot_materials[self.k] = material
+
+class Object(ID):
+    def __init__(self, name, object_data=None):
+        ID.__init__(self, name)
+        self.data = object_data
+        if object_data is not None:
+            object_data.users += 1
+        self.type = {Mesh: 'MESH', Camera: 'CAMERA', Lamp: 'LAMP'}.get(type(object_data), 'EMPTY')
+        self._location = Vector()
+        self._scale = Vector((1, 1, 1))
+        self._rotation = Euler()
+        self.rotation_mode = 'XYZ'
+        self.hide_render = False
+        self._slot_links = {}
+        self._slot_materials = {}
+
+    def _vector(kind, attribute):
+        def get(self):
+            return getattr(self, attribute)
+        def set(self, values):
+            setattr(self, attribute, kind(values))
+        return property(get, set)
+    location = _vector(Vector, '_location')
+    scale = _vector(Vector, '_scale')
+    rotation_euler = _vector(Euler, '_rotation')
+    del _vector
+
+    @property
+    def select(self):
+        return self in SELECTED
+
+    @select.setter
+    def select(self, value):
+        if value:
+            SELECTED.add(self)
+        else:
+            SELECTED.discard(self)
+
+    @property
+    def material_slots(self):
+        if self.type != 'MESH':
+            return []
+        return [MaterialSlot(self, k) for k in range(len(self.data.materials))]
+
+    @property
+    def active_material(self):
+        slots = self.material_slots
+        return slots[0].material if slots else None
+
+    def _release(self):
+        CONTEXT.scene.objects._forget(self)
+        SELECTED.discard(self)
+        if self.data is not None:
+            self.data.users -= 1
+        for material in self._slot_materials.values():
+            if material is not None:
+                material.users -= 1
+
+
+class SceneObjects(object):
+    '''
+    scene.objects: the objects linked to the scene
+    '''
+    def __init__(self):
+        self.objects = OrderedDict()
+        self.active = None
+
+    @recorded('scene.objects.link')
+    def link(self, obj):
+        self.objects[id(obj)] = obj
+
+    @recorded('scene.objects.unlink')
+    def unlink(self, obj):
+        self._forget(obj)
+
+    def _forget(self, obj):
+        self.objects.pop(id(obj), None)
+        if self.active is obj:
+            self.active = None
+
+    def __iter__(self):
+        return iter(list(self.objects.values()))
+
+    def __len__(self):
+        return len(self.objects)
+
+class Scene(ID):
+    def __init__(self, name='Scene'):
+        ID.__init__(self, name)
+        self.objects = SceneObjects()
+        self.camera = None
+        self.frame_current = 1
+        self.node_tree = None
+        self._use_nodes = False
+        self.render = Settings(
+            engine='BLENDER_RENDER', resolution_x=1920, resolution_y=1080, resolution_percentage=50,
+            filepath='/tmp/', file_extension='.png', use_persistent_data=False,
+            threads_mode='AUTO', threads=1, use_multiview=False, views_format='STEREO_3D',
+            tile_x=64, tile_y=64,
+            image_settings=Settings(file_format='PNG', color_mode='RGBA', color_depth='8', compression=15),
+            layers={'RenderLayer': Settings(use_pass_mist=False, use_pass_normal=False,
+                                            use_pass_combined=True, use_pass_material_index=False)})
+        self.view_settings = Settings(view_transform='Default', look='None', exposure=0.0, gamma=1.0,
+                                      use_curve_mapping=False)
+        self.display_settings = Settings(display_device='sRGB')
+        self.world = Settings(use_sky_paper=False, horizon_color=Color((0.05, 0.05, 0.05)),
+                              mist_settings=Settings(falloff='QUADRATIC', start=5.0, depth=25.0, intensity=0.0))
+        # Cycles of 2.7x: no adaptive sampling and no tile_size yet
+        self.cycles = Settings(samples=10, seed=0, max_bounces=12, transparent_max_bounces=8,
+                               sample_clamp_indirect=0.0)
+
+    @property
+    def use_nodes(self):
+        return self._use_nodes
+
+    @use_nodes.setter
+    def use_nodes(self, value):
+        self._use_nodes = bool(value)
+        if value and self.node_tree is None:
+            self.node_tree = NodeTree('COMPOSITING', ('CompositorNodeRLayers', 'CompositorNodeComposite'))
+            nodes = self.node_tree.nodes
+            self.node_tree.links.new(nodes['Render Layers'].outputs['Image'], nodes['Composite'].inputs['Image'])
+
+    @recorded('scene.update')
+    def update(self):
+        pass
+
+class Context(object):
+    def __init__(self, scene):
+        self.scene = scene
+
+    @property
+    def active_object(self):
+        return self.scene.objects.active
+
+    object = active_object
+
+
+def add_object(kind, data, location=(0, 0, 0), rotation=(0, 0, 0)):
+    '''
+    What the *_add operators do: link a new object at location,
+    make it the only selected object and the active one
+    '''
+    obj = DATA.objects.new(kind, data)
+    obj.location = location
+    obj.rotation_euler = rotation
+    scene = CONTEXT.scene
+    scene.objects.link(obj)
+    SELECTED.clear()
+    SELECTED.add(obj)
+    scene.objects.active = obj
+    return {'FINISHED'}
+
+def add_mesh(kind):
+    @recorded('ops.mesh.primitive_%s_add' % kind.lower())
+    def operator(radius=1.0, depth=2.0, location=(0, 0, 0), rotation=(0, 0, 0), **kwargs):
+        return add_object(kind, DATA.meshes.new(kind), location, rotation)
+    return operator
+
+@recorded('ops.object.camera_add')
+def camera_add(view_align=False, location=(0, 0, 0), rotation=(0, 0, 0), **kwargs):
+    return add_object('Camera', DATA.cameras.new('Camera'), location, rotation)
+
+@recorded('ops.object.delete')
+def delete(use_global=False):
+    scene = CONTEXT.scene
+    for obj in list(SELECTED):
+        if id(obj) in scene.objects.objects:
+            DATA.objects.remove(obj)
+    return {'FINISHED'}
+
+def frame_path(path, frame):
+    '''
+    A File Output slot path with its #### replaced by the frame,
+    or the frame appended when it has none
+    '''
+    if '#' not in path:
+        return path + '%04d' % frame
+    return re.sub(r'#+', lambda m: '%0*d' % (len(m.group(0)), frame), path)
+
+def touch(path):
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    open(path, 'wb').close()
+
+@recorded('ops.render.render')
+def render(write_still=False, **kwargs):
+    '''
+    Render nothing, but leave empty files where Blender would write
+    the still image and the File Output nodes, and fill the Viewer
+    Node image with zeros
+    '''
+    scene = CONTEXT.scene
+    if scene.camera is None:
+        raise RuntimeError("Error: No camera found in scene")
+    extension = scene.render.file_extension
+    if write_still:
+        touch(scene.render.filepath + extension)
+    if scene.use_nodes:
+        for node in scene.node_tree.nodes:
+            if node.mute:
+                continue
+            if node.bl_idname == 'CompositorNodeOutputFile':
+                for slot in node.file_slots:
+                    touch(os.path.join(node.base_path, frame_path(slot.path, scene.frame_current) + extension))
+            elif node.bl_idname == 'CompositorNodeViewer':
+                scale = scene.render.resolution_percentage / 100.0
+                width = int(scene.render.resolution_x * scale)
+                height = int(scene.render.resolution_y * scale)
+                viewer = DATA.images.get('Viewer Node')
+                if viewer is None or tuple(viewer.size) != (width, height):
+                    if viewer is not None:
+                        DATA.images.remove(viewer)
+                    viewer = DATA.images.new('Viewer Node', width, height)
+                    viewer.type = 'COMPOSITING'
+    return {'FINISHED'}
+
+class OperatorGroup(object):
+    '''
+    bpy.ops.<group>; operators the stand-in does not model are
+    counted and do nothing
+    '''
+    def __init__(self, group, **operators):
+        self._group = group
+        self.__dict__.update(operators)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        @recorded('ops.%s.%s' % (self._group, name))
+        def operator(*args, **kwargs):
+            return {'FINISHED'}
+        return operator
+
+def make_ops():
+    return Settings(
+        mesh=OperatorGroup('mesh', primitive_cube_add=add_mesh('Cube'),
+                           primitive_cylinder_add=add_mesh('Cylinder'),
+                           primitive_plane_add=add_mesh('Plane')),
+        object=OperatorGroup('object', camera_add=camera_add, delete=delete),
+        render=OperatorGroup('render', render=render))
+
+
+DATA = None
+CONTEXT = None
+SELECTED = set()
+
+def reset():
+    '''
+    Start from an empty scene and clear the recorder
+    '''
+    global DATA, CONTEXT
+    DATA = Settings(objects=Collection('objects', Object), meshes=Collection('meshes', Mesh),
+                    materials=Collection('materials', Material), cameras=Collection('cameras', Camera),
+                    lamps=Collection('lamps', Lamp), images=Collection('images', Image),
+                    scenes=Collection('scenes', Scene))
+    CONTEXT = Context(DATA.scenes.new('Scene'))
+    SELECTED.clear()
+    RECORDER.clear()
+    bpy = sys.modules.get('bpy')
+    if bpy is not None and getattr(bpy, 'STANDIN', False):
+        bpy.data = DATA
+        bpy.context = CONTEXT
+
+def datablock_counts():
+    '''
+    Number of datablocks of each kind, objects linked to the scene,
+    nodes in all node trees and materials without users
+    '''
+    counts = dict((kind, len(getattr(DATA, kind))) for kind in COLLECTIONS)
+    counts['linked'] = len(CONTEXT.scene.objects)
+    counts['nodes'] = node_count()
+    counts['orphan_materials'] = sum(1 for material in DATA.materials if material.users == 0)
+    return counts
+
+def install():
+    '''
+    Register the stand-in as the bpy and mathutils modules, so
+    "import bpy" of the code under test picks it up. Installing again
+    keeps the modules code already imported, with an empty scene
+    '''
+    if getattr(sys.modules.get('bpy'), 'STANDIN', False):
+        reset()
+        return sys.modules['bpy']
+    bpy = types.ModuleType('bpy')
+    bpy.STANDIN = True
+    bpy.ops = make_ops()
+    bpy.app = Settings(version=BLENDER_VERSION, handlers=Settings(render_pre=[], render_post=[]))
+    mathutils = types.ModuleType('mathutils')
+    for cls in (Vector, Euler, Color, Matrix):
+        setattr(mathutils, cls.__name__, cls)
+    mathutils.__all__ = ['Vector', 'Euler', 'Color', 'Matrix']
+    sys.modules['bpy'] = bpy
+    sys.modules['mathutils'] = mathutils
+    reset()
+    return bpy
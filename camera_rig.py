@@ -0,0 +1,180 @@
+import numpy as np
+
+'''
+Camera rigs computed with numpy
+
+Positions for many cameras at once (one or several rings, a Fibonacci
+cap over the scene, jittered heights), look-at rotations for all of
+them in one go and the K, R, t of every camera for export.
+
+Conventions: a rotation is camera to world in Blender's camera frame
+(the camera looks down its -Z axis with +Y up), as matrix_world of a
+camera object. The exported R and t are world to camera in the
+OpenCV frame (x right, y down, z forward), so a world point X maps to
+pixel K (R X + t) with the origin in the top left corner.
+
+Usage:
+    positions = ring(radius=7, height=2, count=8)
+    rotations = look_at(positions, (0, 0, 1))
+    export_rig('camera.npz', names, pose_matrices(positions, rotations),
+               intrinsics(960, 540, 35, 32), (960, 540))
+'''
+
+# the first camera of a legacy ring sits at 45 degrees
+RING_START = 45.0
+GOLDEN_ANGLE = np.pi * (3 - np.sqrt(5))
+
+
+def ring(radius, height, count, start=RING_START):
+    '''
+    count positions evenly spaced on a circle of the given radius
+    around the Z axis at the given height, the first at start degrees
+    from +Y towards +X and the others following clockwise seen from
+    above
+    '''
+    angle = np.radians(start + np.arange(count) * 360.0 / max(count, 1))
+    return np.stack([radius * np.sin(angle), radius * np.cos(angle),
+                     np.full(count, float(height))], axis=1)
+
+def rings(radii, heights, counts, stagger=True):
+    '''
+    Several rings, ring k with counts[k] cameras at radii[k] and
+    heights[k]. With stagger every other ring is turned by half
+    its spacing so cameras of neighbouring rings do not line up
+    '''
+    positions = []
+    for k, (radius, height, count) in enumerate(zip(radii, heights, counts)):
+        start = RING_START
+        if stagger and k % 2 == 1 and count > 0:
+            start += 180.0 / count
+        positions.append(ring(radius, height, count, start))
+    return np.concatenate(positions) if positions else np.zeros((0, 3))
+
+def fibonacci_cap(count, radius, center=(0, 0, 0), max_polar=75.0):
+    '''
+    count nearly evenly spread positions on the cap of the sphere
+    of the given radius around center, up to max_polar degrees from
+    straight above
+    '''
+    lowest = np.cos(np.radians(max_polar))
+    z = 1 - (1 - lowest) * (np.arange(count) + 0.5) / max(count, 1)
+    ring_radius = np.sqrt(np.maximum(1 - z ** 2, 0))
+    phi = np.arange(count) * GOLDEN_ANGLE
+    unit = np.stack([ring_radius * np.cos(phi), ring_radius * np.sin(phi), z], axis=1)
+    return np.asarray(center, dtype=float) + radius * unit
+
+def jitter_heights(positions, amount, rng=None, floor=0.0):
+    '''
+    Move every position up or down by up to amount, keeping
+    it above floor
+    '''
+    if rng is None:
+        rng = np.random.RandomState()
+    positions = np.array(positions, dtype=float)
+    positions[:, 2] += rng.uniform(-amount, amount, len(positions))
+    positions[:, 2] = np.maximum(positions[:, 2], floor)
+    return positions
+
+
+def look_at(positions, target, roll=0.0):
+    '''
+    Camera to world rotations, shape (n, 3, 3), of cameras at
+    positions looking at target: the camera -Z axis points at target
+    and its +Y axis is the world +Z projected onto the image plane
+    (world +Y when looking straight up or down). roll turns the
+    camera about its view axis, in radians
+    '''
+    positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+    back = positions - np.asarray(target, dtype=float)
+    back /= np.maximum(np.linalg.norm(back, axis=1, keepdims=True), 1e-12)
+    up = np.tile([0.0, 0.0, 1.0], (len(positions), 1))
+    # looking straight up or down, take +Y as up instead
+    vertical = np.abs(back[:, 2]) > 1 - 1e-9
+    up[vertical] = [0.0, 1.0, 0.0]
+    y = up - np.sum(up * back, axis=1, keepdims=True) * back
+    y /= np.linalg.norm(y, axis=1, keepdims=True)
+    x = np.cross(y, back)
+    rotations = np.stack([x, y, back], axis=2)
+    if roll:
+        c, s = np.cos(roll), np.sin(roll)
+        rotations = rotations @ np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]])
+    return rotations
+
+def rotation_to_euler(rotations):
+    '''
+    XYZ Euler angles (rotation_euler of an object) of rotation
+    matrices of shape (n, 3, 3)
+    '''
+    rotations = np.asarray(rotations, dtype=float).reshape(-1, 3, 3)
+    ey = np.arcsin(np.clip(-rotations[:, 2, 0], -1, 1))
+    ex = np.arctan2(rotations[:, 2, 1], rotations[:, 2, 2])
+    ez = np.arctan2(rotations[:, 1, 0], rotations[:, 0, 0])
+    # gimbal lock: put the whole rotation about z into x
+    locked = np.abs(rotations[:, 2, 0]) > 1 - 1e-9
+    ex[locked] = np.arctan2(-rotations[locked, 1, 2], rotations[locked, 1, 1])
+    ez[locked] = 0
+    return np.stack([ex, ey, ez], axis=1)
+
+def pose_matrices(positions, rotations):
+    '''
+    4x4 matrix_world of every camera
+    '''
+    positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+    poses = np.tile(np.eye(4), (len(positions), 1, 1))
+    poses[:, :3, :3] = rotations
+    poses[:, :3, 3] = positions
+    return poses
+
+
+def intrinsics(width, height, lens, sensor_width, sensor_height=None, sensor_fit='AUTO'):
+    '''
+    Pixel intrinsic matrix K of a Blender camera rendering a
+    width x height image (square pixels, no lens shift)
+    '''
+    if sensor_fit == 'VERTICAL':
+        focal = lens / sensor_height * height
+    elif sensor_fit == 'HORIZONTAL' or width >= height:
+        focal = lens / sensor_width * width
+    else:
+        # AUTO fits the sensor width to the longer image side
+        focal = lens / sensor_width * height
+    return np.array([[focal, 0, width / 2.0],
+                     [0, focal, height / 2.0],
+                     [0, 0, 1]])
+
+def extrinsics(matrix_world):
+    '''
+    World to camera R, t in the OpenCV frame of every matrix_world
+    '''
+    matrix_world = np.asarray(matrix_world, dtype=float).reshape(-1, 4, 4)
+    # Blender camera frame to OpenCV: flip y and z
+    flip = np.diag([1.0, -1.0, -1.0])
+    R = flip @ np.transpose(matrix_world[:, :3, :3], (0, 2, 1))
+    t = -np.einsum('nij,nj->ni', R, matrix_world[:, :3, 3])
+    return R, t
+
+def export_rig(path, names, matrix_world, K, image_size, mist=None):
+    '''
+    Write the rig to a .npz file with arrays names, K (n, 3, 3),
+    R (n, 3, 3), t (n, 3), matrix_world (n, 4, 4) and image_size
+    (width, height). K may be one matrix shared by every camera.
+    mist, the (start, depth) of the mist pass saved as depth map,
+    is written as the array mist when given
+    '''
+    matrix_world = np.asarray(matrix_world, dtype=float).reshape(-1, 4, 4)
+    K = np.asarray(K, dtype=float)
+    if K.ndim == 2:
+        K = np.tile(K, (len(matrix_world), 1, 1))
+    R, t = extrinsics(matrix_world)
+    arrays = dict(names=np.array(names), K=K, R=R, t=t, matrix_world=matrix_world,
+                  image_size=np.array(image_size))
+    if mist is not None:
+        arrays['mist'] = np.array(mist, dtype=float)
+    np.savez(path, **arrays)
+
+def load_rig(path):
+    '''
+    Read a rig written by export_rig() as a dict of arrays
+    '''
+    rig = np.load(path)
+    return dict((name, rig[name]) for name in rig.files)
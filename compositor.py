@@ -0,0 +1,153 @@
+import bpy
+
+'''
+One compositor graph for every output of haze_generator_new.py
+
+The compositor tree holds a fixed set of named nodes: Render Layers,
+Composite, a File Output node per output written next to the
+Composite image ("Depth Output", "Normals Output") and a Viewer node
+for the background image writer. A node is created the first time an
+output configuration needs it and found by name afterwards, so image
+sets and rounds reuse the same graph. configure() switches between
+configurations by relinking the Composite input and muting the File
+Output and Viewer nodes that are not wanted; a link that is already
+there is left alone.
+
+An output is a render layer pass (OUTPUTS). Transmission has no pass
+in Cycles, the exact maps are computed by transmission.py instead.
+
+Usage:
+    graph = compositor_graph()
+    graph.configure('rgb', files={'depth': depth_directory})   # image + depth in one render
+    graph.configure('depth')                                   # depth map as the Composite image
+'''
+
+# output -> (Render Layers socket, render layer flag turning its pass on)
+OUTPUTS = {
+    'rgb': ('Image', None),
+    'depth': ('Mist', 'use_pass_mist'),
+    'normals': ('Normal', 'use_pass_normal'),
+}
+
+
+class CompositorGraph(object):
+    '''
+    The compositor graph of a scene. Nodes are looked up by name
+    on every use, so nodes removed behind its back are made again
+    '''
+    def __init__(self, scene):
+        self.scene = scene
+        self.created = 0
+        self.relinked = 0
+
+    @property
+    def tree(self):
+        self.scene.use_nodes = True
+        return self.scene.node_tree
+
+    def node(self, name, kind, location=(0, 0)):
+        '''
+        The node called name, created the first time
+        '''
+        tree = self.tree
+        node = tree.nodes.get(name)
+        if node is None or node.bl_idname != kind:
+            if node is not None:
+                tree.nodes.remove(node)
+            node = tree.nodes.new(type=kind)
+            node.name = name
+            node.location = location
+            self.created += 1
+        return node
+
+    def render_layers(self):
+        return self.node("Render Layers", "CompositorNodeRLayers")
+
+    def composite(self):
+        return self.node("Composite", "CompositorNodeComposite", (200, 0))
+
+    def source(self, output):
+        '''
+        Render Layers socket of output, with its pass turned on
+        '''
+        name, flag = OUTPUTS[output]
+        if flag is not None:
+            layer = self.scene.render.layers['RenderLayer']
+            if not getattr(layer, flag):
+                setattr(layer, flag, True)
+        return self.render_layers().outputs[name]
+
+    def link(self, source, target):
+        '''
+        Feed target from source unless it already is
+        '''
+        tree = self.tree
+        for link in list(tree.links):
+            if link.to_socket == target:
+                if link.from_socket == source:
+                    return link
+                tree.links.remove(link)
+        self.relinked += 1
+        return tree.links.new(source, target)
+
+    def file_output(self, output, directory):
+        '''
+        The File Output node writing output to directory in the
+        file format of the Composite image
+        '''
+        index = sorted(OUTPUTS).index(output)
+        node = self.node("%s Output" % output.capitalize(), "CompositorNodeOutputFile", (200, -200 * (index + 1)))
+        settings = self.scene.render.image_settings
+        node.format.file_format = settings.file_format
+        node.format.color_mode = settings.color_mode
+        node.format.color_depth = settings.color_depth
+        node.format.compression = settings.compression
+        node.base_path = directory
+        self.link(self.source(output), node.inputs[0])
+        return node
+
+    def viewer(self, image, alpha=None):
+        '''
+        The Viewer node showing output image, with output alpha
+        as its alpha channel
+        '''
+        node = self.node("Viewer", "CompositorNodeViewer", (200, 200))
+        node.use_alpha = alpha is not None
+        self.link(self.source(image), node.inputs['Image'])
+        if alpha is not None:
+            self.link(self.source(alpha), node.inputs['Alpha'])
+        return node
+
+    def configure(self, composite='rgb', files=None, viewer=None):
+        '''
+        Show output composite as the Composite image, write every
+        output of files ({output: directory}) with its File Output
+        node and, with viewer = (image, alpha) outputs, feed the
+        Viewer node. Other File Output and Viewer nodes are muted.
+        Return the File Output nodes by output
+        '''
+        files = files or {}
+        self.link(self.source(composite), self.composite().inputs['Image'])
+        nodes = dict((output, self.file_output(output, directory)) for output, directory in files.items())
+        wanted = set(node.name for node in nodes.values())
+        if viewer is not None:
+            wanted.add(self.viewer(*viewer).name)
+        for node in self.tree.nodes:
+            if node.bl_idname in ("CompositorNodeOutputFile", "CompositorNodeViewer"):
+                node.mute = node.name not in wanted
+        return nodes
+
+GRAPHS = {}
+
+def compositor_graph(scene=None):
+    '''
+    The CompositorGraph of scene (the current one by default),
+    the same object on every call
+    '''
+    if scene is None:
+        scene = bpy.context.scene
+    key = scene.as_pointer()
+    graph = GRAPHS.get(key)
+    if graph is None or graph.scene != scene:
+        graph = GRAPHS[key] = CompositorGraph(scene)
+    return graph
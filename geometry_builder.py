@@ -0,0 +1,166 @@
+import bpy
+import numpy as np
+from math import *
+
+'''
+Build scene geometry through bpy.data instead of bpy.ops
+
+Every bpy.ops.*_add call updates the scene and re-evaluates the
+dependency graph, so adding n objects that way costs more than n times
+adding one. GeometryBatch creates the objects directly as datablocks,
+sharing one unit mesh per shape and sizing each object with its scale,
+and links all of them to the scene in a single pass at the end.
+
+Usage:
+    batch = GeometryBatch()
+    batch.cubes(locations, radius, materials)
+    batch.cameras(camera_locations)
+    batch.link()
+'''
+
+# default segment count of bpy.ops.mesh.primitive_cylinder_add
+CYLINDER_VERTICES = 32
+
+
+def mesh_from_arrays(name, vertices, faces):
+    '''
+    Create a mesh datablock from a vertex array and a list of
+    faces (vertex index tuples) with foreach_set on whole arrays
+    '''
+    vertices = np.asarray(vertices, dtype=np.float32)
+    loop_total = np.array([len(face) for face in faces], dtype=np.int32)
+    loop_start = np.concatenate(([0], np.cumsum(loop_total)[:-1])).astype(np.int32)
+    vertex_index = np.concatenate([np.asarray(face) for face in faces]).astype(np.int32)
+
+    mesh = bpy.data.meshes.new(name)
+    mesh.vertices.add(len(vertices))
+    mesh.vertices.foreach_set('co', vertices.ravel())
+    mesh.loops.add(len(vertex_index))
+    mesh.loops.foreach_set('vertex_index', vertex_index)
+    mesh.polygons.add(len(faces))
+    mesh.polygons.foreach_set('loop_start', loop_start)
+    mesh.polygons.foreach_set('loop_total', loop_total)
+    mesh.update(calc_edges=True)
+    return mesh
+
+def unit_cube():
+    '''
+    Cube of radius 1 around the origin, like primitive_cube_add
+    '''
+    vertices = [(1, 1, -1), (1, -1, -1), (-1, -1, -1), (-1, 1, -1),
+                (1, 1, 1), (1, -1, 1), (-1, -1, 1), (-1, 1, 1)]
+    faces = [(0, 1, 2, 3), (4, 7, 6, 5), (0, 4, 5, 1),
+             (1, 5, 6, 2), (2, 6, 7, 3), (4, 0, 3, 7)]
+    return mesh_from_arrays("Cube", vertices, faces)
+
+def unit_cylinder(segments=CYLINDER_VERTICES):
+    '''
+    Cylinder of radius 1 and depth 2 around the origin with n-gon
+    caps, like primitive_cylinder_add
+    '''
+    angle = np.arange(segments) * 2 * pi / segments
+    ring = np.stack([np.cos(angle), np.sin(angle)], axis=1)
+    vertices = np.zeros((2 * segments, 3))
+    vertices[:segments, :2] = ring
+    vertices[:segments, 2] = -1
+    vertices[segments:, :2] = ring
+    vertices[segments:, 2] = 1
+    faces = [(i, (i + 1) % segments, segments + (i + 1) % segments, segments + i)
+             for i in range(segments)]
+    faces.append(tuple(range(segments, 2 * segments)))
+    faces.append(tuple(reversed(range(segments))))
+    return mesh_from_arrays("Cylinder", vertices, faces)
+
+def unit_plane():
+    '''
+    Plane of radius 1 in the xy plane, like primitive_plane_add
+    '''
+    vertices = [(-1, -1, 0), (1, -1, 0), (1, 1, 0), (-1, 1, 0)]
+    return mesh_from_arrays("Plane", vertices, [(0, 1, 2, 3)])
+
+
+class GeometryBatch(object):
+    '''
+    Collect new objects and link them to the scene in one go.
+    Objects of one shape share a mesh, so their material is
+    attached to the object rather than to the mesh.
+    '''
+    def __init__(self):
+        self.objects = []
+        self.meshes = {}
+
+    def _mesh(self, shape, build):
+        if shape not in self.meshes:
+            mesh = build()
+            # one material slot, filled per object
+            mesh.materials.append(None)
+            self.meshes[shape] = mesh
+        return self.meshes[shape]
+
+    def _add(self, name, mesh, location, scale, material):
+        obj = bpy.data.objects.new(name, mesh)
+        obj.location = location
+        obj.scale = scale
+        if len(obj.material_slots):
+            # the mesh is shared, so the material is set on the object,
+            # also when it is given later
+            slot = obj.material_slots[0]
+            slot.link = 'OBJECT'
+            if material is not None:
+                slot.material = material
+        self.objects.append(obj)
+        return obj
+
+    def cubes(self, locations, radius, materials=None):
+        '''
+        Add one cube of the given radius at every location
+        '''
+        mesh = self._mesh("cube", unit_cube)
+        if materials is None:
+            materials = [None] * len(locations)
+        return [self._add("Cube", mesh, loc, (radius, radius, radius), mat)
+                for loc, mat in zip(locations, materials)]
+
+    def cylinders(self, locations, radii, depths, materials=None):
+        '''
+        Add cylinders, depth being the full height of each one
+        '''
+        mesh = self._mesh("cylinder", unit_cylinder)
+        if materials is None:
+            materials = [None] * len(locations)
+        return [self._add("Cylinder", mesh, loc, (radius, radius, depth / 2), mat)
+                for loc, radius, depth, mat in zip(locations, radii, depths, materials)]
+
+    def plane(self, radius, location, material=None):
+        mesh = self._mesh("plane", unit_plane)
+        return self._add("Plane", mesh, location, (radius, radius, 1), material)
+
+    def cameras(self, locations, rotations=None):
+        '''
+        Add one camera at every location, named Camera, Camera.001, ...
+        as bpy.ops.object.camera_add would, optionally turned by
+        rotations (XYZ Euler angles, one per camera)
+        '''
+        cameras = []
+        if rotations is None:
+            rotations = [(0, 0, 0)] * len(locations)
+        for loc, rotation in zip(locations, rotations):
+            obj = bpy.data.objects.new("Camera", bpy.data.cameras.new("Camera"))
+            obj.location = loc
+            obj.rotation_euler = rotation
+            self.objects.append(obj)
+            cameras.append(obj)
+        return cameras
+
+    def link(self, scene=None):
+        '''
+        Link every collected object to the scene and update it once
+        '''
+        if scene is None:
+            scene = bpy.context.scene
+        for obj in self.objects:
+            scene.objects.link(obj)
+        scene.update()
+        linked = self.objects
+        self.objects = []
+        return linked
@@ -0,0 +1,532 @@
+import argparse
+import json
+import os
+import re
+import struct
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import camera_rig
+from haze_io import read_label, read_text_field
+from haze_synthesis import MIST_DEPTH, MIST_START, mist_range, mist_to_distance
+from image_pyramid import level_intrinsics, level_path
+from image_reader import load_png
+from image_writer import from_uint, srgb_to_linear
+from shard_writer import ShardReader
+
+'''
+Read the output tree of haze_generator_new.py for training
+
+A round directory written by run() holds
+
+    <round>/camera.txt                      look-at point and the location of every camera
+    <round>/camera.npz                      K, R, t of every camera (camera_rig.export_rig)
+    <round>/image_set_<scene mode><i>/<camera>.png  hazy image
+    <round>/image_set_<scene mode><i>/label<i>.txt  voxel densities as a text field
+    <round>/image_set_<scene mode><i>/label<i>.npy  the same densities with the poses
+    <round>/depth_set_<scene mode><i>/<camera>.png  mist pass of the same view
+
+Rounds rendered before camera.npz and label<i>.npy existed (such as
+example_images/random_0.1) only have camera.txt, whose camera lines
+are str() of the Blender object, and label<i>.txt. Their poses are
+rebuilt from the camera locations and the look-at point the way
+align_camera() aims the cameras, with the intrinsics of the default
+35 mm Blender camera the generator never changes.
+
+HazeDataset walks the tree once and keeps an index of every view
+(paths, the camera of each round as arrays); save_index() writes it as
+JSON so later jobs and epochs skip the walk and never parse camera.txt
+again. samples() streams one dict per view
+
+    {'round', 'image_set', 'camera',
+     'image'   (height, width, 3) float32 sRGB values in [0, 1],
+     'depth'   (height, width) float32 distance from the camera, NaN
+               where the mist pass clamped it (closer than the mist
+               start, see haze_synthesis.mist_to_distance),
+     'density' (z, y, x) float32 voxel densities,
+     'K', 'R', 't', 'matrix_world'   pose, see camera_rig.py}
+
+decoded on a thread pool with at most prefetch views decoded ahead of
+the consumer. The PNGs are decoded with OpenCV or Pillow when either
+is installed (image_reader.load_png), whose decoders release the GIL;
+without them the threads share the GIL of the numpy decoder.
+batches() decodes straight into preallocated arrays: a ring of
+prefetch + 1 batches is allocated once and reused, so memory stays
+fixed for the whole epoch, and a yielded batch is valid until the next
+one is asked for. With size the views of the pyramid level
+<round>/pyramid_<size> written by image_pyramid.py are read instead,
+with K cropped and scaled to match. Tar output is read with
+shard_samples(), which yields the same sample dicts from the shards,
+taking K, R, t and the mist range from the camera.json of each sample.
+
+Usage:
+    dataset = HazeDataset('/data/haze', index='/data/haze/index.json')
+    for batch in dataset.batches(32, shuffle=True, seed=epoch):
+        train(batch['image'], batch['depth'], batch['density'])
+    python haze_dataset.py /data/haze --index /data/haze/index.json --batch 32
+'''
+
+INDEX_VERSION = 3
+# lens and sensor width in mm of a new Blender camera
+DEFAULT_LENS = 35.0
+DEFAULT_SENSOR = 32.0
+# densities of this many image sets are kept decoded
+DENSITY_CACHE_SIZE = 64
+
+
+def png_size(path):
+    '''
+    (width, height) from the header of a PNG file
+    '''
+    f = open(path, 'rb')
+    header = f.read(24)
+    f.close()
+    return header_size(header, path)
+
+def header_size(header, name='PNG data'):
+    '''
+    (width, height) from the first 24 bytes of a PNG file
+    '''
+    if header[:8] != b'\x89PNG\r\n\x1a\n':
+        raise ValueError("%s is not a PNG file" % name)
+    return struct.unpack('>II', header[16:24])
+
+def read_image(source, out=None):
+    '''
+    float32 sRGB values in [0, 1] (height, width, 3) of a hazy image,
+    source being its path or PNG bytes
+    '''
+    array = load_png(source)
+    if array.shape[2] < 3:
+        array = np.repeat(array[:, :, :1], 3, axis=2)
+    if out is None:
+        out = np.empty(array.shape[:2] + (3,), dtype=np.float32)
+    np.multiply(array[:, :, :3], 1.0 / np.iinfo(array.dtype).max, out=out, casting='unsafe')
+    return out
+
+def read_depth(source, out=None, mist=(MIST_START, MIST_DEPTH)):
+    '''
+    Distance map of a mist pass PNG rendered with the mist range
+    mist (start, depth), source being its path or PNG bytes
+    '''
+    values = srgb_to_linear(from_uint(load_png(source)[:, :, 0]))
+    distance = mist_to_distance(values, mist[0], mist[1])
+    if out is None:
+        return distance.astype(np.float32)
+    out[...] = distance
+    return out
+
+def parse_camera_txt(path):
+    '''
+    Look-at point, names and locations of the cameras in a camera.txt
+    written by align_camera(). Names are written as str() of the
+    Blender object, <bpy_struct, Object("Camera.001")>
+    '''
+    f = open(path, 'r')
+    lines = [line.strip() for line in f]
+    f.close()
+    look_at = None
+    names = []
+    locations = []
+    for k, line in enumerate(lines):
+        if line == "Camera look at":
+            look_at = [float(value) for value in lines[k + 1].split()]
+        elif line.startswith("Camera name:"):
+            name = line[len("Camera name:"):].strip()
+            # the quoted name, also in the "... at 0x..." form of newer Blenders
+            match = re.search(r'"(.*)"', name)
+            names.append(match.group(1) if match else name)
+        elif line == "Camera locate at":
+            locations.append([float(value) for value in lines[k + 1].split()])
+    if look_at is None or len(names) != len(locations):
+        raise ValueError("%s is not a camera.txt written by align_camera()" % path)
+    return np.array(look_at), names, np.array(locations).reshape(-1, 3)
+
+def round_cameras(round_directory, image_size=None):
+    '''
+    names, K, R, t, matrix_world and image_size of the cameras of a
+    round from camera.npz or, for older rounds, camera.txt, whose
+    images are image_size (width, height)
+    '''
+    path = os.path.join(round_directory, 'camera.npz')
+    if os.path.exists(path):
+        rig = camera_rig.load_rig(path)
+        rig['names'] = [str(name) for name in rig['names']]
+        return rig
+    look_at, names, locations = parse_camera_txt(os.path.join(round_directory, 'camera.txt'))
+    matrix_world = camera_rig.pose_matrices(locations, camera_rig.look_at(locations, look_at))
+    R, t = camera_rig.extrinsics(matrix_world)
+    width, height = image_size
+    K = camera_rig.intrinsics(width, height, DEFAULT_LENS, DEFAULT_SENSOR)
+    return {'names': names, 'K': np.tile(K, (len(names), 1, 1)), 'R': R, 't': t,
+            'matrix_world': matrix_world, 'image_size': np.array(image_size)}
+
+def label_path(set_directory):
+    '''
+    label<i>.npy of an image set, or label<i>.txt without it
+    '''
+    labels = sorted(name for name in os.listdir(set_directory) if name.startswith('label'))
+    for ext in ('.npy', '.txt'):
+        for name in labels:
+            if name.endswith(ext):
+                return os.path.join(set_directory, name)
+    return None
+
+def round_key(name):
+    # rounds are numbered, sort 2 before 10
+    return (0, int(name), name) if name.isdigit() else (1, 0, name)
+
+def find_rounds(root):
+    '''
+    Round directories below root, root itself if it is one
+    '''
+    rounds = []
+    for directory, subdirectories, files in os.walk(root):
+        subdirectories.sort(key=round_key)
+        if 'camera.npz' in files or 'camera.txt' in files:
+            if any(name.startswith('image_set_') for name in subdirectories):
+                rounds.append(directory)
+            # image sets and pyramid levels are not rounds
+            subdirectories[:] = []
+    return rounds
+
+def index_round(root, round_directory, size=None):
+    '''
+    Index entries of the views of a round: its cameras and one sample
+    per view with a depth map and a label. Paths are relative to root
+    '''
+    samples = []
+    image_size = None
+    render_size = None
+    for set_name in sorted(os.listdir(round_directory)):
+        set_directory = os.path.join(round_directory, set_name)
+        if not set_name.startswith('image_set_') or not os.path.isdir(set_directory):
+            continue
+        suffix = set_name[len('image_set_'):]
+        label = label_path(set_directory)
+        if label is None:
+            continue
+        for name in sorted(os.listdir(set_directory)):
+            if not name.lower().endswith('.png'):
+                continue
+            image = os.path.join(set_directory, name)
+            depth = os.path.join(round_directory, 'depth_set_' + suffix, name)
+            if render_size is None and os.path.exists(image):
+                render_size = png_size(image)
+            if size is not None:
+                image, depth = level_path(image, size), level_path(depth, size)
+            if not os.path.exists(image) or not os.path.exists(depth):
+                continue
+            if image_size is None:
+                image_size = png_size(image)
+            samples.append({'image_set': suffix, 'camera': os.path.splitext(name)[0],
+                            'image': os.path.relpath(image, root), 'depth': os.path.relpath(depth, root),
+                            'label': os.path.relpath(label, root)})
+    if not samples:
+        return None, []
+    if render_size is None:
+        render_size = image_size
+    cameras = round_cameras(round_directory, render_size)
+    names = list(cameras['names'])
+    K = np.asarray(cameras['K'], dtype=float)
+    rendered = [float(n) for n in cameras['image_size']]
+    if tuple(rendered) != tuple(render_size):
+        # a render at another resolution percentage
+        K = K * np.array([[render_size[0] / rendered[0]], [render_size[1] / rendered[1]], [1]])
+    if size is not None:
+        K = level_intrinsics(K, render_size[0], render_size[1], size)
+    rig = {'names': names, 'K': K.tolist(), 'R': np.asarray(cameras['R']).tolist(),
+           't': np.asarray(cameras['t']).tolist(),
+           'matrix_world': np.asarray(cameras['matrix_world']).tolist(), 'image_size': list(image_size),
+           'mist': list(mist_range(cameras))}
+    indexed = []
+    for sample in samples:
+        if sample['camera'] in names:
+            sample['camera_index'] = names.index(sample['camera'])
+            indexed.append(sample)
+    return rig, indexed
+
+def build_index(root, size=None):
+    '''
+    Index of every view below root, a dict that json can write
+    '''
+    rounds = {}
+    samples = []
+    for round_directory in find_rounds(root):
+        name = os.path.relpath(round_directory, root)
+        rig, views = index_round(root, round_directory, size)
+        if rig is None:
+            continue
+        rounds[name] = rig
+        for view in views:
+            view['round'] = name
+        samples.extend(views)
+    return {'version': INDEX_VERSION, 'size': size, 'rounds': rounds, 'samples': samples}
+
+
+class DensityCache(object):
+    '''
+    Densities of the last image sets read, shared by the threads
+    '''
+    def __init__(self, max_size=DENSITY_CACHE_SIZE):
+        self.max_size = max_size
+        self.densities = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        with self.lock:
+            if path in self.densities:
+                self.densities.move_to_end(path)
+                return self.densities[path]
+        if path.endswith('.npy'):
+            density = np.array(read_label(path)['density'], dtype=np.float32)
+        else:
+            density = read_text_field(path).astype(np.float32)
+        with self.lock:
+            self.densities[path] = density
+            while len(self.densities) > self.max_size:
+                self.densities.popitem(last=False)
+        return density
+
+
+class Prefetcher(object):
+    '''
+    Run function on every item on a thread pool, keeping at most
+    depth results ahead of the consumer, and yield them in order
+    '''
+    def __init__(self, threads=4, depth=8):
+        self.threads = threads
+        self.depth = max(depth, 1)
+
+    def map(self, function, items):
+        pool = ThreadPoolExecutor(self.threads)
+        pending = deque()
+        items = iter(items)
+        try:
+            while True:
+                while len(pending) < self.depth:
+                    item = next(items, None)
+                    if item is None:
+                        break
+                    pending.append(pool.submit(function, item))
+                if not pending:
+                    break
+                yield pending.popleft().result()
+        finally:
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=True)
+
+
+class HazeDataset(object):
+    '''
+    The views of an output tree of haze_generator_new.py. With index,
+    the index is read from that file, or built and written there the
+    first time. With size, pyramid level size is read. Depth maps are
+    read with the mist range of their round, mist_start and mist_depth
+    override it
+    '''
+    def __init__(self, root, index=None, size=None, mist_start=None, mist_depth=None):
+        self.root = root
+        if index is not None and os.path.exists(index):
+            f = open(index, 'r')
+            self.index = json.load(f)
+            f.close()
+            if self.index.get('version') != INDEX_VERSION or self.index.get('size') != size:
+                self.index = None
+        else:
+            self.index = None
+        if self.index is None:
+            self.index = build_index(root, size)
+            if index is not None:
+                self.save_index(index)
+        self.views = self.index['samples']
+        self.rounds = dict((name, dict((key, np.asarray(value)) for key, value in rig.items()))
+                           for name, rig in self.index['rounds'].items())
+        for rig in self.rounds.values():
+            rig['mist'] = mist_range(rig, mist_start, mist_depth)
+        self.densities = DensityCache()
+
+    def save_index(self, path):
+        f = open(path + '.tmp', 'w')
+        json.dump(self.index, f)
+        f.close()
+        os.replace(path + '.tmp', path)
+
+    def __len__(self):
+        return len(self.views)
+
+    def shapes(self):
+        '''
+        Shapes of the image, depth and density of the views, taken from
+        the first one; batches() needs every view to have them
+        '''
+        sample = self.views[0]
+        width, height = self.index['rounds'][sample['round']]['image_size']
+        density = self.densities.get(os.path.join(self.root, sample['label']))
+        return (height, width, 3), (height, width), density.shape
+
+    def order(self, shuffle=False, seed=None):
+        if not shuffle:
+            return np.arange(len(self.views))
+        return np.random.RandomState(seed).permutation(len(self.views))
+
+    def load(self, k, out=None, row=None):
+        '''
+        View k as a sample dict, or decoded into row of the
+        batch arrays out
+        '''
+        sample = self.views[k]
+        rig = self.rounds[sample['round']]
+        camera = sample['camera_index']
+        density = self.densities.get(os.path.join(self.root, sample['label']))
+        if out is None:
+            return {'round': sample['round'], 'image_set': sample['image_set'], 'camera': sample['camera'],
+                    'image': read_image(os.path.join(self.root, sample['image'])),
+                    'depth': read_depth(os.path.join(self.root, sample['depth']), mist=rig['mist']),
+                    'density': density.copy(),
+                    'K': rig['K'][camera], 'R': rig['R'][camera], 't': rig['t'][camera],
+                    'matrix_world': rig['matrix_world'][camera]}
+        if density.shape != out['density'].shape[1:]:
+            raise ValueError("%s: %s densities in a batch of %s"
+                             % (sample['label'], density.shape, out['density'].shape[1:]))
+        read_image(os.path.join(self.root, sample['image']), out['image'][row])
+        read_depth(os.path.join(self.root, sample['depth']), out['depth'][row], rig['mist'])
+        out['density'][row] = density
+        for key in ('K', 'R', 't', 'matrix_world'):
+            out[key][row] = rig[key][camera]
+        out['index'][row] = k
+
+    def samples(self, shuffle=False, seed=None, threads=4, prefetch=8):
+        '''
+        Yield every view as a sample dict, decoded on threads
+        with at most prefetch views ahead
+        '''
+        return Prefetcher(threads, prefetch).map(self.load, self.order(shuffle, seed))
+
+    def allocate(self, batch_size):
+        image, depth, density = self.shapes()
+        return {'image': np.empty((batch_size,) + image, dtype=np.float32),
+                'depth': np.empty((batch_size,) + depth, dtype=np.float32),
+                'density': np.empty((batch_size,) + density, dtype=np.float32),
+                'K': np.empty((batch_size, 3, 3)), 'R': np.empty((batch_size, 3, 3)),
+                't': np.empty((batch_size, 3)), 'matrix_world': np.empty((batch_size, 4, 4)),
+                'index': np.empty(batch_size, dtype=np.int64)}
+
+    def batches(self, batch_size, shuffle=False, seed=None, threads=4, prefetch=2, drop_last=False):
+        '''
+        Yield dicts of arrays of batch_size views (see allocate()),
+        decoded on threads into a ring of prefetch + 1 preallocated
+        batches. A batch is overwritten once the next one is asked for,
+        copy what has to outlive it. index holds the view numbers
+        '''
+        prefetch = max(prefetch, 1)
+        order = self.order(shuffle, seed)
+        chunks = [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+        if drop_last and chunks and len(chunks[-1]) < batch_size:
+            chunks.pop()
+        if not chunks:
+            return
+        slots = [self.allocate(batch_size) for _ in range(prefetch + 1)]
+        free = list(range(len(slots)))
+        pending = deque()
+        chunks = iter(chunks)
+        pool = ThreadPoolExecutor(threads)
+        held = None
+        try:
+            while True:
+                if held is not None:
+                    # the consumer is done with the batch it was given
+                    free.append(held)
+                    held = None
+                while len(pending) < prefetch and free:
+                    chunk = next(chunks, None)
+                    if chunk is None:
+                        break
+                    slot = free.pop()
+                    futures = [pool.submit(self.load, k, slots[slot], row) for row, k in enumerate(chunk)]
+                    pending.append((slot, len(chunk), futures))
+                if not pending:
+                    break
+                slot, count, futures = pending.popleft()
+                for future in futures:
+                    future.result()
+                held = slot
+                yield dict((key, array[:count]) for key, array in slots[slot].items())
+        finally:
+            for _, _, futures in pending:
+                for future in futures:
+                    future.cancel()
+            pool.shutdown(wait=True)
+
+
+def shard_sample(reader, key, size=None):
+    '''
+    The view key of a tar shard read by a shard_writer.ShardReader as
+    the sample dict of HazeDataset.samples(), from pyramid level size
+    if given. K is scaled to the image read
+    '''
+    files = reader.samples[key]
+    ext = [name for name in files if '.' not in name][0]
+    camera = reader.camera(key)
+    rig = reader.rig(key)
+    render_size = header_size(reader.read(key, ext, 24), '%s.%s' % (key, ext))
+    K = rig['K'].astype(float)
+    rendered = [float(n) for n in rig['image_size']]
+    if tuple(rendered) != tuple(render_size):
+        # a render at another resolution percentage
+        K = K * np.array([[render_size[0] / rendered[0]], [render_size[1] / rendered[1]], [1]])
+    image, depth = ext, 'depth.' + ext
+    if size is not None:
+        image, depth = '%d.%s' % (size, ext), '%d.depth.%s' % (size, ext)
+        K = level_intrinsics(K, render_size[0], render_size[1], size)
+    return {'round': str(camera['round']), 'image_set': camera['image_set'], 'camera': camera['camera'],
+            'image': read_image(reader.read(key, image)),
+            'depth': read_depth(reader.read(key, depth), mist=mist_range(rig)),
+            'density': np.array(reader.label(key)['density'], dtype=np.float32),
+            'K': K, 'R': rig['R'], 't': rig['t'], 'matrix_world': rig['matrix_world']}
+
+def shard_samples(shards, size=None, threads=4, prefetch=8):
+    '''
+    Yield every view of the given tar shards as a sample dict,
+    decoded on threads with at most prefetch views ahead
+    '''
+    views = []
+    for shard in shards:
+        reader = ShardReader(shard)
+        views.extend((reader, key) for key in reader.keys())
+    return Prefetcher(threads, prefetch).map(lambda view: shard_sample(view[0], view[1], size), views)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Index an output tree and time reading it")
+    parser.add_argument('root', help="output directory of haze_generator_new.py, or one round")
+    parser.add_argument('--index', help="read the index from this JSON file, or write it there")
+    parser.add_argument('--size', type=int, help="read pyramid level size instead of the full images")
+    parser.add_argument('--batch', type=int, default=16)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--prefetch', type=int, default=2, help="batches decoded ahead")
+    args = parser.parse_args(argv)
+
+    start = time.time()
+    dataset = HazeDataset(args.root, args.index, args.size)
+    print("%d views in %d rounds, indexed in %.2f s"
+          % (len(dataset), len(dataset.rounds), time.time() - start))
+    if not len(dataset):
+        return 1
+    image, depth, density = dataset.shapes()
+    print("image %s, depth %s, density %s" % (image, depth, density))
+    start = time.time()
+    views = 0
+    for batch in dataset.batches(args.batch, threads=args.threads, prefetch=args.prefetch):
+        views += len(batch['index'])
+    elapsed = time.time() - start
+    print("read %d views in %.2f s, %.1f views/s" % (views, elapsed, views / max(elapsed, 1e-9)))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
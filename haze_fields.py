@@ -0,0 +1,252 @@
+import argparse
+import os
+import sys
+import warnings
+import numpy as np
+from haze_io import create_bundle, write_text_field
+
+'''
+Correlated air transmittance fields for haze_generator_new.py
+
+Stationary Gaussian random fields are drawn by circulant embedding:
+the covariance is laid out on a periodic grid at least twice the size
+of the field, its FFT gives the eigenvalues of the embedding, and one
+FFT of scaled complex white noise gives two independent fields. This
+costs O(n log n) in the number of voxels, where a Cholesky factor of
+the covariance matrix costs O(n^3) and does not fit in memory for a
+32x32x32 grid.
+
+The fields are mapped to Volume Scatter densities and written either
+as text files in the input format read by run() or as one .npy bundle
+(see haze_io.py).
+
+Usage:
+    python haze_fields.py --dim 32 32 32 --kernel matern --length 4 --count 1000 --output input_file/matern
+    python haze_fields.py --dim 32 32 32 --count 10000 --output input_file/matern.npy
+    python haze_fields.py --dim 16 16 16 --kernel exponential --length 3 --check
+'''
+
+
+def exponential_kernel(r, length, nu=None):
+    return np.exp(-r / length)
+
+def gaussian_kernel(r, length, nu=None):
+    return np.exp(-0.5 * (r / length) ** 2)
+
+def matern_kernel(r, length, nu=1.5):
+    '''
+    Matern covariance with smoothness nu. nu = 0.5, 1.5 and 2.5 use
+    the closed forms, any other nu needs scipy
+    '''
+    if nu == 0.5:
+        return np.exp(-r / length)
+    if nu == 1.5:
+        a = np.sqrt(3.0) * r / length
+        return (1 + a) * np.exp(-a)
+    if nu == 2.5:
+        a = np.sqrt(5.0) * r / length
+        return (1 + a + a ** 2 / 3.0) * np.exp(-a)
+    try:
+        from scipy.special import gamma, kv
+    except ImportError:
+        raise ImportError("Matern kernel with nu=%g needs scipy, use nu 0.5, 1.5 or 2.5" % nu)
+    a = np.sqrt(2 * nu) * np.asarray(r, dtype=float) / length
+    with np.errstate(invalid='ignore'):
+        c = 2 ** (1 - nu) / gamma(nu) * a ** nu * kv(nu, a)
+    return np.where(a == 0, 1.0, c)
+
+KERNELS = {
+    'exponential': exponential_kernel,
+    'gaussian': gaussian_kernel,
+    'matern': matern_kernel,
+}
+
+
+def embedding_eigenvalues(shape, kernel, length, nu=1.5, spacing=1.0, padding=2):
+    '''
+    Eigenvalues of the circulant embedding of the covariance of a
+    field of the given shape on a periodic grid padding times larger
+    '''
+    padded = [max(int(padding * n), 1) for n in shape]
+    axes = []
+    for m in padded:
+        k = np.arange(m)
+        axes.append(np.minimum(k, m - k) * spacing)
+    r2 = 0
+    for i, d in enumerate(axes):
+        view = [1] * len(axes)
+        view[i] = len(d)
+        r2 = r2 + d.reshape(view) ** 2
+    c = KERNELS[kernel](np.sqrt(r2), length, nu)
+    return np.fft.fftn(c).real
+
+
+class FieldGenerator(object):
+    '''
+    Draw zero mean, unit variance Gaussian random fields of the given
+    shape ([z, y, x] like the arrays of haze_generator_new.py) with
+    the named covariance kernel. length is the correlation length in
+    voxels times spacing
+    '''
+    def __init__(self, shape, kernel='exponential', length=2.0, nu=1.5,
+                 spacing=1.0, seed=None, max_padding=8):
+        if kernel not in KERNELS:
+            raise ValueError("unknown kernel %r, use one of %s" % (kernel, sorted(KERNELS)))
+        self.shape = tuple(int(n) for n in shape)
+        self.kernel = kernel
+        self.length = length
+        self.nu = nu
+        self.spacing = spacing
+        self.rng = np.random.RandomState(seed)
+
+        # grow the embedding until it is positive semi-definite
+        for padding in range(2, max_padding + 1):
+            lam = embedding_eigenvalues(self.shape, kernel, length, nu, spacing, padding)
+            if lam.min() >= -1e-8 * lam.max():
+                break
+        else:
+            warnings.warn("circulant embedding not positive definite up to padding %d "
+                          "(min eigenvalue %g), clipping it, the covariance is approximate"
+                          % (max_padding, lam.min()))
+        self.padding = padding
+        self.padded = lam.shape
+        self.scale = np.sqrt(np.maximum(lam, 0) / lam.size)
+
+    def covariance(self, r):
+        return KERNELS[self.kernel](np.asarray(r, dtype=float), self.length, self.nu)
+
+    def sample(self, count=1, batch_size=64):
+        '''
+        Return count fields as an array of shape (count,) + shape
+        '''
+        fields = np.empty((count,) + self.shape)
+        crop = (slice(None),) + tuple(slice(0, n) for n in self.shape)
+        axes = tuple(range(1, len(self.shape) + 1))
+        done = 0
+        while done < count:
+            # every complex FFT gives two independent fields
+            pairs = min(batch_size, (count - done + 1) // 2)
+            noise = (self.rng.standard_normal((pairs,) + self.padded)
+                     + 1j * self.rng.standard_normal((pairs,) + self.padded))
+            y = np.fft.fftn(self.scale * noise, axes=axes)[crop]
+            both = np.concatenate([y.real, y.imag])
+            take = min(len(both), count - done)
+            fields[done:done + take] = both[:take]
+            done += take
+        return fields
+
+
+def to_density(fields, mean=0.1, std=0.03, transform='lognormal', low=0.0):
+    '''
+    Map unit Gaussian fields to Volume Scatter densities with the
+    given mean and standard deviation. lognormal keeps every density
+    positive, normal is mean + std * field clipped at low
+    '''
+    fields = np.asarray(fields)
+    if transform == 'lognormal':
+        s2 = np.log(1 + (std / mean) ** 2)
+        return np.exp(np.log(mean) - s2 / 2 + np.sqrt(s2) * fields)
+    if transform == 'normal':
+        return np.maximum(mean + std * fields, low)
+    raise ValueError("unknown transform %r" % transform)
+
+
+def write_fields(directory, densities, prefix='field', start=0):
+    '''
+    Write every field of a batch to <directory>/<prefix>_<k>.txt
+    and return the paths
+    '''
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    paths = []
+    for k, density in enumerate(densities, start):
+        path = os.path.join(directory, '%s_%05d.txt' % (prefix, k))
+        write_text_field(path, density)
+        paths.append(path)
+    return paths
+
+
+def empirical_covariance(fields, max_lag):
+    '''
+    Covariance of zero mean fields at lags 0..max_lag along each
+    axis, averaged over the positions of every field. Returns an
+    array of shape (number of fields, number of axes, max_lag + 1)
+    '''
+    fields = np.asarray(fields)
+    positions = tuple(range(1, fields.ndim))
+    result = np.zeros((len(fields), fields.ndim - 1, max_lag + 1))
+    for axis in positions:
+        n = fields.shape[axis]
+        for lag in range(min(max_lag, n - 1) + 1):
+            a = np.take(fields, np.arange(0, n - lag), axis=axis)
+            b = np.take(fields, np.arange(lag, n), axis=axis)
+            result[:, axis - 1, lag] = np.mean(a * b, axis=positions)
+    return result
+
+def check_covariance(generator, count=2000, max_lag=None):
+    '''
+    Compare the empirical covariance of count fields with the
+    requested kernel. Every lag must be within five standard errors
+    of the kernel; returns (worst error in standard errors, passed)
+    '''
+    if max_lag is None:
+        max_lag = min(min(generator.shape) - 1, int(np.ceil(3 * generator.length / generator.spacing)))
+    per_field = empirical_covariance(generator.sample(count), max_lag)
+    measured = per_field.mean(axis=0)
+    stderr = per_field.std(axis=0) / np.sqrt(count)
+    expected = generator.covariance(np.arange(max_lag + 1) * generator.spacing)
+    score = (np.abs(measured - expected) / np.maximum(stderr, 1e-12)).max()
+    passed = score <= 5
+    print("lag      " + " ".join("%7d" % lag for lag in range(max_lag + 1)))
+    print("kernel   " + " ".join("%7.4f" % c for c in expected))
+    for axis, row in zip("zyx"[3 - len(generator.shape):], measured):
+        print("%s axis   " % axis + " ".join("%7.4f" % c for c in row))
+    print("worst lag is %.1f standard errors off: %s" % (score, "ok" if passed else "FAILED"))
+    return score, passed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate correlated haze density fields")
+    parser.add_argument('--dim', type=int, nargs=3, default=[5, 5, 5], metavar=('X', 'Y', 'Z'))
+    parser.add_argument('--kernel', choices=sorted(KERNELS), default='exponential')
+    parser.add_argument('--length', type=float, default=2.0, help="correlation length in voxels")
+    parser.add_argument('--nu', type=float, default=1.5, help="Matern smoothness")
+    parser.add_argument('--count', type=int, default=1)
+    parser.add_argument('--mean', type=float, default=0.1, help="mean scatter density")
+    parser.add_argument('--std', type=float, default=0.03, help="standard deviation of the density")
+    parser.add_argument('--transform', choices=['lognormal', 'normal'], default='lognormal')
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--output', default='input_file',
+                        help="directory for text field files, or a .npy bundle")
+    parser.add_argument('--prefix', default='field')
+    parser.add_argument('--check', action='store_true',
+                        help="compare the empirical covariance with the kernel instead of writing fields")
+    args = parser.parse_args(argv)
+
+    shape = (args.dim[2], args.dim[1], args.dim[0])
+    generator = FieldGenerator(shape, args.kernel, args.length, args.nu, seed=args.seed)
+    if args.check:
+        score, passed = check_covariance(generator, max(args.count, 2000))
+        return 0 if passed else 1
+
+    bundle = None
+    if args.output.endswith('.npy'):
+        bundle = create_bundle(args.output, args.count, shape)
+    written = 0
+    batch = 256
+    while written < args.count:
+        fields = generator.sample(min(batch, args.count - written))
+        densities = to_density(fields, args.mean, args.std, args.transform)
+        if bundle is not None:
+            bundle[written:written + len(fields)] = densities
+        else:
+            write_fields(args.output, densities, args.prefix, start=written)
+        written += len(fields)
+    if bundle is not None:
+        bundle.flush()
+    print("wrote %d fields to %s" % (written, args.output))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,50 @@
 import bpy
-from random import uniform
+from random import uniform, getrandbits, seed
 from mathutils import *
 from math import *
 import os
+import sys
+import argparse
+import shutil
+import tempfile
+import traceback
+from collections import OrderedDict
+import numpy as np
+
+def helper_directories():
+    '''
+    The directory of the helper modules of this script: the one it is
+    in, or, run from Blender's text editor where __file__ is the text
+    block, the one of a text opened from a file or of the open .blend
+    '''
+    yield os.path.dirname(os.path.abspath(__file__))
+    for text in bpy.data.texts:
+        if text.filepath:
+            yield os.path.dirname(bpy.path.abspath(text.filepath))
+    if bpy.data.filepath:
+        yield os.path.dirname(bpy.data.filepath)
+
+# helper modules live next to this script
+for directory in helper_directories():
+    if os.path.exists(os.path.join(directory, 'geometry_builder.py')):
+        sys.path.append(directory)
+        break
+else:
+    raise ImportError("haze_generator_new.py needs the helper modules of its repository "
+                      "(geometry_builder.py, haze_io.py, ...): open it with Text > Open from "
+                      "the repository directory instead of pasting it, or run it with blender -P")
+from geometry_builder import GeometryBatch
+from haze_io import read_field, write_label
+from scene_layout import place_footprints
+from render_cache import RenderCache, scene_hash
+from shard_writer import ShardWriter, pack_round
+from image_writer import ImageWriter, linear_to_srgb, to_uint, write_png
+from transmission import write_round_maps
+from image_pyramid import DEPTH_MODES, check_sizes, write_file_levels, write_levels, write_set_levels
+from metrics import Metrics, NULL_METRICS
+from scene_cleanup import OrphanCollector, datablock_counts
+from compositor import compositor_graph
+import camera_rig
 
 '''
 Blender code for AQI modeling
@@ -16,6 +58,145 @@ Edited by: Linxiao and Zhizhuo
 # Global variable save directory
 SAVE_DIRECTORY = r'\\engin-labs.m.storage.umich.edu\sowone\windat.v2\Desktop\3d' 
 
+#####################################################
+# job settings, all of them can be set from the command line, see main()
+# round k reads INPUT_FILES[k % len(INPUT_FILES)]
+INPUT_FILES = [r'input_file\random_0.06.txt']
+NUM_ROUNDS = 15
+NUM_CAMERAS = 4
+# CAMERA_RIG places the cameras on one "ring" (the original layout),
+# on CAMERA_RINGS staggered "rings" of different heights, or on a
+# Fibonacci "cap" over the scene reaching CAMERA_CAP_ANGLE degrees
+# from straight above. CAMERA_JITTER moves every camera up or down by
+# up to that fraction of the camera height
+CAMERA_RIG = "ring"
+CAMERA_RINGS = 3
+CAMERA_CAP_ANGLE = 75.0
+CAMERA_JITTER = 0.0
+# 0 lets Blender pick the number of render threads
+NUM_THREADS = 0
+
+INPUT_FILE_MODE = True
+
+SCENE_MODE = "moderate" # scene_mode is close, moderate, far, or dense
+
+# haze_mode is cubes (one cube object per voxel) or volume
+# (a single box reading every voxel density from a texture)
+HAZE_MODE = "cubes"
+
+# build objects through bpy.data in one batch instead of bpy.ops
+BATCH_GEOMETRY = True
+
+# keep cameras, ground, lamp and render settings of the previous
+# round and only change densities and buildings
+REUSE_SCENE = True
+
+# render each camera once for both the hazy image and the depth map
+SINGLE_PASS = True
+
+# keep the Cycles scene (BVH, shaders, images) between renders. Every
+# voxel then gets its own material whose density is changed in place
+# between rounds, so only the shaders are updated instead of every
+# voxel being reassigned a material. benchmarks/bench_persistent_data.py
+# compares the time per camera with and without it
+PERSISTENT_DATA = False
+
+# round k seeds the random module with "SEED:k", None for no seeding
+SEED = None
+
+# directory of finished renders keyed by a hash of the scene, so
+# repeated scenes are linked from it instead of rendered (single
+# pass only), None to render everything. At most RENDER_CACHE_SIZE
+# bytes are kept, least recently used renders are deleted first
+RENDER_CACHE = None
+RENDER_CACHE_SIZE = 50 * 2**30
+# change it whenever the scene code changes what a render looks like,
+# so earlier cache entries stop matching
+RENDER_CACHE_VERSION = 1
+
+# Cycles settings used for every render, one of RENDER_PROFILES
+RENDER_PROFILE = "legacy"
+
+# OUTPUT_FORMAT "files" writes the round directories to SAVE_DIRECTORY.
+# "tar" renders each round to ARCHIVE_STAGING on local disk, packs it
+# into tar shards there and copies every shard of ARCHIVE_SHARD_SIZE
+# bytes to SAVE_DIRECTORY as a whole (see shard_writer.py)
+OUTPUT_FORMAT = "files"
+ARCHIVE_STAGING = os.path.join(tempfile.gettempdir(), 'haze_staging')
+ARCHIVE_SHARD_SIZE = 2**30
+
+# take every render out of Blender as an array and encode and write
+# the image and depth map on WRITER_THREADS background threads while
+# the next camera renders, with at most WRITER_QUEUE renders waiting
+# (single pass PNG output only, see image_writer.py)
+ASYNC_WRITE = False
+WRITER_QUEUE = 4
+WRITER_THREADS = 2
+
+# after every round write the exact transmission exp(-tau) of every
+# pixel to transmission_set_* next to the depth maps (transmission.py)
+TRANSMISSION_MAPS = False
+
+# the mist pass saved as depth map is (distance - MIST_START) / MIST_DEPTH,
+# clamped to [0, 1]. Anything closer than MIST_START reads as 0, so its
+# distance is lost; main() sets MIST_START to 0 with TRANSMISSION_MAPS,
+# otherwise Blender's default 5 is kept for depth maps as before.
+# Both are saved in camera.npz
+MIST_START = 5.0
+MIST_DEPTH = 100.0
+
+# also write every view as PYRAMID_SIZES x PYRAMID_SIZES squares cut
+# from the centre of the full resolution render and reduced with numpy,
+# to <round>/pyramid_<size> (image_pyramid.py). A size is at most the
+# shorter side of the render, 540 at the default 960x540. PYRAMID_DEPTH
+# is how the depths a level pixel covers become one, "min" or
+# "nearest". PNG output only
+PYRAMID_SIZES = []
+PYRAMID_DEPTH = "min"
+
+# after every round remove the materials, meshes, camera and lamp
+# data, images and compositor nodes made by the job that nothing uses
+# any more, and print the datablock counts before and after
+# (scene_cleanup.py). Materials of the MaterialCache are kept
+CLEANUP = True
+
+# METRICS_FILE gets one JSON line with the wall and CPU time and the
+# datablock counts of every stage of a round and of every render
+# (metrics.py), None records nothing. With PROFILE_DIRECTORY every
+# round is also run under cProfile and dumped to round<k>.pstats there
+METRICS_FILE = None
+PROFILE_DIRECTORY = None
+# set up by main()
+METRICS = NULL_METRICS
+#####################################################
+
+# Named render settings. None is the value the scene had before the
+# first profile was applied (the Blender default unless the .blend
+# changed it), whichever profile was applied last. legacy is what this
+# script always used. Adaptive sampling only exists from Blender 2.83
+# on, which this 2.7x API script does not run on, so profiles have
+# none. benchmarks/bench_render_profiles.py measures seconds per image
+# and error against reference for each profile
+RENDER_PROFILES = {
+    'legacy': {'samples': None, 'max_bounces': 12, 'transparent_max_bounces': 32,
+               'tile_size': None, 'clamp_indirect': None},
+    'preview': {'samples': 16, 'max_bounces': 4, 'transparent_max_bounces': 8,
+                'tile_size': 64, 'clamp_indirect': 1.0},
+    'train': {'samples': 64, 'max_bounces': 8, 'transparent_max_bounces': 16,
+              'tile_size': 64, 'clamp_indirect': 5.0},
+    'reference': {'samples': 1024, 'max_bounces': 12, 'transparent_max_bounces': 32,
+                  'tile_size': 32, 'clamp_indirect': 0.0},
+}
+# the settings of the scene before apply_render_profile() first ran
+RENDER_DEFAULTS = None
+
+# Voxels whose densities differ by less than MATERIAL_TOLERANCE share
+# one material (1e-6 is the precision of the label files), and at most
+# MATERIAL_CACHE_SIZE materials are kept. Raise the tolerance in random
+# mode, e.g. to 0.001, to get cache hits.
+MATERIAL_TOLERANCE = 1e-6
+MATERIAL_CACHE_SIZE = 256
+
 def delete_all():
     '''
     Delete current objects
@@ -35,18 +216,11 @@ def delete_all():
       bpy.data.meshes.remove(item)
     
     
-def edit_node(file, num_specify=-1):
+def new_volume_material(density):
     '''
-    Edit each cube and specify the parameter
+    Create a Volume Scatter material with the given density
     '''
-    # Save time with variable names.
-    # Set active object to variable
-    activeObject = bpy.context.active_object
-    # Set new material to variable
-    mat = bpy.data.materials.new(name="Material") 
-    # Add the material to the object
-    activeObject.data.materials.append(mat) 
-    mat = bpy.context.object.active_material
+    mat = bpy.data.materials.new(name="Material")
     mat.use_nodes = True
     material_output = mat.node_tree.nodes['Material Output']
     # Delete every node but 'Material Output'
@@ -75,148 +249,473 @@ def edit_node(file, num_specify=-1):
 
     # change the value of volume scatter and absorption
     # volume_abs.inputs[1].default_value = 0 # uniform(0.01, 0.02)
-    picked_num = uniform(0.1, 0.3)
-    if num_specify != -1:
-        picked_num = num_specify
-    volume_scatter.inputs[1].default_value = picked_num
-    file.write("%f " % picked_num)
-    
-def camera_look_at(obj, target, roll=0):
-    """
-    Rotate obj to look at target
+    volume_scatter.inputs[1].default_value = density
+    return mat
 
-    :arg obj: the object to be rotated. Usually the camera
-    :arg target: the location (3-tuple or Vector) to be looked at
-    :arg roll: The angle of rotation about the axis from obj to target in radians. 
+class MaterialCache(object):
+    '''
+    Share one Volume Scatter material between all voxels whose
+    density falls in the same bucket of width tolerance.
+    At most max_size materials are kept, least recently used first out.
+    '''
+    def __init__(self, tolerance=1e-6, max_size=256):
+        self.tolerance = tolerance
+        self.max_size = max_size
+        self.materials = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
 
-    Based on: https://blender.stackexchange.com/a/5220/12947 (ideasman42)     
-    """
-    #if not isinstance(target, mathutils.Vector):
-    if not isinstance(target, Vector):
-        # target = mathutils.Vector(target)
-        target = Vector(target)
-    loc = obj.location
-    # direction points from the object to the target
-    direction = target - loc
+    def get(self, density):
+        '''
+        Return (material, density actually used) for density
+        '''
+        key = int(round(density / self.tolerance))
+        value = key * self.tolerance
+        mat = self.materials.get(key)
+        if mat is not None:
+            try:
+                mat.name
+            except ReferenceError:
+                # removed from bpy.data behind our back
+                mat = None
+        if mat is not None:
+            self.materials.move_to_end(key)
+            self.hits += 1
+            return mat, value
 
-    quat = direction.to_track_quat('-Z', 'Y')
+        self.misses += 1
+        mat = new_volume_material(value)
+        self.materials[key] = mat
+        while len(self.materials) > self.max_size:
+            _, old = self.materials.popitem(last=False)
+            self.evictions += 1
+            # materials still on a voxel of this round are left alone
+            if old.users == 0:
+                bpy.data.materials.remove(old)
+        return mat, value
 
-    # /usr/share/blender/scripts/addons/add_advanced_objects_menu/arrange_on_curve.py
-    quat = quat.to_matrix().to_4x4()
-    # rollMatrix = mathutils.Matrix.Rotation(roll, 4, 'Z')
-    rollMatrix = Matrix.Rotation(roll, 4, 'Z')
+    def report(self):
+        lookups = self.hits + self.misses
+        rate = 100.0 * self.hits / lookups if lookups else 0.0
+        print('Material cache: %d hits / %d lookups (%.1f%%), %d materials, %d evicted'
+              % (self.hits, lookups, rate, len(self.materials), self.evictions))
 
-    # remember the current location, since assigning to obj.matrix_world changes it
-    loc = loc.to_tuple()
-    obj.matrix_world = quat * rollMatrix
-    obj.location = loc
+def voxel_material(num_specify=-1, cache=None):
+    '''
+    Pick the density of one voxel and return its material
+    with the density to record in the label
+    '''
+    picked_num = uniform(0.1, 0.3)
+    if num_specify != -1:
+        picked_num = num_specify
+    if cache is not None:
+        mat, picked_num = cache.get(picked_num)
+    else:
+        # Set new material to variable
+        mat = new_volume_material(picked_num)
+    return mat, picked_num
 
-def generate_camera_view(pathname):
+def edit_node(num_specify=-1, cache=None):
     '''
-    Generate camera rendered views within specified pathname
+    Edit each cube and specify the parameter
+    Return the density used for the label
+    '''
+    # Save time with variable names.
+    # Set active object to variable
+    activeObject = bpy.context.active_object
+    mat, picked_num = voxel_material(num_specify, cache)
+    # Add the material to the object
+    activeObject.data.materials.append(mat) 
+    return picked_num
+    
+def generate_camera_view(pathname, output='rgb', stage='render_image'):
+    '''
+    Generate camera rendered views within specified pathname,
+    output (see compositor.OUTPUTS) being the saved image
     '''
     scene = bpy.context.scene
     #scene.render.layers['RenderLayer'].use_pass_mist = False
     #scene.render.layers['RenderLayer'].use_pass_normal = True
     #scene.render.layers['RenderLayer'].use_pass_combined = True
     #scene.render.layers['RenderLayer'].use_pass_material_index = True
-    tree = bpy.context.scene.node_tree
-    links = tree.links
-    rl = tree.nodes.new(type="CompositorNodeRLayers")
-    composite = tree.nodes.new(type = "CompositorNodeComposite")
-    links.new(rl.outputs['Image'],composite.inputs['Image'])
+    compositor_graph().configure(output)
     for ob in bpy.context.scene.objects:
         if ob.type == 'CAMERA':
             bpy.context.scene.camera = ob
             print('Set camera %s' % ob.name )
             file = os.path.join(pathname, ob.name )
             bpy.context.scene.render.filepath = file
-            bpy.ops.render.render(write_still=True)
+            with METRICS.stage(stage, camera=ob.name):
+                bpy.ops.render.render(write_still=True)
 
 
-def align_camera(output_path, loc=(0, 0, 0)):
+def setup_mist_pass(dist=None, start=None):
     '''
-    Adjust each camera and make them point
-    at the center
+    Turn on the mist pass used as depth map, from MIST_START
+    over MIST_DEPTH units by default
+    '''
+    if dist is None:
+        dist = MIST_DEPTH
+    if start is None:
+        start = MIST_START
+    scene = bpy.context.scene
+    #setup the depthmap calculation using blender's mist function:
+    scene.render.layers['RenderLayer'].use_pass_mist = True
+    #the depthmap can be calculated as the distance between objects and camera ('LINEAR'), 
+    #or square/inverse square of the distance ('QUADRATIC'/'INVERSEQUADRATIC'):
+    scene.world.mist_settings.falloff = 'LINEAR'
+    #minimum depth:
+    scene.world.mist_settings.intensity = 0.0
+    # distances below start all read as 0, the .blend value is not trusted
+    scene.world.mist_settings.start = start
+    #maximum depth (can be changed depending on the scene geometry to normalize the depth 
+    #map whatever the camera orientation and position is):
+    scene.world.mist_settings.depth = dist
+    print(dist)
+
+def png_level(settings):
+    '''
+    zlib level of the PNG compression (0-100) of image settings,
+    mapped the way Blender maps it
+    '''
+    return int(settings.compression / 11.1111)
+
+def viewer_pixels():
     '''
+    Pixels of the compositor Viewer node as a float array
+    of shape (height, width, 4), top row first
     '''
-    camera_path = os.path.join(SAVE_DIRECTORY, 'camera')
-    if not os.path.exists(camera_path):
-        os.makedirs(camera_path)
+    image = bpy.data.images['Viewer Node']
+    width, height = image.size
+    if hasattr(image.pixels, 'foreach_get'):
+        pixels = np.empty(width * height * 4, dtype=np.float32)
+        image.pixels.foreach_get(pixels)
+    else:
+        pixels = np.array(image.pixels[:], dtype=np.float32)
+    return pixels.reshape(height, width, 4)[::-1]
+
+def plain_srgb(scene):
     '''
-              
+    Whether the scene saves images with the plain sRGB transform
+    write_view() applies: no view transform, look, exposure, gamma
+    or curves on an sRGB display
+    '''
+    view = scene.view_settings
+    return (scene.display_settings.display_device == 'sRGB'
+            and view.view_transform in ('Default', 'Standard') and view.look == 'None'
+            and view.exposure == 0 and view.gamma == 1 and not view.use_curve_mapping)
+
+def write_view(pixels, image_path, depth_path, color_mode, bit_depth, level, cache=None, key=None,
+               sizes=(), depth_mode="min"):
+    '''
+    ImageWriter job: save the colour of pixels as the hazy image and
+    its alpha, the mist pass, as the depth map, with the sRGB view
+    transform and colour mode Blender would save them with, and their
+    square pyramid levels of sides sizes
+    '''
+    srgb = linear_to_srgb(pixels)
+    color = srgb[:, :, :3]
+    depth = srgb[:, :, 3:]
+    if color_mode == 'BW':
+        color = np.dot(color, [0.2126, 0.7152, 0.0722])[:, :, np.newaxis]
+    else:
+        depth = np.repeat(depth, 3, axis=2)
+    if color_mode == 'RGBA':
+        opaque = np.ones(depth.shape[:2] + (1,))
+        color = np.concatenate([color, opaque], axis=2)
+        depth = np.concatenate([depth, opaque], axis=2)
+    color = to_uint(color, bit_depth)
+    depth = to_uint(depth, bit_depth)
+    written = write_png(image_path, color, level)
+    written += write_png(depth_path, depth, level)
+    if sizes:
+        written += write_levels(color, depth, image_path, depth_path, sizes, depth_mode, level)
+    if key is not None:
+        cache.store(key, {'image': image_path, 'depth': depth_path})
+    return written
+
+def generate_camera_views(pathname, depthpath, description=None, cache=None, writer=None):
+    '''
+    Render every camera once. The Composite output is saved as
+    the hazy image in pathname, and a File Output node fed by
+    the mist pass writes the depth map of the same render to
+    depthpath under the same file name.
+    With a RenderCache, cameras whose scene description (see
+    scene_description()) was rendered before are linked from it.
+    With an ImageWriter, a Viewer node gets the image and the mist
+    pass and the writer saves both while the next camera renders.
+    Every view also gets the pyramid levels of PYRAMID_SIZES
+    '''
+    scene = bpy.context.scene
+    setup_mist_pass()
+    settings = scene.render.image_settings
+    sizes = PYRAMID_SIZES
+    if settings.file_format != 'PNG':
+        # image_writer.py only encodes PNG
+        writer = None
+        sizes = []
+    if writer is not None and not plain_srgb(scene):
+        # write_view() knows only the plain sRGB transform
+        print('Colour management of the scene is not plain sRGB, saving with Blender')
+        writer = None
+    level = png_level(settings)
+
+    graph = compositor_graph()
+    if writer is None:
+        # the Depth Output node saves the mist pass in the file
+        # format of the Composite output
+        depth_output = graph.configure('rgb', files={'depth': depthpath})['depth']
+    else:
+        graph.configure('rgb', viewer=('rgb', 'depth'))
+    if not os.path.exists(depthpath):
+        os.makedirs(depthpath)
+
+    for ob in scene.objects:
+        if ob.type == 'CAMERA':
+            image = os.path.join(pathname, ob.name + scene.render.file_extension)
+            target = os.path.join(depthpath, ob.name + scene.render.file_extension)
+            key = None
+            if cache is not None:
+                camera = {'location': list(ob.location), 'rotation': list(ob.rotation_euler),
+                          'lens': ob.data.lens, 'sensor_width': ob.data.sensor_width}
+                key = scene_hash(dict(description, camera=camera))
+                if cache.fetch(key, {'image': image, 'depth': target}):
+                    print('Camera %s found in the render cache' % ob.name)
+                    METRICS.event('render_cache_hit', camera=ob.name)
+                    if sizes:
+                        with METRICS.stage('pyramid', camera=ob.name):
+                            write_file_levels(image, target, sizes, PYRAMID_DEPTH, level)
+                    continue
+                # earlier outputs may be links into the cache
+                if os.path.exists(image):
+                    os.remove(image)
+            scene.camera = ob
+            print('Set camera %s' % ob.name )
+            if writer is not None:
+                with METRICS.stage('render', camera=ob.name):
+                    bpy.ops.render.render()
+                for path in (image, target):
+                    if os.path.exists(path):
+                        os.remove(path)
+                writer.submit(write_view, viewer_pixels(), image, target, settings.color_mode,
+                              int(settings.color_depth), level, cache, key, sizes, PYRAMID_DEPTH)
+                continue
+            scene.render.filepath = os.path.join(pathname, ob.name )
+            # File Output always appends the frame number, so the
+            # depth map is renamed to match the legacy layout
+            depth_output.file_slots[0].path = ob.name + "_####"
+            with METRICS.stage('render', camera=ob.name):
+                bpy.ops.render.render(write_still=True)
+            written = os.path.join(depthpath, "%s_%04d%s" % (ob.name, scene.frame_current, scene.render.file_extension))
+            if os.path.exists(target):
+                os.remove(target)
+            os.rename(written, target)
+            if key is not None:
+                cache.store(key, {'image': image, 'depth': target})
+            if sizes:
+                with METRICS.stage('pyramid', camera=ob.name):
+                    write_file_levels(image, target, sizes, PYRAMID_DEPTH, level)
+    if writer is not None:
+        writer.wait()
+        writer.report()
+
+def render_profile_values():
+    '''
+    The settings of the scene a render profile sets
+    '''
+    scene = bpy.context.scene
+    cycles = scene.cycles
+    return {'samples': cycles.samples, 'max_bounces': cycles.max_bounces,
+            'transparent_max_bounces': cycles.transparent_max_bounces,
+            'tile_size': scene.render.tile_x, 'clamp_indirect': cycles.sample_clamp_indirect}
+
+def apply_render_profile(name):
+    '''
+    Set the Cycles settings of RENDER_PROFILES[name]. Every setting is
+    set, the ones the profile leaves None to RENDER_DEFAULTS, so no
+    value of a profile applied before is kept
+    '''
+    global RENDER_DEFAULTS
+    if RENDER_DEFAULTS is None:
+        RENDER_DEFAULTS = render_profile_values()
+    profile = dict(RENDER_DEFAULTS)
+    profile.update((key, value) for key, value in RENDER_PROFILES[name].items() if value is not None)
+    scene = bpy.context.scene
+    cycles = scene.cycles
+    cycles.samples = profile['samples']
+    cycles.max_bounces = profile['max_bounces']
+    cycles.transparent_max_bounces = profile['transparent_max_bounces']
+    scene.render.tile_x = profile['tile_size']
+    scene.render.tile_y = profile['tile_size']
+    cycles.sample_clamp_indirect = profile['clamp_indirect']
+
+def render_settings():
+    '''
+    The render settings that change the pixels of a render
+    '''
+    scene = bpy.context.scene
+    settings = scene.render.image_settings
+    mist = scene.world.mist_settings
+    return {
+        'engine': scene.render.engine,
+        'resolution': [scene.render.resolution_x, scene.render.resolution_y,
+                       scene.render.resolution_percentage],
+        'format': [settings.file_format, settings.color_mode, settings.color_depth],
+        'samples': scene.cycles.samples,
+        'seed': scene.cycles.seed,
+        'max_bounces': scene.cycles.max_bounces,
+        'transparent_max_bounces': scene.cycles.transparent_max_bounces,
+        'profile': render_profile_values(),
+        'mist': [mist.falloff, mist.start, mist.depth, mist.intensity],
+        'sky': [scene.world.use_sky_paper, list(scene.world.horizon_color)],
+    }
+
+def scene_description(labels, rig, round_seed=None):
+    '''
+    Describe everything but the camera that decides the rendered
+    pixels: densities, buildings, render settings and seed.
+    generate_camera_views() adds the camera pose and hashes it
+    '''
+    buildings = []
+    for obj, _, _ in rig['buildings']:
+        buildings.append([list(obj.location), list(obj.scale),
+                          list(obj.active_material.diffuse_color), obj.hide_render])
+    return {
+        'version': RENDER_CACHE_VERSION,
+        'haze_mode': HAZE_MODE,
+        'density': np.asarray(labels, dtype=float),
+        'buildings': buildings,
+        'render': render_settings(),
+        'seed': round_seed,
+    }
+
+def align_camera(output_path, loc=(0, 0, 0)):
+    '''
+    Adjust each camera and make them point
+    at the center. Write camera.txt and camera.npz with
+    K, R and t of every camera (see camera_rig.export_rig())
+    Return the camera poses for the label file
+    '''
+    scene = bpy.context.scene
+    cams = [item for item in bpy.data.objects if item.type == "CAMERA"]
+    cam_list = [cam.name for cam in cams]
+    positions = np.array([list(cam.location) for cam in cams]).reshape(-1, 3)
+    rotations = camera_rig.look_at(positions, loc)
+    for cam, angles in zip(cams, camera_rig.rotation_to_euler(rotations)):
+        cam.rotation_mode = 'XYZ'
+        cam.rotation_euler = angles
+    matrix_world = camera_rig.pose_matrices(positions, rotations)
+
     filepath = os.path.join(output_path, 'camera.txt')
     f = open(filepath, "w+")
-    # f.write("%d\n%d\n%d\n" % (dim[0], dim[1], dim[2]))
     f.write("Camera look at\n %f %f %f\n" % (loc[0], loc[1], loc[2]))
-    cam_list = [item.name for item in bpy.data.objects if item.type == "CAMERA"]
-    for name in cam_list: 
-        cam = bpy.data.objects[name]
+    for cam in cams:
         f.write("Camera name: %s\n" % (cam))
         f.write("Camera locate at\n %f %f %f\n" % (cam.location[0], cam.location[1], cam.location[2]))
-        camera_look_at(cam, loc)
     f.close()
-       
-       
-def create_camera(radius, z_axis, num = 2, angle = 90):
+
+    scale = scene.render.resolution_percentage / 100.0
+    size = (int(scene.render.resolution_x * scale), int(scene.render.resolution_y * scale))
+    K = [camera_rig.intrinsics(size[0], size[1], cam.data.lens, cam.data.sensor_width,
+                               cam.data.sensor_height, cam.data.sensor_fit) for cam in cams]
+    camera_rig.export_rig(os.path.join(output_path, 'camera.npz'), cam_list, matrix_world, K, size,
+                          mist=(MIST_START, MIST_DEPTH))
+    return {'names': cam_list, 'look_at': loc, 'matrix_world': matrix_world,
+            'location': positions}
+
+def create_camera_rig(radius, height, target, batch=None):
     '''
-    this function is used to create num cameras with 
-    angle to each other 
+    Create NUM_CAMERAS cameras laid out as CAMERA_RIG says, all
+    looking at target. radius is the ring radius or, for the cap,
+    the distance from target
+    if batch (a GeometryBatch) is given the cameras are
+    added to it instead of going through bpy.ops
     '''
-    # trans = radians(angle)
-    
-    # print(trans)
-    for i in range(num):
-        #i = num
-        x = radius * sin(radians(45 + i * angle))
-        y = radius * cos(radians(45 + i * angle))
-        # print(x)
-        # print(y)
-        bpy.ops.object.camera_add(view_align=False, location=[x,y, z_axis])
-        
-    # f.close() 
+    if CAMERA_RIG == "rings":
+        counts = [len(part) for part in np.array_split(np.arange(NUM_CAMERAS), CAMERA_RINGS)]
+        heights = height * np.linspace(0.5, 1.5, CAMERA_RINGS)
+        positions = camera_rig.rings([radius] * CAMERA_RINGS, heights, counts)
+    elif CAMERA_RIG == "cap":
+        positions = camera_rig.fibonacci_cap(NUM_CAMERAS, radius, target, CAMERA_CAP_ANGLE)
+    else:
+        positions = camera_rig.ring(radius, height, NUM_CAMERAS)
+    if CAMERA_JITTER > 0:
+        rng = np.random.RandomState(getrandbits(32))
+        positions = camera_rig.jitter_heights(positions, CAMERA_JITTER * height, rng, floor=0.1)
+    rotations = camera_rig.rotation_to_euler(camera_rig.look_at(positions, target))
+    if batch is not None:
+        batch.cameras(positions.tolist(), rotations.tolist())
+        return
+    for loc, rotation in zip(positions.tolist(), rotations.tolist()):
+        bpy.ops.object.camera_add(view_align=False, location=loc, rotation=rotation)
 
-def is_overlap(building_list, cur_loc, r):
-    if len(building_list) == 0:
-        return False
-    
-    for building in building_list:
-        distance = (building[0] - cur_loc[0]) **2 + (building[1] - cur_loc[1]) **2
-        if distance <= 4 * (r **2):
-            return True
-    return False
-
-def create_scene(constrain_r, constrain_h, num=3):
-    #x_loc = 0
-    #y_loc = 0 
+def building_material():
+    mat = bpy.data.materials.new(name="Building") #set new material to variable
+    mat.diffuse_color = (uniform(0, 1), uniform(0, 1), uniform(0, 1)) #change color
+    return mat
+
+def place_buildings(constrain_r, constrain_h, num=3):
+    '''
+    Pick num non overlapping buildings inside a circle of radius
+    constrain_r, returned as (x, y, radius, half height).
+    Fewer are returned when num of them do not fit
+    '''
     # use polar coordinate
-    building = []
-    # each_angle = radians(360 / num)
-    
-    #max_r = sin * cons / (1 + sin)
-    # max_r = sin(each_angle / 2) * constrain_r / (1 + sin(each_angle / 2)) # max radius for cylinder
     # max_r = constrain_r / 3 # cylinder radius
     r = constrain_r / (1.5 * num * 2)
-    max_r = constrain_r - r
-    # min_cons = r / sin(each_angle / 2)
-    # building_create = 0
-    while len(building) < num:
-        print('Still generating scene...')
-        loc_r = uniform(0, max_r)
-        theta = uniform(0, 360)
-        x_loc = loc_r * cos(radians(theta))
-        y_loc = loc_r * sin(radians(theta))
-        radius = uniform(0.8*r, 1.2*r)
-        if is_overlap(building, (x_loc, y_loc), radius):
-            continue
-        loc = (x_loc, y_loc)
-        building.append(loc)
+    # Poisson-disk sampling on a hash grid (scene_layout.py), seeded
+    # from random so that seeding it reproduces the scene
+    layout = place_footprints(constrain_r, num, 0.8 * r, 1.2 * r, seed=getrandbits(32))
+    if not layout.complete:
+        print('Only %d of %d buildings fit in radius %f' % (len(layout.footprints), num, constrain_r))
+    placements = []
+    for x_loc, y_loc, radius in layout.footprints:
         depth = uniform(0.2 * constrain_h, 0.7 * constrain_h) / 2
-        bpy.ops.mesh.primitive_cylinder_add(radius= radius, depth=depth*2, location=(x_loc,y_loc,depth))
-        activeObject = bpy.context.active_object
-        mat = bpy.data.materials.new(name="Building") #set new material to variable
-        activeObject.data.materials.append(mat) #add the material to the object
-        bpy.context.object.active_material.diffuse_color = (uniform(0, 1), uniform(0, 1), uniform(0, 1)) #change color    
+        placements.append((x_loc, y_loc, radius, depth))
+    return placements
+
+def create_scene(constrain_r, constrain_h, num=3, batch=None):
+    '''
+    Create num random buildings. Return them as a list of
+    (object, mesh radius, mesh half height) for update_scene()
+    '''
+    placements = place_buildings(constrain_r, constrain_h, num)
+    placed = len(placements)
+    # buildings that do not fit are made too and left out of the render,
+    # so update_scene() keeps placing num of them at the same size
+    spare = (0.0, 0.0, constrain_r / (1.5 * num * 2), constrain_h / 4.0)
+    placements += [spare] * (num - placed)
+    buildings = []
+    for k, (x_loc, y_loc, radius, depth) in enumerate(placements):
+        if batch is not None:
+            # unit cylinder sized by the object scale
+            obj = batch.cylinders([(x_loc, y_loc, depth)], [radius], [depth * 2], [building_material()])[0]
+            buildings.append((obj, 1, 1))
+        else:
+            bpy.ops.mesh.primitive_cylinder_add(radius= radius, depth=depth*2, location=(x_loc,y_loc,depth))
+            obj = bpy.context.active_object
+            obj.data.materials.append(building_material()) #add the material to the object
+            buildings.append((obj, radius, depth))
+        obj.hide_render = k >= placed
+    return buildings
+
+def update_scene(buildings, constrain_r, constrain_h):
+    '''
+    Move, resize and recolour the buildings made by create_scene()
+    as if create_scene() had been called again
+    '''
+    # create_scene() makes all num buildings, even when fewer fitted
+    placements = place_buildings(constrain_r, constrain_h, len(buildings))
+    # buildings that did not fit this time are left out of the render
+    for obj, base_radius, base_depth in buildings[len(placements):]:
+        obj.hide_render = True
+    for (obj, base_radius, base_depth), (x_loc, y_loc, radius, depth) in zip(buildings, placements):
+        obj.hide_render = False
+        obj.location = (x_loc, y_loc, depth)
+        obj.scale = (radius / base_radius, radius / base_radius, depth / base_depth)
+        obj.active_material.diffuse_color = (uniform(0, 1), uniform(0, 1), uniform(0, 1))
+
     '''
     if scene_mode == "moderate":
         y_loc = rad
@@ -247,27 +746,210 @@ def create_scene(constrain_r, constrain_h, num=3):
                 mat = bpy.data.materials.new(name="Building") #set new material to variable
                 activeObject.data.materials.append(mat) #add the material to the object
                 bpy.context.object.active_material.diffuse_color = (uniform(0, 1), uniform(0, 1), uniform(0, 1)) #change color    
-     '''   
-def run(haze_input_file, round):
+     '''
+
+def random_haze_grid(dim, low=0.1, high=0.3):
+    '''
+    Uncorrelated random densities for dim[0] * dim[1] * dim[2] voxels,
+    indexed [z, y, x]
+    '''
+    values = [uniform(low, high) for _ in range(dim[0] * dim[1] * dim[2])]
+    return np.array(values).reshape(dim[2], dim[1], dim[0])
+
+def set_haze_volume_density(image, grid):
+    '''
+    Write grid into the density image of create_haze_volume()
+    '''
+    nz, ny, nx = grid.shape
+    # density atlas: pixel (row y, column z * nx + x) holds grid[z, y, x]
+    atlas = grid.transpose(1, 0, 2).reshape(ny, nz * nx)
+    pixels = np.ones((ny, nz * nx, 4))
+    pixels[:, :, 0] = atlas
+    pixels[:, :, 1] = atlas
+    pixels[:, :, 2] = atlas
+    image.pixels[:] = pixels.ravel().tolist()
+
+def set_voxel_densities(voxels, grid):
+    '''
+    Change the density of the own material of every cube in place
+    (PERSISTENT_DATA), return the densities used
+    '''
+    for voxel, density in zip(voxels, grid.ravel()):
+        material = voxel.material_slots[0].material
+        material.node_tree.nodes['Volume Scatter'].inputs[1].default_value = density
+    return grid
+
+def assign_voxel_materials(voxels, grid, cache):
+    '''
+    Give every cube, in [z, y, x] order, the material of its density
+    from cache (a new one of its own without a cache) and return the
+    densities used, like edit_node() does. Each material goes on its
+    cube as soon as it is made: the cache only removes evicted
+    materials without users, so one made for a cube that does not
+    hold it yet would be removed from bpy.data
+    '''
+    labels = np.zeros(grid.shape)
+    used = labels.reshape(-1)
+    for k, (voxel, density) in enumerate(zip(voxels, grid.ravel())):
+        mat, used[k] = voxel_material(density, cache)
+        voxel.material_slots[0].material = mat
+    return labels
+
+def update_voxels(voxels, grid, cache):
+    '''
+    Give the cubes of an earlier round the densities of grid
+    and return the densities used
+    '''
+    if cache is None:
+        return set_voxel_densities(voxels, grid)
+    return assign_voxel_materials(voxels, grid, cache)
+
+def create_haze_volume(grid, rad):
+    '''
+    Build one box covering the whole voxel grid. Its Volume Scatter
+    density is looked up per voxel from a float image holding the
+    z layers side by side, so the number of objects and nodes stays
+    the same however large the grid is.
+    '''
+    nz, ny, nx = grid.shape
+    bpy.ops.mesh.primitive_cube_add(radius=1, location=(0, 0, nz * rad))
+    activeObject = bpy.context.active_object
+    activeObject.name = "HazeVolume"
+    activeObject.scale = (nx * rad, ny * rad, nz * rad)
+
+    image = bpy.data.images.new("HazeDensity", width=nz * nx, height=ny, alpha=True, float_buffer=True)
+    image.colorspace_settings.name = 'Non-Color'
+    set_haze_volume_density(image, grid)
+
+    mat = bpy.data.materials.new(name="HazeVolume")
+    activeObject.data.materials.append(mat)
+    mat.use_nodes = True
+    nodes = mat.node_tree.nodes
+    links = mat.node_tree.links
+    material_output = nodes['Material Output']
+    for k in nodes.keys():
+        if k != 'Material Output':
+            nodes.remove(nodes[k])
+    x, y = material_output.location
+
+    def math_node(operation, value, location):
+        node = nodes.new('ShaderNodeMath')
+        node.operation = operation
+        node.inputs[1].default_value = value
+        node.location = location
+        return node
+
+    tex_coord = nodes.new('ShaderNodeTexCoord')
+    tex_coord.location = (x - 1500, y)
+    separate = nodes.new('ShaderNodeSeparateXYZ')
+    separate.location = (x - 1350, y)
+    links.new(tex_coord.outputs['Generated'], separate.inputs[0])
+
+    # z layer index = min(floor(z * nz), nz - 1), floor(a) being round(a - 0.5)
+    z_scaled = math_node('MULTIPLY', nz, (x - 1200, y))
+    z_shift = math_node('SUBTRACT', 0.5, (x - 1050, y))
+    z_floor = math_node('ROUND', 0, (x - 900, y))
+    z_index = math_node('MINIMUM', nz - 1, (x - 750, y))
+    links.new(separate.outputs['Z'], z_scaled.inputs[0])
+    links.new(z_scaled.outputs[0], z_shift.inputs[0])
+    links.new(z_shift.outputs[0], z_floor.inputs[0])
+    links.new(z_floor.outputs[0], z_index.inputs[0])
+
+    # u = (z layer + x) / nz, keeping x inside its own layer
+    x_clamp = math_node('MINIMUM', 1 - 0.5 / nx, (x - 750, y - 200))
+    u_sum = math_node('ADD', 0, (x - 600, y))
+    u = math_node('DIVIDE', nz, (x - 450, y))
+    links.new(separate.outputs['X'], x_clamp.inputs[0])
+    links.new(z_index.outputs[0], u_sum.inputs[0])
+    links.new(x_clamp.outputs[0], u_sum.inputs[1])
+    links.new(u_sum.outputs[0], u.inputs[0])
+
+    combine = nodes.new('ShaderNodeCombineXYZ')
+    combine.location = (x - 300, y)
+    links.new(u.outputs[0], combine.inputs['X'])
+    links.new(separate.outputs['Y'], combine.inputs['Y'])
+
+    density = nodes.new('ShaderNodeTexImage')
+    density.location = (x - 150, y - 200)
+    density.image = image
+    density.interpolation = 'Closest'
+    density.extension = 'EXTEND'
+    links.new(combine.outputs[0], density.inputs['Vector'])
+
+    volume_scatter = nodes.new('ShaderNodeVolumeScatter')
+    volume_scatter.location = (x - 150, y)
+    # the atlas stores the density in r, g and b alike, so the
+    # colour to float conversion gives the density back unchanged
+    links.new(density.outputs['Color'], volume_scatter.inputs['Density'])
+    links.new(volume_scatter.outputs[0], material_output.inputs['Volume'])
+    return activeObject, image
+
+def build_rig(dim, batch):
+    '''
+    Build the static part of the scene: cameras, ground,
+    sun lamp, sky and render settings. Later rounds with the
+    same grid size reuse it and only change voxels and buildings
+    '''
+    ground_rad = dim[0]/2
+    camera_height = dim[2] / 3
+    # NUM_CAMERAS cameras around the scene, looking at its center
+    create_camera_rig(ground_rad*1.414213, camera_height, (0, 0, camera_height * 0.5), batch=batch)
+
+    mat = bpy.data.materials.new(name="Ground") #set new material to variable
+    mat.diffuse_color = (.2, .2, .2) #change color
+    if batch is not None:
+        batch.plane(ground_rad, (0,0,-0.001), mat)  # ground
+    else:
+        bpy.ops.mesh.primitive_plane_add(radius=ground_rad, location=(0,0,-0.001))  # ground
+        activeObject = bpy.context.active_object
+        activeObject.data.materials.append(mat) #add the material to the object
+
+    # add light
+    scene = bpy.context.scene
+    lamp_data = bpy.data.lamps.new(name="New Lamp", type='SUN')
+    lamp_object = bpy.data.objects.new(name="New Lamp", object_data=lamp_data)
+    scene.objects.link(lamp_object)
+    lamp_object.location = (10.0, 10.0, 10.0)
+    lamp_object.select = True
+    scene.objects.active = lamp_object
+    lamp = scene.objects.active
+    lamp.data.use_nodes = True
+    lamp.data.node_tree.nodes['Emission'].inputs['Strength'].default_value = 5
+
+    scene.render.engine = "CYCLES" # use cycle render
+    scene.render.use_persistent_data = PERSISTENT_DATA
+    apply_render_profile(RENDER_PROFILE)
+    ### USE SKY
+    scene.world.use_sky_paper = True
+    # before any render or scene description
+    setup_mist_pass()
+    compositor_graph().configure('rgb')
+    return {'ground_rad': ground_rad, 'camera_height': camera_height}
+
+def run(haze_input_file, round, material_cache=None, rig=None, render_cache=None, writer=None):
     '''
     Create pollution cubes and general actions
+    Pass the same material_cache to every round to keep
+    sharing voxel materials between rounds, and the rig
+    returned by the previous round to reuse its scene
     '''
-    delete_all()
-    bpy.context.scene.render.engine = "CYCLES" # use cycle render
     PATH_PREFIX = str(round)
-    os.mkdir(PATH_PREFIX)
+    round_seed = None
+    if SEED is not None:
+        round_seed = "%d:%d" % (SEED, round)
+        seed(round_seed)
     
     #####################################################
-    # tunable parameters
-    input_file_mode = True
-    
-    scene_mode = "moderate" # scene_mode is close, moderate, far, or dense
-    
+    # tunable parameters (the job wide ones are at the top of the file)
     '''
     The first three lines specify x dim, y dim and z dim
     and the following lines specifies each x
     '''
-    save_directory = os.path.join(SAVE_DIRECTORY, PATH_PREFIX)
+    output_root = SAVE_DIRECTORY
+    if OUTPUT_FORMAT == "tar":
+        # main() packs the staged round into a shard
+        output_root = ARCHIVE_STAGING
+    save_directory = os.path.join(output_root, PATH_PREFIX)
     # half length for each cube
     rad = 0.5
     r = rad - 0.0001 
@@ -275,163 +957,368 @@ def run(haze_input_file, round):
     dim = [1, 1, 1] 
     ###################################################
     # no need to modify when use
-    inFile = None
-    input_list = []
-    if input_file_mode:
+    if INPUT_FILE_MODE:
         f_path = os.path.join(SAVE_DIRECTORY, haze_input_file)
         # print(f_path)
-        inFile = open(f_path , 'r')
-        input_list = inFile.readlines()
-        # print(input_list)
-        dim[0] = int(input_list.pop(0)) # x
-        dim[1] = int(input_list.pop(0)) # y
-        dim[2] = int(input_list.pop(0)) # z
+        # a .npy bundle without "#k" gives round k its field k
+        grid = read_field(f_path, round)
+        dim = [grid.shape[2], grid.shape[1], grid.shape[0]]
         # print(dim)
-        ground_rad = dim[0] / 2
-        inFile.close()
+    else:
+        grid = random_haze_grid(dim)
+    if material_cache is None:
+        material_cache = MaterialCache(MATERIAL_TOLERANCE, MATERIAL_CACHE_SIZE)
+    if PERSISTENT_DATA:
+        # every voxel keeps its own material, see set_voxel_densities()
+        material_cache = None
     ####################################################
-    ground_rad = dim[0]/2
+    if not os.path.exists(save_directory):
+        os.makedirs(save_directory)
+    batch = GeometryBatch() if BATCH_GEOMETRY else None
+    key = (tuple(dim), HAZE_MODE, BATCH_GEOMETRY, PERSISTENT_DATA)
+    if not REUSE_SCENE or rig is None or rig['key'] != key:
+        with METRICS.stage('delete_all'):
+            delete_all()
+        with METRICS.stage('build_rig'):
+            rig = build_rig(dim, batch)
+        rig['key'] = key
+    ground_rad = rig['ground_rad']
+    camera_height = rig['camera_height']
         
     # number of image set to create
     num_image_set = 1
-    # add 2 cameras with 45 degree of distance to each other
-    camera_height = dim[2] / 3
-    create_camera(ground_rad*1.414213 , camera_height, 4) 
     # make all camera look at (0, 0, dim[2] // 2)
-    align_camera(save_directory, (0, 0,  camera_height * 0.5))  
+    with METRICS.stage('align_camera'):
+        cameras = align_camera(save_directory, (0, 0,  camera_height * 0.5))  
     # end of tunable parameter
     ####################################################
     x = (1-dim[0])*rad
     y = (1-dim[1])*rad
     z = rad # starting point
     
-    ### USE SKY
-    bpy.context.scene.world.use_sky_paper = True    
     for i in range(num_image_set):
         
-        dir = "image_set_" + scene_mode + str(i)
-        file_name = 'label' + str(i) +'.txt'
+        dir = "image_set_" + SCENE_MODE + str(i)
         pathname = os.path.join(save_directory, dir)
         # print(pathname)
         if not os.path.exists(pathname):
             os.makedirs(pathname)
-        filepath = os.path.join(pathname, file_name)
-        f = open(filepath, "w+")
-        f.write("%d\n%d\n%d\n" % (dim[0], dim[1], dim[2]))
         
-        # create cubes
-        if input_file_mode: # if specify input
-            iter = 0;
-            for z_step in range(0, dim[2]):
-                # f.write("Layer %d:\n" % z_step)
-                for y_step in range(0, dim[1]):
-                    line = input_list[iter]
-                    iter += 1
-                    num_list = line.split(" ")
-                    for x_step, num in zip(range(0, dim[0]), num_list):
-                        # print(num)
-                        add_x = x_step*rad*2
-                        add_y = y_step*rad*2
-                        add_z = z_step*rad*2
-                        loc = (x+add_x,y+add_y,z+add_z)
-                        bpy.ops.mesh.primitive_cube_add(radius=r, location=loc)
-                        edit_node(f, num_specify=float(num))
-                    f.write("\n")         
-        else:
-            for z_step in range(0, dim[2]):
-                # f.write("Layer %d:\n" % z_step)
-                for y_step in range(-1 * dim[1] // 2, dim[1] // 2):
-                    for x_step in range(-1 * dim[0] // 2, dim[0] // 2):
-                        add_x = x_step*rad*2
-                        add_y = y_step*rad*2
-                        add_z = z_step*rad*2
-                        loc = (x+add_x,y+add_y,z+add_z)
-                        bpy.ops.mesh.primitive_cube_add(radius=r, location=loc)
-                        edit_node(f)
-                    f.write("\n")
+        # create cubes, or give the existing ones new densities;
+        # labels holds the density each voxel is rendered with
+        with METRICS.stage('cubes', haze_mode=HAZE_MODE, voxels=grid.size):
+            if 'volume' in rig:
+                set_haze_volume_density(rig['volume'], grid)
+                labels = grid
+            elif 'voxels' in rig:
+                labels = update_voxels(rig['voxels'], grid, material_cache)
+            elif HAZE_MODE == "volume":
+                _, rig['volume'] = create_haze_volume(grid, rad)
+                labels = grid
+            elif batch is not None:
+                locations = []
+                for z_step in range(0, dim[2]):
+                    for y_step in range(0, dim[1]):
+                        for x_step in range(0, dim[0]):
+                            locations.append((x+x_step*rad*2, y+y_step*rad*2, z+z_step*rad*2))
+                # the cubes exist before their materials, see assign_voxel_materials()
+                rig['voxels'] = batch.cubes(locations, r)
+                labels = assign_voxel_materials(rig['voxels'], grid, material_cache)
+            else:
+                labels = np.zeros(grid.shape)
+                rig['voxels'] = []
+                for z_step in range(0, dim[2]):
+                    # f.write("Layer %d:\n" % z_step)
+                    for y_step in range(0, dim[1]):
+                        for x_step in range(0, dim[0]):
+                            add_x = x_step*rad*2
+                            add_y = y_step*rad*2
+                            add_z = z_step*rad*2
+                            loc = (x+add_x,y+add_y,z+add_z)
+                            bpy.ops.mesh.primitive_cube_add(radius=r, location=loc)
+                            labels[z_step, y_step, x_step] = edit_node(num_specify=grid[z_step, y_step, x_step], cache=material_cache)
+                            rig['voxels'].append(bpy.context.active_object)
                 
-        f.close()
-        
-        
-        bpy.ops.mesh.primitive_plane_add(radius=ground_rad, location=(0,0,-0.001))  # ground
-        activeObject = bpy.context.active_object
-        mat = bpy.data.materials.new(name="Ground") #set new material to variable
-        activeObject.data.materials.append(mat) #add the material to the object
-        bpy.context.object.active_material.diffuse_color = (.2, .2, .2) #change color
+        # label<i>.txt in the usual layout plus label<i>.npy with the cameras
+        with METRICS.stage('write_label'):
+            write_label(pathname, i, labels, cameras)
+        if HAZE_MODE != "volume" and material_cache is not None:
+            material_cache.report()
     
         '''
         Generate Depth Map with Buildings
         '''
         # create buildings
         # create_scene(dim=dim, rad=rad, scene_mode=scene_mode)
-        create_scene(ground_rad * 0.7, camera_height, num=6)
-        # add light
-        scene = bpy.context.scene
-        lamp_data = bpy.data.lamps.new(name="New Lamp", type='SUN')
-        lamp_object = bpy.data.objects.new(name="New Lamp", object_data=lamp_data)
-        scene.objects.link(lamp_object)
-        lamp_object.location = (10.0, 10.0, 10.0)
-        lamp_object.select = True
-        scene.objects.active = lamp_object
-        lamp = scene.objects.active
-        lamp.data.use_nodes = True
-        lamp.data.node_tree.nodes['Emission'].inputs['Strength'].default_value = 5
-        
-        bpy.context.scene.cycles.transparent_max_bounces = 32 # 8 #64
-        bpy.context.scene.cycles.max_bounces = 12 # 4 #25
-        
-        # Generate normal views 
-        generate_camera_view(pathname)
-        
+        with METRICS.stage('buildings'):
+            if 'buildings' in rig:
+                update_scene(rig['buildings'], ground_rad * 0.7, camera_height)
+            else:
+                rig['buildings'] = create_scene(ground_rad * 0.7, camera_height, num=6, batch=batch)
+            if batch is not None:
+                batch.link()
         
         ##
         # EXPERIMENTAL
         DEPTH_NEEDED = True
+        depthpath = os.path.join(save_directory, "depth_set_" + SCENE_MODE + str(i))
+        if DEPTH_NEEDED and SINGLE_PASS:
+            # one render per camera writes both the image and the depth map
+            description = None
+            if render_cache is not None:
+                description = scene_description(labels, rig, round_seed)
+            generate_camera_views(pathname, depthpath, description, render_cache, writer)
+            if render_cache is not None:
+                render_cache.report()
+            continue
+
+        # Generate normal views 
+        generate_camera_view(pathname)
+        
         if DEPTH_NEEDED:
-            bpy.context.scene.use_nodes = True
-            tree = bpy.context.scene.node_tree
-            links = tree.links
-            
-            scene = bpy.context.scene
-            scene.render.use_multiview = True
-            scene.render.views_format = 'STEREO_3D'
-            
-            rl = tree.nodes.new(type="CompositorNodeRLayers")
-            composite = tree.nodes.new(type = "CompositorNodeComposite")
-            composite.location = 200,0
-
-            scene = bpy.context.scene
-
-            #setup the depthmap calculation using blender's mist function:
-            scene.render.layers['RenderLayer'].use_pass_mist = True
-            #the depthmap can be calculated as the distance between objects and camera ('LINEAR'), 
-            #or square/inverse square of the distance ('QUADRATIC'/'INVERSEQUADRATIC'):
-            scene.world.mist_settings.falloff = 'LINEAR'
-            #minimum depth:
-            scene.world.mist_settings.intensity = 0.0
-            #maximum depth (can be changed depending on the scene geometry to normalize the depth 
-            #map whatever the camera orientation and position is):
-            dist = 100
-            scene.world.mist_settings.depth = dist
-            print(dist)
+            setup_mist_pass()
             #ouput the depthmap:
-            links.new(rl.outputs['Mist'],composite.inputs['Image'])
-
-            scene.render.use_multiview = False
-            dir2 = "depth_set_" + scene_mode + str(i)
-            
-            depthpath = os.path.join(save_directory, dir2)
-            for ob in bpy.context.scene.objects:
-                if ob.type == 'CAMERA':
-                    bpy.context.scene.camera = ob
-                    file = os.path.join(depthpath, ob.name )
-                    bpy.context.scene.render.filepath = file
-                    bpy.ops.render.render( write_still=True ) 
+            generate_camera_view(depthpath, 'depth', 'render_depth')
+            settings = bpy.context.scene.render.image_settings
+            if PYRAMID_SIZES and settings.file_format == 'PNG':
+                with METRICS.stage('pyramid'):
+                    write_set_levels(pathname, depthpath, PYRAMID_SIZES, PYRAMID_DEPTH, png_level(settings))
+    if TRANSMISSION_MAPS:
+        with METRICS.stage('transmission'):
+            write_round_maps(save_directory, rad)
+    return rig
      
+def parse_shard(text):
+    '''
+    "k/n" -> (k, n), shard k of n counting from 0
+    '''
+    try:
+        k, n = [int(part) for part in text.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("shard must look like k/n, got %r" % text)
+    if n < 1 or not 0 <= k < n:
+        raise argparse.ArgumentTypeError("shard k/n needs 0 <= k < n, got %r" % text)
+    return k, n
+
+def parse_args(argv):
+    '''
+    Parse the arguments given after "--" on the Blender command line:
+        blender -b -P haze_generator_new.py -- --output D --input a.txt b.txt --rounds 15 --shard 0/4
+    Without "--" (e.g. run from the text editor) the settings
+    at the top of this file are used
+    '''
+    if '--' in argv:
+        argv = argv[argv.index('--') + 1:]
+    else:
+        argv = []
+    parser = argparse.ArgumentParser(prog="haze_generator_new.py",
+                                     description="Render hazy multi-view images with Blender")
+    parser.add_argument('--output', default=SAVE_DIRECTORY,
+                        help="root directory, round k is written to <output>/k")
+    parser.add_argument('--input', nargs='+', default=INPUT_FILES,
+                        help="air transmittance input file(s), .txt or .npy (bundle.npy#k for one field "
+                             "of a bundle), round k uses input k mod count")
+    parser.add_argument('--random', action='store_true',
+                        help="ignore --input and use random uncorrelated densities")
+    parser.add_argument('--rounds', type=int, default=NUM_ROUNDS,
+                        help="number of rounds in the whole job")
+    parser.add_argument('--first-round', type=int, default=0,
+                        help="index of the first round of the job")
+    parser.add_argument('--cameras', type=int, default=NUM_CAMERAS)
+    parser.add_argument('--rig', choices=["ring", "rings", "cap"], default=CAMERA_RIG,
+                        help="camera layout, see CAMERA_RIG")
+    parser.add_argument('--camera-jitter', type=float, default=CAMERA_JITTER,
+                        help="random height change as a fraction of the camera height")
+    parser.add_argument('--threads', type=int, default=NUM_THREADS,
+                        help="Cycles render threads, 0 for automatic")
+    parser.add_argument('--shard', type=parse_shard, default=(0, 1), metavar='K/N',
+                        help="only render the rounds r with r %% N == K")
+    parser.add_argument('--haze-mode', choices=["cubes", "volume"], default=HAZE_MODE)
+    parser.add_argument('--scene-mode', default=SCENE_MODE)
+    parser.add_argument('--profile', choices=sorted(RENDER_PROFILES), default=RENDER_PROFILE,
+                        help="render settings, see RENDER_PROFILES")
+    parser.add_argument('--seed', type=int, default=SEED,
+                        help="seed round k with \"SEED:k\" to make its scene reproducible")
+    parser.add_argument('--render-cache', default=RENDER_CACHE, metavar='DIR',
+                        help="reuse renders of identical scenes from this directory")
+    parser.add_argument('--render-cache-size', type=float, default=RENDER_CACHE_SIZE / 2.0**30,
+                        metavar='GB', help="size limit of the render cache")
+    parser.add_argument('--output-format', choices=["files", "tar"], default=OUTPUT_FORMAT,
+                        help="tar packs rounds into tar shards staged on local disk")
+    parser.add_argument('--staging', default=ARCHIVE_STAGING,
+                        help="local directory for rounds and shards of the tar output")
+    parser.add_argument('--archive-size', type=float, default=ARCHIVE_SHARD_SIZE / 2.0**20, metavar='MB',
+                        help="size at which a tar shard is copied to --output")
+    parser.add_argument('--persistent-data', action='store_true', default=PERSISTENT_DATA,
+                        help="keep the Cycles scene between renders and change densities in place")
+    parser.add_argument('--async-write', action='store_true', default=ASYNC_WRITE,
+                        help="encode and write images on background threads while the next camera renders")
+    parser.add_argument('--transmission', action='store_true', default=TRANSMISSION_MAPS,
+                        help="write ground truth transmission maps next to the depth maps")
+    parser.add_argument('--mist-start', type=float, default=None,
+                        help="distance where the depth map starts, closer pixels read as 0; "
+                             "default 0 with --transmission, else %g" % MIST_START)
+    parser.add_argument('--pyramid', type=int, nargs='+', default=PYRAMID_SIZES, metavar='SIZE',
+                        help="also write every view as squares of these sides cut from the centre of "
+                             "the render, at most its shorter side, e.g. --pyramid 128 256 512")
+    parser.add_argument('--pyramid-depth', choices=DEPTH_MODES, default=PYRAMID_DEPTH,
+                        help="depth of a pyramid pixel: the nearest depth it covers or the valid one "
+                             "closest to its centre")
+    parser.add_argument('--no-cleanup', dest='cleanup', action='store_false', default=CLEANUP,
+                        help="keep datablocks that earlier rounds left unused")
+    parser.add_argument('--metrics', default=METRICS_FILE, metavar='FILE',
+                        help="append the time and datablock counts of every stage to this JSON lines file")
+    parser.add_argument('--profile-rounds', default=PROFILE_DIRECTORY, metavar='DIR',
+                        help="run every round under cProfile and dump round<k>.pstats to this directory")
+    parser.add_argument('--serve', action='store_true',
+                        help="read round numbers from stdin, one per line (used by orchestrator.py)")
+    return parser.parse_args(argv)
+
+def shard_rounds(first_round, num_rounds, shard):
+    '''
+    Rounds of the job handled by shard (k, n). Each round writes
+    only to its own <output>/<round> directory, so shards never overlap
+    '''
+    k, n = shard
+    return [round for round in range(first_round, first_round + num_rounds) if round % n == k]
+
+def served_rounds():
+    '''
+    Rounds sent one per line on stdin by orchestrator.py
+    '''
+    for line in iter(sys.stdin.readline, ''):
+        line = line.strip()
+        if line:
+            yield int(line)
+
+def count_images(round):
+    '''
+    Number of images written for round
+    '''
+    count = 0
+    extension = bpy.context.scene.render.file_extension
+    for _, _, files in os.walk(os.path.join(SAVE_DIRECTORY, str(round))):
+        count += len([name for name in files if name.endswith(extension)])
+    return count
+
+def collect_orphans(collector, material_cache):
+    '''
+    Remove what the last round left unused and report the counts
+    '''
+    before, after = collector.collect(keep=material_cache.materials.values())
+    collector.report(before, after)
+    METRICS.event('cleanup', before=before, after=after)
+
+def finish_round(round, archive=None):
+    '''
+    Pack a round staged for the tar output into archive.
+    Return the number of images written for round
+    '''
+    if archive is None:
+        return count_images(round)
+    return pack_round(archive, round, os.path.join(ARCHIVE_STAGING, str(round)))
+
 def main():
-    for round in range(15):
-        run("input_file\random_0.06.txt", round)
+    global SAVE_DIRECTORY, INPUT_FILES, INPUT_FILE_MODE, NUM_CAMERAS, HAZE_MODE, SCENE_MODE, SEED
+    global RENDER_PROFILE, OUTPUT_FORMAT, ARCHIVE_STAGING, CAMERA_RIG, CAMERA_JITTER, PERSISTENT_DATA
+    global TRANSMISSION_MAPS, METRICS_FILE, PROFILE_DIRECTORY, METRICS, CLEANUP, MIST_START
+    global PYRAMID_SIZES, PYRAMID_DEPTH
+    args = parse_args(sys.argv)
+    SAVE_DIRECTORY = args.output
+    if args.input is not INPUT_FILES:
+        # run() looks input files up under SAVE_DIRECTORY unless they are
+        # absolute, paths from the command line are relative to the cwd
+        INPUT_FILES = [os.path.abspath(path) for path in args.input]
+    INPUT_FILE_MODE = not args.random
+    NUM_CAMERAS = args.cameras
+    CAMERA_RIG = args.rig
+    CAMERA_JITTER = args.camera_jitter
+    PERSISTENT_DATA = args.persistent_data
+    TRANSMISSION_MAPS = args.transmission
+    if args.mist_start is not None:
+        MIST_START = args.mist_start
+    elif TRANSMISSION_MAPS:
+        # transmission needs the distance of every pixel
+        MIST_START = 0.0
+    PYRAMID_SIZES = args.pyramid
+    PYRAMID_DEPTH = args.pyramid_depth
+    METRICS_FILE = args.metrics
+    PROFILE_DIRECTORY = args.profile_rounds
+    CLEANUP = args.cleanup
+    HAZE_MODE = args.haze_mode
+    SCENE_MODE = args.scene_mode
+    SEED = args.seed
+    RENDER_PROFILE = args.profile
+    OUTPUT_FORMAT = args.output_format
+    # one staging directory per process, a killed worker leaves its
+    # shard there for "python shard_writer.py recover"
+    ARCHIVE_STAGING = os.path.join(args.staging, str(os.getpid()))
+
+    scene = bpy.context.scene
+    if args.threads > 0:
+        scene.render.threads_mode = 'FIXED'
+        scene.render.threads = args.threads
+    else:
+        scene.render.threads_mode = 'AUTO'
+    if PYRAMID_SIZES:
+        # fail before rendering when a level cannot be made
+        scale = scene.render.resolution_percentage / 100.0
+        check_sizes(int(scene.render.resolution_x * scale), int(scene.render.resolution_y * scale),
+                    PYRAMID_SIZES)
+
+    material_cache = MaterialCache(MATERIAL_TOLERANCE, MATERIAL_CACHE_SIZE)
+    render_cache = None
+    if args.render_cache:
+        render_cache = RenderCache(args.render_cache, int(args.render_cache_size * 2**30))
+    writer = None
+    if args.async_write:
+        writer = ImageWriter(WRITER_QUEUE, WRITER_THREADS)
+    archive = None
+    if OUTPUT_FORMAT == "tar":
+        archive = ShardWriter(SAVE_DIRECTORY, ARCHIVE_STAGING, int(args.archive_size * 2**20))
+    if METRICS_FILE is not None:
+        METRICS = Metrics(METRICS_FILE, datablock_counts, PROFILE_DIRECTORY)
+    # what is in bpy.data before the first round is never removed
+    collector = OrphanCollector() if CLEANUP else None
+    rig = None
+    if args.serve:
+        rounds = served_rounds()
+    else:
+        rounds = shard_rounds(args.first_round, args.rounds, args.shard)
+    try:
+        for round in rounds:
+            haze_input_file = INPUT_FILES[round % len(INPUT_FILES)]
+            if not args.serve:
+                with METRICS.round(round):
+                    rig = run(haze_input_file, round, material_cache, rig, render_cache, writer)
+                    if archive is not None:
+                        finish_round(round, archive)
+                    if collector is not None:
+                        collect_orphans(collector, material_cache)
+                continue
+            # report every round back to the orchestrator, a failed
+            # round leaves the scene in an unknown state so rebuild it
+            try:
+                with METRICS.round(round):
+                    rig = run(haze_input_file, round, material_cache, rig, render_cache, writer)
+                    images = finish_round(round, archive)
+                    if collector is not None:
+                        collect_orphans(collector, material_cache)
+            except Exception:
+                traceback.print_exc()
+                rig = None
+                if archive is not None:
+                    shutil.rmtree(os.path.join(ARCHIVE_STAGING, str(round)), ignore_errors=True)
+                print("ROUND_FAILED %d" % round)
+            else:
+                print("ROUND_DONE %d %d" % (round, images))
+            sys.stdout.flush()
+    finally:
+        # copy the last, partly filled shard
+        if archive is not None:
+            archive.close()
+        METRICS.close()
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,202 @@
+import argparse
+import glob
+import os
+import sys
+import numpy as np
+
+'''
+Read and write haze density fields
+
+Two formats are accepted wherever a field is read:
+
+- text (.txt), the original input format:
+      x dim
+      y dim
+      z dim
+      one line of x values per y row, y rows grouped by z layer
+- numpy (.npy), either one field of shape (z, y, x) or a bundle of
+  stacked fields of shape (count, z, y, x). Bundles are opened with
+  mmap_mode='r', so reading field k only touches that field.
+
+A single field of a bundle is named "<bundle>.npy#k".
+
+The labels of every image set are written by write_label() as
+label<i>.txt, a text field, and label<i>.npy, the same densities
+with the camera poses in one structured record.
+
+Usage:
+    python haze_io.py convert input_file/same_*.txt input_file/same.npy
+    python haze_io.py convert input_file/same.npy input_file/same_txt
+'''
+
+
+def split_field_path(path):
+    '''
+    "fields.npy#12" -> ("fields.npy", 12), "a.txt" -> ("a.txt", None)
+    '''
+    if '#' in os.path.basename(path):
+        path, index = path.rsplit('#', 1)
+        return path, int(index)
+    return path, None
+
+def read_text_field(path):
+    '''
+    Read a text field as an array indexed [z, y, x]. Any whitespace
+    separates values, so trailing spaces and newlines are fine
+    '''
+    f = open(path, 'r')
+    tokens = f.read().split()
+    f.close()
+    nx, ny, nz = int(tokens[0]), int(tokens[1]), int(tokens[2])
+    values = np.array(tokens[3:3 + nx * ny * nz], dtype=float)
+    if values.size != nx * ny * nz:
+        raise ValueError("%s: expected %d values for a %dx%dx%d grid, found %d"
+                         % (path, nx * ny * nz, nx, ny, nz, values.size))
+    return values.reshape(nz, ny, nx)
+
+def open_bundle(path):
+    '''
+    Memory map a .npy field or bundle without reading it
+    '''
+    fields = np.load(path, mmap_mode='r')
+    if fields.ndim not in (3, 4):
+        raise ValueError("%s: expected a (z, y, x) field or a (count, z, y, x) bundle, got shape %s"
+                         % (path, fields.shape))
+    return fields
+
+def count_fields(path):
+    path, index = split_field_path(path)
+    if index is not None or not path.endswith('.npy'):
+        return 1
+    fields = open_bundle(path)
+    return len(fields) if fields.ndim == 4 else 1
+
+def read_field(path, default_index=0):
+    '''
+    Read one field as a float array indexed [z, y, x].
+    For a bundle without "#k" in the path, field
+    default_index modulo the bundle size is read
+    '''
+    path, index = split_field_path(path)
+    if not path.endswith('.npy'):
+        return read_text_field(path)
+    fields = open_bundle(path)
+    if fields.ndim == 3:
+        return np.array(fields, dtype=float)
+    if index is None:
+        index = default_index % len(fields)
+    return np.array(fields[index], dtype=float)
+
+
+def write_text_field(path, density):
+    '''
+    Write one [z, y, x] density array in the text format
+    '''
+    nz, ny, nx = density.shape
+    f = open(path, 'w')
+    f.write("%d\n%d\n%d\n" % (nx, ny, nz))
+    for z_step in range(nz):
+        for y_step in range(ny):
+            f.write(" ".join("%f" % value for value in density[z_step, y_step]) + "\n")
+    f.close()
+
+def create_bundle(path, count, shape, dtype=np.float32):
+    '''
+    Create an empty bundle of count fields of shape (z, y, x) on disk
+    and return it memory mapped for writing
+    '''
+    return np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=(count,) + tuple(shape))
+
+def write_bundle(path, densities, dtype=np.float32):
+    '''
+    Write stacked [z, y, x] fields as one .npy bundle
+    '''
+    np.save(path, np.asarray(densities, dtype=dtype))
+
+
+def label_dtype(shape, num_cameras):
+    '''
+    Record type of a label<i>.npy file: the density of every voxel
+    indexed [z, y, x] and the pose of every camera
+    '''
+    return np.dtype([('density', np.float32, tuple(shape)),
+                     ('camera_names', 'U64', (num_cameras,)),
+                     ('camera_location', np.float64, (num_cameras, 3)),
+                     ('camera_matrix_world', np.float64, (num_cameras, 4, 4)),
+                     ('look_at', np.float64, (3,))])
+
+def write_label(directory, index, density, cameras):
+    '''
+    Write the label of image set index in one go:
+    label<index>.txt in the text field layout (one "%f " per voxel)
+    and label<index>.npy, a single record of label_dtype.
+    cameras is the pose dict returned by align_camera()
+    '''
+    density = np.asarray(density, dtype=float)
+    nz, ny, nx = density.shape
+    rows = density.reshape(nz * ny, nx)
+    f = open(os.path.join(directory, 'label%d.txt' % index), 'w')
+    f.write("%d\n%d\n%d\n" % (nx, ny, nz))
+    f.write("".join("%f " * nx % tuple(row) + "\n" for row in rows))
+    f.close()
+
+    names = list(cameras['names'])
+    label = np.zeros((), dtype=label_dtype(density.shape, len(names)))
+    label['density'] = density
+    label['camera_names'] = names
+    label['camera_location'] = cameras['location']
+    label['camera_matrix_world'] = cameras['matrix_world']
+    label['look_at'] = cameras['look_at']
+    np.save(os.path.join(directory, 'label%d.npy' % index), label)
+
+def read_label(path, mmap_mode='r'):
+    '''
+    Open a label<i>.npy record, memory mapped by default.
+    label['density'] is the [z, y, x] density array
+    '''
+    return np.load(path, mmap_mode=mmap_mode)
+
+
+def convert(sources, target):
+    '''
+    Convert between the formats:
+    text files -> .npy bundle, or .npy -> directory of text files
+    '''
+    if target.endswith('.npy'):
+        fields = [read_text_field(path) for path in sources]
+        write_bundle(target, fields)
+        print("wrote %d fields to %s" % (len(fields), target))
+        return
+    if not os.path.exists(target):
+        os.makedirs(target)
+    written = 0
+    for source in sources:
+        name = os.path.splitext(os.path.basename(source))[0]
+        fields = open_bundle(source)
+        if fields.ndim == 3:
+            fields = fields[np.newaxis]
+        for k in range(len(fields)):
+            write_text_field(os.path.join(target, '%s_%05d.txt' % (name, k)), fields[k])
+            written += 1
+    print("wrote %d fields to %s" % (written, target))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert haze density fields between text and .npy")
+    commands = parser.add_subparsers(dest='command')
+    converter = commands.add_parser('convert', help="text files to a .npy bundle or a .npy bundle to text files")
+    converter.add_argument('sources', nargs='+', help="input files (globs are expanded)")
+    converter.add_argument('target', help="a .npy bundle or a directory for text files")
+    args = parser.parse_args(argv)
+    if args.command != 'convert':
+        parser.print_help()
+        return 1
+    sources = []
+    for pattern in args.sources:
+        sources.extend(sorted(glob.glob(pattern)) or [pattern])
+    convert(sources, args.target)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
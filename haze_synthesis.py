@@ -0,0 +1,358 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+from camera_rig import load_rig
+from haze_io import count_fields, read_field
+from image_reader import load_png
+from image_writer import from_uint, linear_to_srgb, srgb_to_linear, to_uint, write_png
+
+'''
+Add haze to a clean render without Cycles
+
+Only the haze density changes between most training variants, yet
+Cycles path traces the whole scene again for each of them. Given one
+haze free render J of a camera (a round rendered with an all zero
+density field), its mist depth and its pose, the optical depth
+tau = integral of the density along the ray of every pixel is found
+by ray marching the voxel grid, and the atmospheric scattering model
+
+    I = J t + A (1 - t),    t = exp(-tau)
+
+gives the hazy image for any number of density fields. The march is
+vectorized over pixels and every field of a batch reuses the samples.
+
+The grid has the geometry of the cubes built by run() in
+haze_generator_new.py: voxels of size 2 * rad, x and y centred on the
+origin and z starting at the ground. Densities are Volume Scatter
+densities, i.e. extinction per Blender unit. The model is single
+scattering with a constant airlight A, so "validate" fits A against a
+real Cycles render of the same field and reports the remaining error.
+
+Usage:
+    python haze_synthesis.py render --clean clean/image_set_moderate0/Camera.png \\
+        --depth clean/depth_set_moderate0/Camera.png --camera clean/camera.npz --name Camera \\
+        --fields input_file/matern.npy --output variants
+    python haze_synthesis.py validate --clean clean/image_set_moderate0/Camera.png \\
+        --depth clean/depth_set_moderate0/Camera.png --camera clean/camera.npz --name Camera \\
+        --fields input_file/same_0.02.txt --hazy 0/image_set_moderate0/Camera.png
+'''
+
+# mist pass of setup_mist_pass() in haze_generator_new.py: linear
+# from MIST_START (Blender's default) over MIST_DEPTH units. Rounds
+# record the range they were rendered with in camera.npz (see
+# mist_range()), these are for the rounds that do not
+MIST_START = 5.0
+MIST_DEPTH = 100.0
+
+
+class VoxelGrid(object):
+    '''
+    Axis aligned grid of shape (nz, ny, nx) with its lowest
+    corner at origin and cubic voxels of size spacing
+    '''
+    def __init__(self, shape, origin, spacing=1.0):
+        self.shape = tuple(int(n) for n in shape)
+        self.origin = np.asarray(origin, dtype=float)
+        self.spacing = float(spacing)
+
+    @classmethod
+    def from_layout(cls, shape, rad=0.5):
+        '''
+        Grid of the cubes of run(), which are centred at
+        ((1 - nx) rad + 2 rad i, (1 - ny) rad + 2 rad j, rad + 2 rad k)
+        '''
+        nz, ny, nx = shape
+        return cls(shape, (-nx * rad, -ny * rad, 0.0), 2 * rad)
+
+    def bounds(self):
+        size = np.array(self.shape[::-1], dtype=float) * self.spacing
+        return self.origin, self.origin + size
+
+    def voxel_index(self, points):
+        '''
+        Flat [z, y, x] index of the voxel of every point (..., 3)
+        '''
+        nz, ny, nx = self.shape
+        cell = np.floor((points - self.origin) / self.spacing).astype(np.int64)
+        ix = np.clip(cell[..., 0], 0, nx - 1)
+        iy = np.clip(cell[..., 1], 0, ny - 1)
+        iz = np.clip(cell[..., 2], 0, nz - 1)
+        return (iz * ny + iy) * nx + ix
+
+
+def camera_rays(K, R, t, width, height):
+    '''
+    Origin (3,) and unit directions (height * width, 3) of the rays
+    through the pixel centres, top row first, for world to camera
+    R, t in the OpenCV frame (see camera_rig.py)
+    '''
+    u, v = np.meshgrid(np.arange(width) + 0.5, np.arange(height) + 0.5)
+    pixels = np.stack([u.ravel(), v.ravel(), np.ones(u.size)], axis=1)
+    directions = np.linalg.solve(K, pixels.T).T @ R
+    directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+    return -R.T @ t, directions
+
+def ray_box(origin, directions, lo, hi):
+    '''
+    Distances where every ray enters and leaves the box [lo, hi];
+    rays that miss it get t_in >= t_out
+    '''
+    safe = np.where(directions == 0, 1e-30, directions)
+    t0 = (lo - origin) / safe
+    t1 = (hi - origin) / safe
+    t_in = np.maximum(np.minimum(t0, t1).max(axis=1), 0.0)
+    t_out = np.maximum(t0, t1).min(axis=1)
+    return t_in, t_out
+
+def march(grid, origin, directions, far, step):
+    '''
+    Sample every ray at intervals of step between where it enters the
+    grid and where it leaves it or reaches far, whichever is first.
+    Return voxel indices (rays, samples) and the length each sample
+    stands for (0 past the end of a ray)
+    '''
+    lo, hi = grid.bounds()
+    t_in, t_out = ray_box(origin, directions, lo, hi)
+    t_end = np.minimum(t_out, far)
+    count = int(np.ceil(np.linalg.norm(hi - lo) / step))
+    start = t_in[:, None] + np.arange(count) * step
+    lengths = np.clip(t_end[:, None] - start, 0.0, step)
+    middle = start + 0.5 * lengths
+    points = origin + middle[:, :, None] * directions[:, None, :]
+    return grid.voxel_index(points), lengths
+
+def optical_depth(grid, fields, origin, directions, far, step=0.25, max_elements=2**24):
+    '''
+    Integral of the density along every ray up to far, for each
+    field of fields (count, nz, ny, nx). Returns (count, rays).
+    step is the march interval in voxels
+    '''
+    fields = np.asarray(fields, dtype=np.float32).reshape(len(fields), -1)
+    # voxel major, so the densities of all fields at a sample are adjacent
+    by_voxel = np.ascontiguousarray(fields.T)
+    step = step * grid.spacing
+    lo, hi = grid.bounds()
+    samples = int(np.ceil(np.linalg.norm(hi - lo) / step))
+    chunk = max(1, max_elements // (samples * max(len(fields), 1)))
+    far = np.broadcast_to(far, (len(directions),))
+    tau = np.zeros((len(fields), len(directions)), dtype=np.float32)
+    for first in range(0, len(directions), chunk):
+        last = min(first + chunk, len(directions))
+        index, lengths = march(grid, origin, directions[first:last], far[first:last], step)
+        tau[:, first:last] = np.einsum('rsf,rs->fr', by_voxel[index], lengths.astype(np.float32))
+    return tau
+
+
+def hazy_image(clean, transmission, airlight):
+    '''
+    I = J t + A (1 - t) for a clean image (height, width, 3) and
+    transmissions (..., height, width)
+    '''
+    t = transmission[..., np.newaxis]
+    return clean * t + np.asarray(airlight, dtype=float) * (1 - t)
+
+def estimate_airlight(hazy, clean, transmission):
+    '''
+    Least squares airlight per channel for hazy = J t + A (1 - t)
+    '''
+    haze = (1 - transmission)[..., np.newaxis]
+    residual = hazy - clean * (1 - haze)
+    return (residual * haze).sum(axis=(0, 1)) / np.maximum((haze ** 2).sum(axis=(0, 1)), 1e-12)
+
+def mist_to_distance(mist, start=MIST_START, depth=MIST_DEPTH):
+    '''
+    Distance of mist pass values. Blender clamps everything closer than
+    start to 0, so with start > 0 those pixels get NaN: their distance
+    is anywhere in [0, start] and is not guessed
+    '''
+    distance = start + mist * depth
+    if start > 0:
+        distance = np.where(mist > 0, distance, np.nan)
+    return distance
+
+def mist_range(rig, start=None, depth=None):
+    '''
+    (start, depth) of the mist pass of a round: the given values, else
+    the ones recorded in its camera.npz, else MIST_START and MIST_DEPTH
+    '''
+    recorded = rig['mist'] if 'mist' in rig else (MIST_START, MIST_DEPTH)
+    return (float(recorded[0]) if start is None else start,
+            float(recorded[1]) if depth is None else depth)
+
+def unknown_pixels(distance):
+    '''
+    Number of pixels whose distance the mist pass clamped away
+    '''
+    return int(np.isnan(distance).sum())
+
+def load_image(path):
+    '''
+    Linear RGB image (height, width, 3) from a .npy file or an
+    sRGB PNG saved by Blender
+    '''
+    if path.endswith('.npy'):
+        return np.load(path)[:, :, :3].astype(float)
+    return srgb_to_linear(from_uint(load_png(path))[:, :, :3])
+
+def load_distance(source, start=MIST_START, depth=MIST_DEPTH):
+    '''
+    Distance from the camera (height, width) from a .npy file of
+    distances or from a mist pass PNG saved by Blender (its path or
+    bytes), NaN where mist_to_distance() cannot tell it
+    '''
+    if isinstance(source, str) and source.endswith('.npy'):
+        return np.load(source).astype(float)
+    mist = srgb_to_linear(from_uint(load_png(source))[:, :, 0])
+    return mist_to_distance(mist, start, depth)
+
+def load_camera(path, name):
+    '''
+    K, R, t and (width, height) of camera name in a camera.npz, and
+    the rig itself
+    '''
+    rig = load_rig(path)
+    names = [str(n) for n in rig['names']]
+    if name not in names:
+        raise ValueError("%s has no camera %r, it has %s" % (path, name, names))
+    k = names.index(name)
+    return rig['K'][k], rig['R'][k], rig['t'][k], tuple(int(n) for n in rig['image_size']), rig
+
+def read_fields(paths):
+    '''
+    Every field of the given text files, .npy fields and bundles
+    '''
+    fields = []
+    for path in paths:
+        for k in range(count_fields(path)):
+            fields.append(read_field(path, k))
+    return np.array(fields)
+
+
+class HazeSynthesizer(object):
+    '''
+    Transmission maps and hazy variants of one clean camera view
+    '''
+    def __init__(self, clean, distance, K, R, t, grid, step=0.25):
+        self.clean = clean
+        self.distance = distance
+        self.grid = grid
+        self.step = step
+        height, width = distance.shape
+        self.origin, self.directions = camera_rays(K, R, t, width, height)
+
+    def transmission(self, fields):
+        '''
+        t = exp(-tau) of every field, shape (count, height, width),
+        NaN at the pixels of unknown distance
+        '''
+        distance = self.distance.ravel()
+        known = ~np.isnan(distance)
+        tau = np.full((len(fields), len(distance)), np.nan, dtype=np.float32)
+        tau[:, known] = optical_depth(self.grid, fields, self.origin, self.directions[known],
+                                      distance[known], self.step)
+        return np.exp(-tau).reshape((len(tau),) + self.distance.shape)
+
+    def variants(self, fields, airlight):
+        return hazy_image(self.clean, self.transmission(fields), airlight)
+
+
+def synthesizer_from_args(args, shape):
+    clean = load_image(args.clean)
+    K, R, t, size, rig = load_camera(args.camera, args.name)
+    start, depth = mist_range(rig, args.mist_start, args.mist_depth)
+    distance = load_distance(args.depth, start, depth)
+    unknown = unknown_pixels(distance)
+    if unknown:
+        print("warning: %d pixels are closer than the mist start %g, their distance is unknown; "
+              "render with --mist-start 0" % (unknown, start))
+    if size != distance.shape[::-1]:
+        # the render was made at another resolution percentage
+        scale = distance.shape[1] / float(size[0])
+        K = K * np.array([[scale], [scale], [1]])
+    grid = VoxelGrid.from_layout(shape, args.rad)
+    return HazeSynthesizer(clean, distance, K, R, t, grid, args.step)
+
+def render(args):
+    fields = read_fields(args.fields)
+    synthesizer = synthesizer_from_args(args, fields.shape[1:])
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    start = time.time()
+    written = 0
+    for first in range(0, len(fields), args.batch):
+        batch = fields[first:first + args.batch]
+        transmission = synthesizer.transmission(batch)
+        # pixels of unknown distance are written as J, their .npy keep NaN
+        images = hazy_image(synthesizer.clean, np.nan_to_num(transmission, nan=1.0), args.airlight)
+        for k in range(len(batch)):
+            name = '%s_%05d' % (args.name, first + k)
+            write_png(os.path.join(args.output, name + '.png'), to_uint(linear_to_srgb(images[k]), 8))
+            if args.save_transmission:
+                np.save(os.path.join(args.output, name + '_transmission.npy'), transmission[k])
+            written += 1
+    elapsed = time.time() - start
+    print("wrote %d hazy images to %s in %.1f s (%.3f s per image)"
+          % (written, args.output, elapsed, elapsed / max(written, 1)))
+
+def validate(args):
+    fields = read_fields(args.fields)[:1]
+    synthesizer = synthesizer_from_args(args, fields.shape[1:])
+    hazy = load_image(args.hazy)
+    transmission = synthesizer.transmission(fields)[0]
+    # only the pixels of known distance are fitted and compared
+    known = ~np.isnan(transmission)
+    airlight = estimate_airlight(hazy[known][np.newaxis], synthesizer.clean[known][np.newaxis],
+                                 transmission[known][np.newaxis])
+    predicted = hazy_image(synthesizer.clean[known], transmission[known], airlight)
+    transmission = transmission[known]
+    error = linear_to_srgb(predicted) - linear_to_srgb(hazy[known])
+    rmse = np.sqrt(np.mean(error ** 2))
+    psnr = 20 * np.log10(1.0 / rmse) if rmse > 0 else float('inf')
+    print("fitted airlight: %s" % " ".join("%.4f" % a for a in airlight))
+    print("transmission: min %.4f, mean %.4f" % (transmission.min(), transmission.mean()))
+    print("against Cycles: RMSE %.5f, PSNR %.2f dB, worst pixel %.4f"
+          % (rmse, psnr, np.abs(error).max()))
+    return rmse
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Synthesize hazy images from one clean render")
+    commands = parser.add_subparsers(dest='command')
+    renderer = commands.add_parser('render', help="write a hazy image for every density field")
+    validator = commands.add_parser('validate', help="compare with a Cycles render of the first field")
+    for command in (renderer, validator):
+        command.add_argument('--clean', required=True, help="haze free render, .png or linear .npy")
+        command.add_argument('--depth', required=True, help="mist pass .png or distances .npy")
+        command.add_argument('--camera', required=True, help="camera.npz of the round")
+        command.add_argument('--name', default='Camera', help="camera name in camera.npz")
+        command.add_argument('--fields', nargs='+', required=True,
+                             help="density fields, .txt, .npy or bundles like haze_generator_new.py reads")
+        command.add_argument('--rad', type=float, default=0.5, help="half size of a voxel cube")
+        command.add_argument('--step', type=float, default=0.25, help="march step in voxels")
+        command.add_argument('--mist-start', type=float, default=None,
+                             help="default: the range in camera.npz, else %g" % MIST_START)
+        command.add_argument('--mist-depth', type=float, default=None,
+                             help="default: the range in camera.npz, else %g" % MIST_DEPTH)
+    renderer.add_argument('--airlight', type=float, nargs=3, default=[0.8, 0.8, 0.8],
+                          help="linear RGB airlight A")
+    renderer.add_argument('--output', required=True, help="directory for the hazy images")
+    renderer.add_argument('--batch', type=int, default=16, help="fields marched together")
+    renderer.add_argument('--save-transmission', action='store_true',
+                          help="also write every transmission map as .npy")
+    validator.add_argument('--hazy', required=True, help="Cycles render of the first field")
+    args = parser.parse_args(argv)
+
+    if args.command == 'render':
+        render(args)
+    elif args.command == 'validate':
+        validate(args)
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,251 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+from image_reader import load_png
+from image_writer import linear_to_srgb, srgb_to_linear, write_png
+
+'''
+Lower resolution copies of rendered views without rendering again
+
+Training at 128x128, 256x256 and 512x512 used to take one Cycles run
+per resolution. Instead the full resolution hazy image and depth map
+of every view are reduced with numpy to each size of a pyramid and
+written next to the full resolution output, as a tree of their own:
+
+    <round>/pyramid_<size>/image_set_<scene mode><i>/<camera>.png
+    <round>/pyramid_<size>/depth_set_<scene mode><i>/<camera>.png
+
+so a reader pointed at <round>/pyramid_<size> sees the same layout as
+at <round>. Every level is size x size: the centred square of side
+min(width, height) of the render is cut out (horizontally for the
+960x540 default) and reduced to size x size, so 128, 256 and 512 can
+all be made from any render at least size pixels high and wide. K of
+a level is that of the render with the crop and the scale applied
+(level_intrinsics()).
+
+Each level pixel covers an area of side / size render pixels, which
+need not be an integer: the render pixels it overlaps are weighted by
+the area of the overlap. The hazy image is averaged that way in linear
+light (the PNG holds sRGB values). The depth map is never averaged, a
+level pixel straddling an edge would get a depth no surface has: "min"
+keeps the nearest depth of the render pixels it overlaps, "nearest"
+the depth of the overlapped pixel closest to its centre that hit
+something within the mist depth. Depth values are kept as the integers
+Blender wrote, so every level holds depths of the full resolution map
+exactly.
+
+haze_generator_new.py writes the levels with --pyramid 128 256 512,
+from the pixels in memory with --async-write and from the PNG files
+just written otherwise.
+
+Usage:
+    python image_pyramid.py /data/haze/0 /data/haze/1 --sizes 128 256 512
+'''
+
+DEPTH_MODES = ('min', 'nearest')
+
+
+def level_crop(width, height):
+    '''
+    (x, y, side) of the centred square of a width x height render
+    that the levels are made from
+    '''
+    side = min(width, height)
+    return (width - side) // 2, (height - side) // 2, side
+
+def check_sizes(width, height, sizes):
+    '''
+    Raise ValueError unless every size can be made from a render of
+    width x height, i.e. is no larger than its shorter side
+    '''
+    side = level_crop(width, height)[2]
+    for size in sizes:
+        if size <= 0 or size > side:
+            raise ValueError("pyramid size %d is not within 1 and %d, the shorter side of the %dx%d render"
+                             % (size, side, width, height))
+
+def level_intrinsics(K, width, height, size):
+    '''
+    K (..., 3, 3) of a width x height render for its size x size level
+    '''
+    x, y, side = level_crop(width, height)
+    K = np.array(K, dtype=float)
+    K[..., 0, 2] -= x
+    K[..., 1, 2] -= y
+    scale = size / float(side)
+    K[..., :2, :] *= scale
+    return K
+
+def windows(length, size):
+    '''
+    For each of size level pixels along an axis of length render
+    pixels: the render pixels it overlaps (size, count), in order, the
+    area of each overlap in render pixels and the distance of each
+    pixel centre to the level pixel centre. Rows with fewer overlapped
+    pixels are padded with their last pixel at weight 0 and distance inf
+    '''
+    step = length / float(size)
+    lo = np.arange(size) * step
+    hi = lo + step
+    first = np.floor(lo).astype(np.int64)
+    last = np.minimum(np.ceil(hi).astype(np.int64), length) - 1
+    count = int((last - first).max()) + 1
+    index = first[:, np.newaxis] + np.arange(count)
+    padding = index > last[:, np.newaxis]
+    index = np.minimum(index, last[:, np.newaxis])
+    weight = np.clip(np.minimum(index + 1, hi[:, np.newaxis]) - np.maximum(index, lo[:, np.newaxis]), 0, None)
+    weight[padding] = 0.0
+    distance = index + 0.5 - (lo + hi)[:, np.newaxis] / 2.0
+    distance[padding | (weight <= 0)] = np.inf
+    return index, weight, distance
+
+def gather(array, size):
+    '''
+    The render pixels overlapped by every pixel of the size x size
+    level of array (height, width, channels), as an array
+    (size, rows, size, columns, channels), with the row and column
+    windows() they come from
+    '''
+    height, width = array.shape[:2]
+    x, y, side = level_crop(width, height)
+    square = array[y:y + side, x:x + side]
+    rows, columns = windows(side, size), windows(side, size)
+    return square[rows[0][:, :, np.newaxis, np.newaxis], columns[0][np.newaxis, np.newaxis]], rows, columns
+
+def color_channels(channels):
+    # grey + alpha and RGBA end in an alpha channel that is not sRGB
+    return channels - 1 if channels in (2, 4) else channels
+
+def downsample_color(array, size):
+    '''
+    Area average of a uint8 or uint16 sRGB image of shape
+    (height, width, channels) to its size x size level
+    '''
+    height, width = array.shape[:2]
+    if height == width == size:
+        return array
+    top = float(np.iinfo(array.dtype).max)
+    colors = color_channels(array.shape[2])
+    pixels, rows, columns = gather(array, size)
+    values = pixels / top
+    values[..., :colors] = srgb_to_linear(values[..., :colors])
+    weight = rows[1][:, :, np.newaxis, np.newaxis] * columns[1][np.newaxis, np.newaxis]
+    mean = np.einsum('arbsc,arbs->abc', values, weight) / weight.sum(axis=(1, 3))[:, :, np.newaxis]
+    mean[:, :, :colors] = linear_to_srgb(mean[:, :, :colors])
+    return np.round(mean * top).astype(array.dtype)
+
+def downsample_depth(array, size, mode='min'):
+    '''
+    One depth per pixel of the size x size level of a mist depth map
+    of shape (height, width, channels), without blending depths. Pixels
+    at the largest value did not hit anything within the mist depth
+    '''
+    if mode not in DEPTH_MODES:
+        raise ValueError("depth mode must be one of %s, got %r" % (DEPTH_MODES, mode))
+    height, width = array.shape[:2]
+    if height == width == size:
+        return array
+    pixels, rows, columns = gather(array, size)
+    if mode == 'min':
+        # mist values grow with the distance, the smallest is the nearest
+        # surface; padding repeats an overlapped pixel, so it is harmless
+        return pixels.min(axis=(1, 3))
+    channels = array.shape[2]
+    candidates = pixels.transpose(0, 2, 1, 3, 4).reshape(size, size, -1, channels)
+    distance = (rows[2][:, np.newaxis, :, np.newaxis] ** 2
+                + columns[2][np.newaxis, :, np.newaxis, :] ** 2).reshape(size, size, -1)
+    order = np.argsort(distance, axis=2, kind='mergesort')
+    candidates = np.take_along_axis(candidates, order[:, :, :, np.newaxis], axis=2)
+    valid = candidates[:, :, :, 0] < np.iinfo(array.dtype).max
+    # first valid candidate, or the centre one when the pixel hit nothing
+    first = np.argmax(valid, axis=2)
+    return np.take_along_axis(candidates, first[:, :, np.newaxis, np.newaxis], axis=2)[:, :, 0]
+
+def level_path(path, size):
+    '''
+    <round>/<set>/<file> -> <round>/pyramid_<size>/<set>/<file>
+    '''
+    set_directory, name = os.path.split(path)
+    round_directory, set_name = os.path.split(set_directory)
+    return os.path.join(round_directory, 'pyramid_%d' % size, set_name, name)
+
+def write_levels(color, depth, image_path, depth_path, sizes, mode='min', level=6):
+    '''
+    Write every level of the hazy image color and the depth map depth,
+    uint arrays of shape (height, width, channels) as they were saved
+    to image_path and depth_path. Return the number of bytes written
+    '''
+    height, width = color.shape[:2]
+    check_sizes(width, height, sizes)
+    written = 0
+    for size in sizes:
+        for array, path in ((downsample_color(color, size), image_path),
+                            (downsample_depth(depth, size, mode), depth_path)):
+            target = level_path(path, size)
+            directory = os.path.dirname(target)
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+            written += write_png(target, array, level)
+    return written
+
+def write_file_levels(image_path, depth_path, sizes, mode='min', level=6):
+    '''
+    write_levels() for a view already saved as PNG files
+    '''
+    return write_levels(load_png(image_path), load_png(depth_path), image_path, depth_path,
+                        sizes, mode, level)
+
+def write_set_levels(image_directory, depth_directory, sizes, mode='min', level=6):
+    '''
+    Write the levels of every PNG view of an image set with a depth
+    map. Return the number of views
+    '''
+    views = 0
+    for name in sorted(os.listdir(image_directory)):
+        depth_path = os.path.join(depth_directory, name)
+        if not name.lower().endswith('.png') or not os.path.exists(depth_path):
+            continue
+        write_file_levels(os.path.join(image_directory, name), depth_path, sizes, mode, level)
+        views += 1
+    return views
+
+def write_round_levels(round_directory, sizes, mode='min', level=6):
+    '''
+    Write the levels of every image set of a round rendered by
+    haze_generator_new.run(). Return the number of views
+    '''
+    views = 0
+    for set_name in sorted(os.listdir(round_directory)):
+        image_directory = os.path.join(round_directory, set_name)
+        if not set_name.startswith('image_set_') or not os.path.isdir(image_directory):
+            continue
+        depth_directory = os.path.join(round_directory, 'depth_set_' + set_name[len('image_set_'):])
+        if os.path.isdir(depth_directory):
+            views += write_set_levels(image_directory, depth_directory, sizes, mode, level)
+    return views
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write lower resolution levels of rendered rounds")
+    parser.add_argument('rounds', nargs='+', help="round directories written by haze_generator_new.py")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[128, 256, 512],
+                        help="sides of the square levels, cut from the centre of the render and "
+                             "at most its shorter side (540 for the default 960x540)")
+    parser.add_argument('--depth', choices=DEPTH_MODES, default='min',
+                        help="depth of a level pixel: the nearest depth it covers or the valid "
+                             "one closest to its centre")
+    parser.add_argument('--level', type=int, default=6, help="zlib compression level")
+    args = parser.parse_args(argv)
+
+    for round_directory in args.rounds:
+        start = time.time()
+        views = write_round_levels(round_directory, args.sizes, args.depth, args.level)
+        print("wrote %d levels of %d views for %s in %.1f s"
+              % (len(args.sizes), views, round_directory, time.time() - start))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
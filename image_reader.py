@@ -0,0 +1,238 @@
+import struct
+import zlib
+import numpy as np
+
+'''
+Read the PNG files written by Blender and image_writer.py
+
+load_png() decodes with the C decoder of OpenCV or Pillow when either
+is installed, as they release the GIL and threads decoding with them
+run in parallel, and with the numpy decoder decode_png() otherwise.
+Every reader of the output tree (haze_synthesis.py, transmission.py,
+image_pyramid.py, haze_dataset.py) goes through load_png(), which
+takes a path or the bytes of a PNG file, e.g. a member of a tar shard.
+
+decode_png() needs no imaging library. Its row filters are undone in
+numpy, an anti-diagonal at a time for the Average and Paeth filters
+Blender uses, so it is slower and threads using it take turns on the
+GIL.
+
+Usage:
+    array = load_png('0/image_set_moderate0/Camera.png')   # (height, width, channels)
+'''
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def read_file(path):
+    f = open(path, 'rb')
+    data = f.read()
+    f.close()
+    return data
+
+def unfilter_row(kind, row, previous, bpp):
+    '''
+    Undo the PNG filter of one row of bytes in place
+    '''
+    if kind == 0:
+        return row
+    if kind == 1:
+        # Sub: running sum of every bpp-th byte
+        for k in range(bpp):
+            row[k::bpp] = np.cumsum(row[k::bpp], dtype=np.int64) % 256
+        return row
+    if kind == 2:
+        row += previous
+        return row
+    # Average and Paeth depend on the decoded byte to the left
+    line = bytearray(row.tobytes())
+    up = previous.tobytes()
+    for i in range(len(line)):
+        left = line[i - bpp] if i >= bpp else 0
+        if kind == 3:
+            line[i] = (line[i] + ((left + up[i]) >> 1)) & 0xff
+        else:
+            corner = up[i - bpp] if i >= bpp else 0
+            p = left + up[i] - corner
+            pa, pb, pc = abs(p - left), abs(p - up[i]), abs(p - corner)
+            if pa <= pb and pa <= pc:
+                predictor = left
+            elif pb <= pc:
+                predictor = up[i]
+            else:
+                predictor = corner
+            line[i] = (line[i] + predictor) & 0xff
+    row[:] = np.frombuffer(bytes(line), dtype=np.uint8)
+    return row
+
+def unfilter_wavefront(kinds, raw, bpp):
+    '''
+    Undo the filters of every row at once, for images using Average
+    or Paeth. A byte depends on the byte bpp to its left and the bytes
+    above, so all pixels on one anti-diagonal x + y are decoded
+    together; the rows are skewed so that a diagonal is one row of
+    the skewed array. raw is (height, width * bpp) without the
+    filter bytes
+    '''
+    height = raw.shape[0]
+    width = raw.shape[1] // bpp
+    diagonals = width + height - 1
+    ys = np.arange(height)[:, np.newaxis]
+    xs = np.arange(width)
+    # skewed[x + y + 2, y + 1] is pixel (y, x); the zero rows and
+    # column around it are the out of image neighbours
+    data = np.zeros((diagonals, height, bpp), dtype=np.int16)
+    data[xs + ys, ys] = raw.reshape(height, width, bpp)
+    skewed = np.zeros((diagonals + 2, height + 1, bpp), dtype=np.int16)
+    kinds = np.asarray(kinds)
+    # rows of each filter, and how many of them come before row y
+    rows_of = [np.flatnonzero(kinds == kind) for kind in range(5)]
+    counts = [[0] + np.cumsum(kinds == kind).tolist() for kind in range(5)]
+    for d in range(diagonals):
+        y0, y1 = max(0, d - width + 1), min(height - 1, d) + 1
+        target = skewed[d + 2, y0 + 1:y1 + 1]
+        target[...] = data[d, y0:y1]
+        for kind in range(1, 5):
+            first, last = counts[kind][y0], counts[kind][y1]
+            if first == last:
+                continue
+            if last - first == y1 - y0:
+                # the whole diagonal uses this filter
+                rows = slice(None)
+            else:
+                rows = rows_of[kind][first:last] - y0
+            left = skewed[d + 1, y0 + 1:y1 + 1][rows]
+            up = skewed[d + 1, y0:y1][rows]
+            if kind == 1:
+                value = left
+            elif kind == 2:
+                value = up
+            elif kind == 3:
+                value = (left + up) >> 1
+            else:
+                corner = skewed[d, y0:y1][rows]
+                p = left + up - corner
+                pa, pb, pc = np.abs(p - left), np.abs(p - up), np.abs(p - corner)
+                use_left = (pa <= pb) & (pa <= pc)
+                use_up = ~use_left & (pb <= pc)
+                value = corner + use_left * (left - corner) + use_up * (up - corner)
+            target[rows] += value
+        target &= 0xff
+    rows = skewed[xs + ys + 2, ys + 1]
+    return rows.astype(np.uint8).reshape(height, width * bpp)
+
+def decode_png(data, name='PNG data'):
+    '''
+    Decode the bytes of a non-interlaced grey, grey + alpha, RGB or
+    RGBA PNG of 8 or 16 bits as an array of shape (height, width,
+    channels), top row first. Palette images are not supported
+    '''
+    if data[:8] != PNG_SIGNATURE:
+        raise ValueError("%s is not a PNG file" % name)
+    position = 8
+    compressed = []
+    while position < len(data):
+        length, kind = struct.unpack('>I4s', data[position:position + 8])
+        chunk = data[position + 8:position + 8 + length]
+        if kind == b'IHDR':
+            width, height, bit_depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', chunk)
+        elif kind == b'IDAT':
+            compressed.append(chunk)
+        elif kind == b'IEND':
+            break
+        position += length + 12
+    if color_type not in (0, 2, 4, 6) or bit_depth not in (8, 16) or interlace:
+        raise ValueError("%s: unsupported PNG (colour type %d, %d bits, interlace %d)"
+                         % (name, color_type, bit_depth, interlace))
+    channels = {0: 1, 4: 2, 2: 3, 6: 4}[color_type]
+    bpp = channels * bit_depth // 8
+    raw = np.frombuffer(zlib.decompress(b''.join(compressed)), dtype=np.uint8)
+    raw = raw.reshape(height, width * bpp + 1)
+    if np.any(raw[:, 0] > 2):
+        # Blender's PNG writer picks Average and Paeth for most rows
+        rows = unfilter_wavefront(raw[:, 0], raw[:, 1:], bpp)
+    else:
+        rows = np.zeros((height, width * bpp), dtype=np.uint8)
+        previous = np.zeros(width * bpp, dtype=np.uint8)
+        for y in range(height):
+            rows[y] = raw[y, 1:]
+            previous = unfilter_row(raw[y, 0], rows[y], previous, bpp)
+    if bit_depth == 16:
+        return rows.view('>u2').reshape(height, width, channels).astype(np.uint16)
+    return rows.reshape(height, width, channels)
+
+def read_png(path):
+    '''
+    decode_png() of a PNG file
+    '''
+    return decode_png(read_file(path), path)
+
+def png_format(data):
+    '''
+    (bit depth, colour type) from the header of PNG bytes
+    '''
+    return struct.unpack('>BB', data[24:26])
+
+def opencv_png(data, name='PNG data'):
+    '''
+    decode_png() with the C decoder of OpenCV
+    '''
+    import cv2
+    array = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_UNCHANGED)
+    if array is None:
+        return decode_png(data, name)
+    if array.ndim == 2:
+        return array[:, :, np.newaxis]
+    if png_format(data)[1] == 4:
+        # grey + alpha comes back as BGRA
+        return np.ascontiguousarray(array[:, :, [0, 3]])
+    # OpenCV keeps colours as BGR(A)
+    return np.ascontiguousarray(array[:, :, [2, 1, 0, 3][:array.shape[2]]])
+
+def pillow_png(data, name='PNG data'):
+    '''
+    decode_png() with the C decoder of Pillow. Pillow reduces 16 bit
+    colour and grey + alpha to 8 bits, such images are decoded by
+    decode_png()
+    '''
+    import io
+    from PIL import Image
+    bit_depth, color_type = png_format(data)
+    if bit_depth == 16 and color_type != 0:
+        return decode_png(data, name)
+    image = Image.open(io.BytesIO(data))
+    array = np.asarray(image)
+    image.close()
+    if bit_depth == 16:
+        return array.astype(np.uint16)[:, :, np.newaxis]
+    return array[:, :, np.newaxis] if array.ndim == 2 else array
+
+def png_decoder():
+    '''
+    The fastest PNG decoder installed: opencv_png, pillow_png or decode_png
+    '''
+    try:
+        import cv2
+        return opencv_png
+    except ImportError:
+        pass
+    try:
+        import PIL.Image
+        return pillow_png
+    except ImportError:
+        return decode_png
+
+# picked by load_png() on its first call
+PNG_DECODER = None
+
+def load_png(source):
+    '''
+    Array of a PNG file, source being its path or its bytes, decoded
+    by png_decoder()
+    '''
+    global PNG_DECODER
+    if PNG_DECODER is None:
+        PNG_DECODER = png_decoder()
+    if isinstance(source, bytes):
+        return PNG_DECODER(source)
+    return PNG_DECODER(read_file(source), source)
@@ -0,0 +1,201 @@
+import queue
+import struct
+import threading
+import time
+import zlib
+import numpy as np
+
+'''
+Encode and write rendered images on background threads
+
+bpy.ops.render.render(write_still=True) encodes the PNG and writes it
+(to the network share) before the next camera can start rendering.
+haze_generator_new.py can instead take the render out of Blender as a
+numpy array and hand it to an ImageWriter, whose threads do the colour
+conversion, PNG encoding (zlib releases the GIL) and the write while
+the next camera renders. The conversion is the plain sRGB transform
+only; a scene with another view transform, a look, exposure, gamma or
+curves is saved by Blender as before.
+
+The queue of an ImageWriter is bounded: submit() blocks once
+max_pending images are waiting, so a slow share cannot make memory
+grow without bound. stats() reports the queue depth, the time the
+renderer was held up by it and the throughput.
+
+image_reader.py reads the images back.
+
+Usage:
+    writer = ImageWriter(max_pending=4, threads=2)
+    writer.submit(write_png, path, to_uint(linear_to_srgb(pixels), 8))
+    writer.wait()
+    writer.report()
+'''
+
+
+def linear_to_srgb(values):
+    '''
+    sRGB transfer function, Blender's "Default" view transform
+    '''
+    values = np.clip(values, 0.0, 1.0)
+    return np.where(values <= 0.0031308, 12.92 * values,
+                    1.055 * np.power(values, 1 / 2.4) - 0.055)
+
+def srgb_to_linear(values):
+    '''
+    Inverse of linear_to_srgb()
+    '''
+    values = np.clip(values, 0.0, 1.0)
+    return np.where(values <= 0.04045, values / 12.92,
+                    np.power((values + 0.055) / 1.055, 2.4))
+
+def to_uint(values, bit_depth=8):
+    '''
+    Quantize values in [0, 1] to uint8 or uint16
+    '''
+    top = 2 ** bit_depth - 1
+    dtype = np.uint8 if bit_depth == 8 else np.uint16
+    return np.round(np.clip(values, 0.0, 1.0) * top).astype(dtype)
+
+
+def png_chunk(kind, data):
+    chunk = kind + data
+    return struct.pack('>I', len(data)) + chunk + struct.pack('>I', zlib.crc32(chunk) & 0xffffffff)
+
+def encode_png(array, level=6):
+    '''
+    PNG bytes of a uint8 or uint16 array of shape (height, width) or
+    (height, width, channels) with 1 to 4 channels, top row first.
+    Every row uses the Up filter
+    '''
+    array = np.asarray(array)
+    if array.dtype == np.uint8:
+        bit_depth = 8
+    elif array.dtype == np.uint16:
+        bit_depth = 16
+    else:
+        raise ValueError("PNG needs a uint8 or uint16 array, got %s" % array.dtype)
+    if array.ndim == 2:
+        array = array[:, :, np.newaxis]
+    height, width, channels = array.shape
+    if channels not in (1, 2, 3, 4):
+        raise ValueError("PNG needs 1 to 4 channels, got %d" % channels)
+    color_type = {1: 0, 2: 4, 3: 2, 4: 6}[channels]
+
+    rows = np.ascontiguousarray(array.astype('>u2') if bit_depth == 16 else array)
+    rows = rows.view(np.uint8).reshape(height, -1)
+    filtered = np.empty((height, rows.shape[1] + 1), dtype=np.uint8)
+    filtered[:, 0] = 2
+    filtered[0, 1:] = rows[0]
+    # uint8 arithmetic wraps modulo 256 as the filter requires
+    filtered[1:, 1:] = rows[1:] - rows[:-1]
+
+    header = struct.pack('>IIBBBBB', width, height, bit_depth, color_type, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + png_chunk(b'IHDR', header)
+            + png_chunk(b'IDAT', zlib.compress(filtered.tobytes(), level))
+            + png_chunk(b'IEND', b''))
+
+def write_png(path, array, level=6):
+    '''
+    Encode array and write it to path, return the number of bytes
+    '''
+    data = encode_png(array, level)
+    f = open(path, 'wb')
+    f.write(data)
+    f.close()
+    return len(data)
+
+
+def from_uint(array):
+    '''
+    uint8 or uint16 values as floats in [0, 1]
+    '''
+    return array / float(np.iinfo(array.dtype).max)
+
+
+class ImageWriter(object):
+    '''
+    Run write jobs on threads behind a queue of at most
+    max_pending jobs. A job is a function returning the
+    number of bytes it wrote
+    '''
+    def __init__(self, max_pending=4, threads=2):
+        self.queue = queue.Queue(max_pending)
+        self.lock = threading.Lock()
+        self.error = None
+        self.written = 0
+        self.bytes = 0
+        self.busy_seconds = 0.0
+        self.blocked_seconds = 0.0
+        self.max_depth = 0
+        self.start_time = None
+        self.threads = [threading.Thread(target=self._work) for _ in range(threads)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def _work(self):
+        while True:
+            function, args = self.queue.get()
+            start = time.time()
+            try:
+                written = function(*args)
+            except Exception as error:
+                with self.lock:
+                    if self.error is None:
+                        self.error = error
+            else:
+                with self.lock:
+                    self.written += 1
+                    self.bytes += written or 0
+            with self.lock:
+                self.busy_seconds += time.time() - start
+            self.queue.task_done()
+
+    def _raise(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def submit(self, function, *args):
+        '''
+        Queue function(*args), blocking while the queue is full
+        '''
+        self._raise()
+        if self.start_time is None:
+            self.start_time = time.time()
+        start = time.time()
+        self.queue.put((function, args))
+        self.blocked_seconds += time.time() - start
+        self.max_depth = max(self.max_depth, self.queue.qsize())
+
+    def wait(self):
+        '''
+        Block until every queued job is done, raising the
+        first error of a job
+        '''
+        self.queue.join()
+        self._raise()
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def stats(self):
+        elapsed = time.time() - self.start_time if self.start_time is not None else 0.0
+        with self.lock:
+            return {
+                'queue_depth': self.queue.qsize(),
+                'max_queue_depth': self.max_depth,
+                'written': self.written,
+                'bytes': self.bytes,
+                'busy_seconds': self.busy_seconds,
+                'blocked_seconds': self.blocked_seconds,
+                'images_per_second': self.written / max(elapsed, 1e-9),
+                'megabytes_per_second': self.bytes / 2.0**20 / max(elapsed, 1e-9),
+            }
+
+    def report(self):
+        stats = self.stats()
+        print("image writer: %d written, %.1f MB/s, queue depth %d (max %d), "
+              "render held up %.1f s by a full queue"
+              % (stats['written'], stats['megabytes_per_second'], stats['queue_depth'],
+                 stats['max_queue_depth'], stats['blocked_seconds']))
@@ -0,0 +1,226 @@
+import cProfile
+import json
+import os
+import socket
+import sys
+import time
+from collections import defaultdict
+
+'''
+Per stage timing of haze_generator_new.py as a JSON lines stream
+
+Every stage of a round (deleting the old scene, building the rig,
+creating the cubes and their materials, the buildings, aiming the
+cameras, writing the label and every single render) is timed with
+wall and CPU time, and the number of Blender datablocks after it is
+recorded. Each finished stage is written as one line of JSON to the
+metrics file, e.g.
+
+    {"event": "stage", "stage": "render", "round": 3, "camera": "Camera.001",
+     "wall": 12.71, "cpu": 95.4, "datablocks": {"objects": 530, ...},
+     "new_datablocks": {"objects": 0, ...}, "time": 1700000000.0, "pid": 4711, ...}
+
+The file is opened for appending and written a line at a time, so the
+workers of orchestrator.py can share one. With a profile directory
+every round is also run under cProfile and its statistics are dumped
+to round<k>.pstats (read them with pstats or snakeviz).
+
+Without a metrics file haze_generator_new.py uses NULL_METRICS, whose
+stage() hands back one shared object doing nothing, so the
+instrumentation costs a method call per stage and nothing else.
+
+Usage:
+    blender -b -P haze_generator_new.py -- --metrics metrics.jsonl --profile-rounds pstats/ ...
+    python metrics.py metrics.jsonl
+'''
+
+
+class NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+NULL_STAGE = NullStage()
+
+class NullMetrics(object):
+    '''
+    Metrics that record nothing
+    '''
+    enabled = False
+
+    def stage(self, name, **fields):
+        return NULL_STAGE
+
+    def round(self, round):
+        return NULL_STAGE
+
+    def event(self, name, **fields):
+        pass
+
+    def close(self):
+        pass
+
+NULL_METRICS = NullMetrics()
+
+
+class Stage(object):
+    '''
+    Times one stage and writes its event when it ends
+    '''
+    def __init__(self, metrics, name, fields):
+        self.metrics = metrics
+        self.name = name
+        self.fields = fields
+
+    def __enter__(self):
+        self.before = self.metrics.datablocks()
+        self.wall = time.time()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        wall = time.time() - self.wall
+        cpu = time.process_time() - self.cpu
+        after = self.metrics.datablocks()
+        new = dict((key, after[key] - self.before.get(key, 0)) for key in after)
+        fields = dict(self.fields, stage=self.name, wall=wall, cpu=cpu,
+                      datablocks=after, new_datablocks=new)
+        if kind is not None:
+            fields['error'] = '%s: %s' % (kind.__name__, value)
+        self.metrics.event('stage', **fields)
+        return False
+
+class Round(object):
+    '''
+    Tags the events of one round with its number, writes its total
+    time and, with a profile directory, profiles it
+    '''
+    def __init__(self, metrics, round):
+        self.metrics = metrics
+        self.round = round
+        self.profiler = None
+
+    def __enter__(self):
+        self.metrics.current_round = self.round
+        if self.metrics.profile_directory is not None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        self.wall = time.time()
+        self.cpu = time.process_time()
+        return self
+
+    def __exit__(self, kind, value, traceback):
+        wall = time.time() - self.wall
+        cpu = time.process_time() - self.cpu
+        fields = {'wall': wall, 'cpu': cpu, 'datablocks': self.metrics.datablocks()}
+        if self.profiler is not None:
+            self.profiler.disable()
+            path = os.path.join(self.metrics.profile_directory, 'round%d.pstats' % self.round)
+            self.profiler.dump_stats(path)
+            fields['profile'] = path
+        if kind is not None:
+            fields['error'] = '%s: %s' % (kind.__name__, value)
+        self.metrics.event('round', **fields)
+        self.metrics.current_round = None
+        return False
+
+class Metrics(object):
+    '''
+    Write stage and round events to path as JSON lines.
+    counts is a function returning the datablock counts,
+    {kind: number}; profile_directory turns on cProfile
+    '''
+    enabled = True
+
+    def __init__(self, path, counts=None, profile_directory=None):
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        self.file = open(path, 'a')
+        self.counts = counts
+        self.profile_directory = profile_directory
+        if profile_directory is not None and not os.path.exists(profile_directory):
+            os.makedirs(profile_directory)
+        self.current_round = None
+        self.host = socket.gethostname()
+        self.pid = os.getpid()
+
+    def datablocks(self):
+        return self.counts() if self.counts is not None else {}
+
+    def stage(self, name, **fields):
+        '''
+        Context manager timing the stage name; fields (such as the
+        camera) are added to its event
+        '''
+        return Stage(self, name, fields)
+
+    def round(self, round):
+        return Round(self, round)
+
+    def event(self, name, **fields):
+        '''
+        Write one event line
+        '''
+        fields = dict(fields, event=name, time=time.time(), host=self.host, pid=self.pid)
+        if self.current_round is not None:
+            fields.setdefault('round', self.current_round)
+        # one write per line keeps lines of several processes apart
+        self.file.write(json.dumps(fields, sort_keys=True) + '\n')
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_events(path):
+    '''
+    The events of a metrics file as dicts; a partly written last
+    line is skipped
+    '''
+    events = []
+    f = open(path, 'r')
+    for line in f:
+        try:
+            events.append(json.loads(line))
+        except ValueError:
+            continue
+    f.close()
+    return events
+
+def summarize(events):
+    '''
+    Count, total and mean wall and CPU seconds of every stage
+    '''
+    totals = defaultdict(lambda: [0, 0.0, 0.0])
+    for event in events:
+        if event.get('event') != 'stage':
+            continue
+        total = totals[event['stage']]
+        total[0] += 1
+        total[1] += event['wall']
+        total[2] += event['cpu']
+    return dict((stage, {'count': count, 'wall': wall, 'cpu': cpu, 'mean_wall': wall / count})
+                for stage, (count, wall, cpu) in totals.items())
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1:
+        print("usage: python metrics.py <metrics.jsonl>")
+        return 1
+    events = read_events(argv[0])
+    rounds = [event for event in events if event.get('event') == 'round']
+    print("%d rounds, %.1f s wall in total" % (len(rounds), sum(event['wall'] for event in rounds)))
+    print("%-16s %7s %12s %12s %12s" % ("stage", "count", "wall [s]", "cpu [s]", "mean [s]"))
+    summary = summarize(events)
+    for stage in sorted(summary, key=lambda stage: -summary[stage]['wall']):
+        total = summary[stage]
+        print("%-16s %7d %12.2f %12.2f %12.3f"
+              % (stage, total['count'], total['wall'], total['cpu'], total['mean_wall']))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
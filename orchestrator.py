@@ -0,0 +1,281 @@
+import argparse
+import os
+import queue
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+'''
+Run one haze_generator_new.py job on several background Blender
+processes at once. Does not need Blender's Python, only a blender
+executable on the PATH (or given with --blender).
+
+Every worker is a long running "blender -b -P haze_generator_new.py
+-- --serve" process with its own Cycles thread budget. Rounds are
+handed out one at a time from a shared queue, so a worker that gets
+a slow round simply takes fewer rounds. A worker that crashes is
+restarted and its round goes back in the queue, and so is one that
+prints nothing for --round-timeout seconds (a wedged Blender), or
+whose round raises in the orchestrator itself. Workers wait on the
+queue until every round is done or out of retries, so a round queued
+again can go to any of them.
+
+Usage:
+    python orchestrator.py --workers 8 --threads 8 --rounds 200 -- --output /data/haze --input input_file/same_0.02.txt
+
+Everything after "--" is passed on to haze_generator_new.py.
+'''
+
+GENERATOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'haze_generator_new.py')
+
+
+def parse_round_list(text):
+    '''
+    "0-99,120,130-131" -> [0, 1, ..., 99, 120, 130, 131]
+    '''
+    rounds = []
+    for part in text.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            first, last = part.split('-')
+            rounds.extend(range(int(first), int(last) + 1))
+        else:
+            rounds.append(int(part))
+    return rounds
+
+
+class Orchestrator(object):
+    '''
+    Hand rounds out to a number of Blender processes, each
+    rendering with its own number of Cycles threads
+    '''
+    def __init__(self, rounds, workers, threads, blender='blender',
+                 generator_args=(), retries=2, log_dir=None, round_timeout=None):
+        self.rounds = list(rounds)
+        self.workers = workers
+        self.threads = threads
+        self.blender = blender
+        self.generator_args = list(generator_args)
+        self.retries = retries
+        self.log_dir = log_dir
+        # seconds a worker may stay silent during a round, None: no limit
+        self.round_timeout = round_timeout
+
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        # rounds not done yet and not given up on
+        self.pending = 0
+        self.attempts = {}
+        self.done = {}
+        self.failed = []
+        self.restarts = 0
+        self.start_time = None
+
+    def command(self):
+        return ([self.blender, '-b', '-P', GENERATOR, '--'] + self.generator_args
+                + ['--threads', str(self.threads), '--serve'])
+
+    def images_per_hour(self):
+        elapsed = time.time() - self.start_time
+        return 3600.0 * sum(self.done.values()) / max(elapsed, 1e-9)
+
+    def _spawn(self, slot):
+        '''
+        Start a worker process. Its output is read on a thread into
+        proc.lines, ending with None when the process exits, so
+        _render() can wait on it with a timeout
+        '''
+        log = None
+        if self.log_dir is not None:
+            log = open(os.path.join(self.log_dir, 'worker_%d.log' % slot), 'a')
+        try:
+            proc = subprocess.Popen(self.command(), stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT, universal_newlines=True, bufsize=1)
+        except Exception:
+            if log is not None:
+                log.close()
+            raise
+        proc.lines = queue.Queue()
+        reader = threading.Thread(target=self._read, args=(proc,))
+        reader.daemon = True
+        reader.start()
+        return proc, log
+
+    def _read(self, proc):
+        try:
+            for line in iter(proc.stdout.readline, ''):
+                proc.lines.put(line)
+        except (OSError, ValueError):
+            pass
+        proc.lines.put(None)
+
+    def _stop(self, proc, log, kill=False):
+        if kill and proc.poll() is None:
+            proc.kill()
+        try:
+            proc.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+        proc.wait()
+        if log is not None:
+            log.close()
+
+    def _render(self, proc, log, round):
+        '''
+        Send round to a worker and wait for its answer.
+        Return the number of images written, False if the round
+        failed or None if the worker died or timed out
+        '''
+        try:
+            proc.stdin.write('%d\n' % round)
+            proc.stdin.flush()
+        except (BrokenPipeError, OSError):
+            return None
+        while True:
+            try:
+                line = proc.lines.get(timeout=self.round_timeout)
+            except queue.Empty:
+                print('round %d: no output for %g s, killing its worker' % (round, self.round_timeout))
+                proc.kill()
+                return None
+            if line is None:
+                return None
+            words = line.split()
+            if len(words) >= 2 and words[0] == 'ROUND_DONE' and int(words[1]) == round:
+                return int(words[2]) if len(words) > 2 else 0
+            if len(words) >= 2 and words[0] == 'ROUND_FAILED' and int(words[1]) == round:
+                return False
+            if log is not None:
+                log.write(line)
+
+    def _retry(self, round, reason):
+        with self.lock:
+            self.attempts[round] = self.attempts.get(round, 0) + 1
+            if self.attempts[round] <= self.retries:
+                print('round %d %s, queued again' % (round, reason))
+                self.queue.put(round)
+            else:
+                print('round %d %s, giving up after %d attempts' % (round, reason, self.attempts[round]))
+                self.failed.append(round)
+                self._finish()
+
+    def _finish(self):
+        '''
+        Count one round as settled, with the lock held. After the last
+        one every worker gets a None to stop on
+        '''
+        self.pending -= 1
+        if self.pending == 0:
+            for _ in range(self.workers):
+                self.queue.put(None)
+
+    def _worker(self, slot):
+        proc = None
+        log = None
+        while True:
+            # blocks while other workers may still queue a round again
+            round = self.queue.get()
+            if round is None:
+                break
+            try:
+                if proc is None:
+                    proc, log = self._spawn(slot)
+                result = self._render(proc, log, round)
+            except Exception as error:
+                # settle the round anyway, or run() would wait for it forever
+                if proc is not None:
+                    self._stop(proc, log, kill=True)
+                    proc = None
+                self._retry(round, 'raised %r on worker %d' % (error, slot))
+                continue
+            if result is None:
+                self._stop(proc, log, kill=True)
+                proc = None
+                with self.lock:
+                    self.restarts += 1
+                self._retry(round, 'crashed worker %d' % slot)
+            elif result is False:
+                self._retry(round, 'failed on worker %d' % slot)
+            else:
+                with self.lock:
+                    self.done[round] = result
+                    print('round %d done by worker %d: %d images, %d/%d rounds, %.0f images/hour'
+                          % (round, slot, result, len(self.done), len(self.rounds), self.images_per_hour()))
+                    self._finish()
+        if proc is not None:
+            self._stop(proc, log)
+
+    def run(self):
+        '''
+        Render every round and return a summary dict
+        '''
+        if shutil.which(self.blender) is None:
+            raise RuntimeError("blender executable not found: %s" % self.blender)
+        if self.log_dir is not None and not os.path.exists(self.log_dir):
+            os.makedirs(self.log_dir)
+        self.pending = len(self.rounds)
+        for round in self.rounds:
+            self.queue.put(round)
+        if not self.rounds:
+            for _ in range(self.workers):
+                self.queue.put(None)
+        self.start_time = time.time()
+        threads = [threading.Thread(target=self._worker, args=(slot,))
+                   for slot in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - self.start_time
+        summary = {
+            'rounds_done': len(self.done),
+            'rounds_failed': sorted(self.failed),
+            'images': sum(self.done.values()),
+            'seconds': elapsed,
+            'images_per_hour': self.images_per_hour(),
+            'worker_restarts': self.restarts,
+        }
+        print('%d/%d rounds, %d images in %.1f s (%.0f images/hour), %d worker restarts, failed rounds: %s'
+              % (summary['rounds_done'], len(self.rounds), summary['images'], elapsed,
+                 summary['images_per_hour'], self.restarts, summary['rounds_failed'] or 'none'))
+        return summary
+
+
+def main(argv=None):
+    if argv is None:
+        argv = sys.argv[1:]
+    generator_args = []
+    if '--' in argv:
+        generator_args = argv[argv.index('--') + 1:]
+        argv = argv[:argv.index('--')]
+    parser = argparse.ArgumentParser(description="Run haze_generator_new.py on several Blender processes")
+    parser.add_argument('--blender', default='blender', help="blender executable")
+    parser.add_argument('--workers', type=int, default=1, help="number of Blender processes")
+    parser.add_argument('--threads', type=int, default=0,
+                        help="Cycles threads per process, default: cores / workers")
+    parser.add_argument('--rounds', type=int, default=15, help="number of rounds")
+    parser.add_argument('--first-round', type=int, default=0)
+    parser.add_argument('--round-list', help="explicit rounds like 0-99,120 instead of --rounds")
+    parser.add_argument('--retries', type=int, default=2, help="times a failed round is queued again")
+    parser.add_argument('--log-dir', help="write each worker's Blender output to <log-dir>/worker_<k>.log")
+    parser.add_argument('--round-timeout', type=float, default=None,
+                        help="restart a worker that prints nothing for this many seconds during a round")
+    args = parser.parse_args(argv)
+
+    if args.round_list:
+        rounds = parse_round_list(args.round_list)
+    else:
+        rounds = range(args.first_round, args.first_round + args.rounds)
+    threads = args.threads or max(1, (os.cpu_count() or 1) // args.workers)
+    orchestrator = Orchestrator(rounds, args.workers, threads, args.blender,
+                                generator_args, args.retries, args.log_dir, args.round_timeout)
+    summary = orchestrator.run()
+    return 1 if summary['rounds_failed'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,198 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+'''
+Content addressed cache of camera renders
+
+Every render is stored under the sha256 of a description of
+everything that decides its pixels: voxel densities, buildings,
+camera pose, render settings and seed. A re-queued or repeated round
+whose description hashes to a stored key gets the stored files linked
+(or copied, where the file system has no hard links) into its output
+tree instead of being rendered again. Since a linked output shares
+its file with the cache, remove an output file before writing a new
+one in its place rather than overwriting it.
+
+The cache directory holds one directory per key,
+<cache>/<first two hex digits>/<key>/, with the files of that render.
+Entries are written to a temporary directory and renamed into place,
+so workers sharing a cache never see half written entries. When the
+cache grows past its size limit the least recently used entries (by
+directory mtime, refreshed on every hit) are deleted until it is back
+under LOW_WATER of the limit. The size is
+kept as a running total of what this process stored since its last
+scan of the directory, so only a store that takes the total past the
+limit, or every RESCAN_STORES stores to see what other workers
+stored, walks the cache. An entry evicted by another worker while it
+is being fetched counts as a miss.
+
+Usage:
+    cache = RenderCache('/data/render_cache', max_bytes=50 * 2**30)
+    key = scene_hash(description)
+    if not cache.fetch(key, {'image': image_path, 'depth': depth_path}):
+        ... render to image_path and depth_path ...
+        cache.store(key, {'image': image_path, 'depth': depth_path})
+'''
+
+# stores between two scans of the cache size
+RESCAN_STORES = 100
+# fraction of max_bytes an eviction leaves, so the next stores fit
+LOW_WATER = 0.9
+
+
+def canonical(value):
+    '''
+    JSON compatible form of value with numpy arrays replaced
+    by the digest of their dtype, shape and bytes
+    '''
+    if isinstance(value, np.ndarray):
+        array = np.ascontiguousarray(value)
+        digest = hashlib.sha256(array.tobytes()).hexdigest()
+        return {'dtype': str(array.dtype), 'shape': list(array.shape), 'sha256': digest}
+    if isinstance(value, dict):
+        return dict((str(k), canonical(v)) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return [canonical(v) for v in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+def scene_hash(description):
+    '''
+    sha256 hex digest of a scene description (nested dicts, lists,
+    numbers, strings and numpy arrays). Key order does not matter
+    '''
+    text = json.dumps(canonical(description), sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+def link_or_copy(source, target):
+    if os.path.exists(target):
+        os.remove(target)
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+class RenderCache(object):
+    '''
+    Directory of renders keyed by scene_hash(), at most
+    max_bytes big (None for no limit)
+    '''
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # bytes in the cache at the last scan plus those stored since,
+        # None before the first scan
+        self.total = None
+        self.stores = 0
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def fetch(self, key, targets):
+        '''
+        Link the files stored under key to targets, a dict of
+        name -> output path. Return False on a miss
+        '''
+        entry = self.path(key)
+        if not all(os.path.exists(os.path.join(entry, name)) for name in targets):
+            self.misses += 1
+            return False
+        try:
+            for name, target in targets.items():
+                link_or_copy(os.path.join(entry, name), target)
+        except OSError:
+            # evicted by another worker meanwhile
+            for target in targets.values():
+                if os.path.exists(target):
+                    os.remove(target)
+            self.misses += 1
+            return False
+        try:
+            os.utime(entry, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return True
+
+    def store(self, key, sources):
+        '''
+        Store the rendered files, a dict of name -> path, under key
+        '''
+        entry = self.path(key)
+        if os.path.exists(entry):
+            return
+        parent = os.path.dirname(entry)
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+        staging = tempfile.mkdtemp(prefix='.' + key[:8], dir=parent)
+        size = 0
+        for name, source in sources.items():
+            # a copy, so that rewriting the output later leaves the cache alone
+            shutil.copy2(source, os.path.join(staging, name))
+            size += os.path.getsize(source)
+        try:
+            os.rename(staging, entry)
+        except OSError:
+            # another worker stored the same render first
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+        if self.max_bytes is None:
+            return
+        self.stores += 1
+        if self.total is not None:
+            self.total += size
+        if self.total is None or self.total > self.max_bytes or self.stores >= RESCAN_STORES:
+            self.evict(int(self.max_bytes * LOW_WATER))
+
+    def entries(self):
+        '''
+        Return (mtime, bytes, path) of every entry
+        '''
+        result = []
+        for prefix in os.listdir(self.directory):
+            parent = os.path.join(self.directory, prefix)
+            if not os.path.isdir(parent):
+                continue
+            for key in os.listdir(parent):
+                entry = os.path.join(parent, key)
+                if key.startswith('.') or not os.path.isdir(entry):
+                    continue
+                try:
+                    size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+                    result.append((os.path.getmtime(entry), size, entry))
+                except OSError:
+                    # evicted by another worker meanwhile
+                    continue
+        return result
+
+    def evict(self, max_bytes):
+        '''
+        Delete least recently used entries until the cache
+        holds at most max_bytes. Return the number deleted
+        '''
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        deleted = 0
+        for _, size, entry in entries:
+            if total <= max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+            deleted += 1
+        self.total = total
+        self.stores = 0
+        return deleted
+
+    def report(self):
+        print("render cache: %d hits, %d misses" % (self.hits, self.misses))
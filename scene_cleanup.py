@@ -0,0 +1,107 @@
+import bpy
+
+'''
+Remove what earlier rounds left behind in bpy.data
+
+Deleting objects does not delete their data: the materials of voxels
+and buildings, camera and lamp data, density images and compositor
+nodes stay in bpy.data with no users, so a long job keeps growing and
+every round walks longer lists. An OrphanCollector notes which
+datablocks and compositor nodes exist when the job starts, and after
+every round removes those the job made that nothing uses any more.
+Datablocks from before the job, ones with a fake user and the ones
+passed as keep (the shared materials of the MaterialCache) are left
+alone, and so are the images Blender renders into ("Render Result"
+and "Viewer Node", which viewer_pixels() reads): they never have
+users, and are only made once the first round renders.
+
+Usage:
+    collector = OrphanCollector()
+    for round in rounds:
+        run(...)
+        before, after = collector.collect(keep=material_cache.materials.values())
+        collector.report(before, after)
+'''
+
+# meshes go first, removing them frees their materials, and materials
+# before images, which they may use through a texture node
+KINDS = ('meshes', 'cameras', 'lamps', 'materials', 'images')
+# images Blender owns and renders into, never removed
+RENDER_IMAGE_TYPES = ('RENDER_RESULT', 'COMPOSITING')
+
+
+def compositor_links(tree):
+    '''
+    Pointers of the nodes with at least one link
+    '''
+    linked = set()
+    for link in tree.links:
+        linked.add(link.from_node.as_pointer())
+        linked.add(link.to_node.as_pointer())
+    return linked
+
+def datablock_counts():
+    '''
+    Number of datablocks of each kind and of compositor nodes
+    '''
+    data = bpy.data
+    counts = {'objects': len(data.objects), 'meshes': len(data.meshes), 'materials': len(data.materials),
+              'cameras': len(data.cameras), 'lamps': len(data.lamps), 'images': len(data.images)}
+    tree = bpy.context.scene.node_tree
+    counts['compositor_nodes'] = len(tree.nodes) if tree is not None else 0
+    return counts
+
+
+class OrphanCollector(object):
+    '''
+    Remove datablocks and compositor nodes made after it was
+    created once nothing uses them
+    '''
+    def __init__(self, kinds=KINDS):
+        self.kinds = kinds
+        self.baseline = dict((kind, set(item.as_pointer() for item in getattr(bpy.data, kind)))
+                             for kind in kinds)
+        tree = bpy.context.scene.node_tree
+        self.baseline_nodes = set(node.as_pointer() for node in tree.nodes) if tree is not None else set()
+        self.removed = dict((kind, 0) for kind in kinds + ('compositor_nodes',))
+
+    def orphans(self, kind, keep=()):
+        '''
+        Datablocks of kind made by the job that have no users
+        '''
+        kept = self.baseline[kind] | set(item.as_pointer() for item in keep)
+        return [item for item in getattr(bpy.data, kind)
+                if item.users == 0 and not item.use_fake_user and item.as_pointer() not in kept
+                and (kind != 'images' or item.type not in RENDER_IMAGE_TYPES)]
+
+    def collect_nodes(self):
+        '''
+        Remove compositor nodes made by the job that are not linked
+        '''
+        tree = bpy.context.scene.node_tree
+        if tree is None:
+            return 0
+        linked = compositor_links(tree)
+        unused = [node for node in tree.nodes
+                  if node.as_pointer() not in linked and node.as_pointer() not in self.baseline_nodes]
+        for node in unused:
+            tree.nodes.remove(node)
+        return len(unused)
+
+    def collect(self, keep=()):
+        '''
+        Remove the orphans, return the datablock counts before and after
+        '''
+        keep = list(keep)
+        before = datablock_counts()
+        for kind in self.kinds:
+            collection = getattr(bpy.data, kind)
+            for item in self.orphans(kind, keep):
+                collection.remove(item)
+                self.removed[kind] += 1
+        self.removed['compositor_nodes'] += self.collect_nodes()
+        return before, datablock_counts()
+
+    def report(self, before, after):
+        print('Cleanup: ' + ', '.join('%s %d -> %d' % (kind.replace('_', ' '), before[kind], after[kind])
+                                      for kind in sorted(before)))
@@ -0,0 +1,180 @@
+import argparse
+import random
+import sys
+import time
+from math import cos, floor, pi, sin, sqrt
+from collections import namedtuple
+import numpy as np
+
+'''
+Place non overlapping circular building footprints inside a disk
+
+Bridson's Poisson-disk sampling with variable radii: every accepted
+footprint is "active" and new candidates are tried in an annulus
+around it until attempts candidates in a row fail, after which it is
+retired. Overlap tests only look at the neighbouring cells of a hash
+grid whose cells are as wide as the largest footprint, so filling the
+disk takes time linear in the number of footprints instead of testing
+every pair, and the number of tries is bounded. Layouts well below
+the capacity of the disk are placed by plain dart throwing on the
+same grid, which is faster and just as uniform.
+
+No Blender needed, create_scene() in haze_generator_new.py uses it
+through place_buildings().
+
+Usage:
+    python scene_layout.py --region 10 --radius 0.4 0.6 --count 1000
+'''
+
+# a footprint is a circle (x, y, radius)
+Layout = namedtuple('Layout', ['footprints', 'complete'])
+
+
+class FootprintGrid(object):
+    '''
+    Spatial hash of footprints, cell size at least twice the
+    largest radius so that overlaps are always in adjacent cells
+    '''
+    def __init__(self, cell):
+        self.cell = float(cell)
+        self.cells = {}
+
+    def key(self, x, y):
+        return int(floor(x / self.cell)), int(floor(y / self.cell))
+
+    def add(self, footprint):
+        self.cells.setdefault(self.key(footprint[0], footprint[1]), []).append(footprint)
+
+    def overlaps(self, x, y, radius, gap=0.0):
+        i, j = self.key(x, y)
+        for di in (-1, 0, 1):
+            for dj in (-1, 0, 1):
+                for fx, fy, fr in self.cells.get((i + di, j + dj), ()):
+                    if (fx - x) ** 2 + (fy - y) ** 2 < (fr + radius + gap) ** 2:
+                        return True
+        return False
+
+
+def poisson_disk(region, min_radius, max_radius, attempts=30, gap=0.0, rng=None):
+    '''
+    Fill a disk of radius region around the origin with footprints
+    of radius uniform in [min_radius, max_radius], each lying entirely
+    inside the disk and at least gap away from every other one.
+    Return the list of (x, y, radius)
+    '''
+    if rng is None:
+        rng = random.Random()
+    if not 0 < min_radius <= max_radius:
+        raise ValueError("need 0 < min_radius <= max_radius, got %g and %g" % (min_radius, max_radius))
+    if max_radius > region:
+        return []
+    grid = FootprintGrid(2 * max_radius + gap)
+    footprints = []
+    active = []
+
+    def accept(footprint):
+        grid.add(footprint)
+        footprints.append(footprint)
+        active.append(footprint)
+
+    # first footprint uniform over the disk its center may lie in
+    radius = rng.uniform(min_radius, max_radius)
+    r = (region - radius) * sqrt(rng.random())
+    theta = rng.uniform(0, 2 * pi)
+    accept((r * cos(theta), r * sin(theta), radius))
+
+    while active:
+        k = rng.randrange(len(active))
+        x, y, parent_radius = active[k]
+        for _ in range(attempts):
+            radius = rng.uniform(min_radius, max_radius)
+            closest = parent_radius + radius + gap
+            distance = rng.uniform(closest, 2 * closest)
+            theta = rng.uniform(0, 2 * pi)
+            cx = x + distance * cos(theta)
+            cy = y + distance * sin(theta)
+            if cx ** 2 + cy ** 2 > (region - radius) ** 2:
+                continue
+            if not grid.overlaps(cx, cy, radius, gap):
+                accept((cx, cy, radius))
+                break
+        else:
+            # no room left around this footprint
+            active[k] = active[-1]
+            active.pop()
+    return footprints
+
+def dart_throw(region, count, min_radius, max_radius, attempts=30, gap=0.0, rng=None):
+    '''
+    Up to count footprints at uniformly random positions, rejecting
+    the ones that overlap, with at most attempts * count tries.
+    Cheaper than poisson_disk() when count is well below what fits
+    '''
+    if rng is None:
+        rng = random.Random()
+    grid = FootprintGrid(2 * max_radius + gap)
+    footprints = []
+    for _ in range(attempts * count):
+        if len(footprints) == count:
+            break
+        radius = rng.uniform(min_radius, max_radius)
+        r = (region - radius) * sqrt(rng.random())
+        theta = rng.uniform(0, 2 * pi)
+        x, y = r * cos(theta), r * sin(theta)
+        if not grid.overlaps(x, y, radius, gap):
+            grid.add((x, y, radius))
+            footprints.append((x, y, radius))
+    return footprints
+
+def place_footprints(region, count, min_radius, max_radius, attempts=30, gap=0.0, seed=None):
+    '''
+    Pick count non overlapping footprints spread over the whole disk.
+    Sparse layouts come from dart_throw(); when that runs out of
+    attempts the disk is filled by poisson_disk() and count of them
+    are chosen at random. Returns Layout(footprints, complete);
+    complete is False when fewer than count fit, footprints then
+    holds all there are
+    '''
+    rng = seed if isinstance(seed, random.Random) else random.Random(seed)
+    if max_radius > region:
+        return Layout([], count == 0)
+    footprints = dart_throw(region, count, min_radius, max_radius, attempts, gap, rng)
+    if len(footprints) == count:
+        return Layout(footprints, True)
+    candidates = poisson_disk(region, min_radius, max_radius, attempts, gap, rng)
+    if len(candidates) < count:
+        return Layout(candidates, False)
+    return Layout(rng.sample(candidates, count), True)
+
+
+def overlapping_pairs(footprints, gap=0.0):
+    '''
+    Brute force count of overlapping pairs, for checking a layout
+    '''
+    a = np.asarray(footprints, dtype=float).reshape(-1, 3)
+    d2 = (a[:, None, 0] - a[None, :, 0]) ** 2 + (a[:, None, 1] - a[None, :, 1]) ** 2
+    reach = (a[:, None, 2] + a[None, :, 2] + gap) ** 2
+    return int(np.triu(d2 < reach - 1e-9, 1).sum())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Poisson-disk building footprints in a disk")
+    parser.add_argument('--region', type=float, default=10.0, help="radius of the disk")
+    parser.add_argument('--radius', type=float, nargs=2, default=[0.4, 0.6], metavar=('MIN', 'MAX'))
+    parser.add_argument('--count', type=int, default=100)
+    parser.add_argument('--attempts', type=int, default=30)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args(argv)
+
+    start = time.time()
+    layout = place_footprints(args.region, args.count, args.radius[0], args.radius[1],
+                              args.attempts, seed=args.seed)
+    elapsed = time.time() - start
+    print("%d/%d footprints in %.3f s, complete: %s, overlapping pairs: %d"
+          % (len(layout.footprints), args.count, elapsed, layout.complete,
+             overlapping_pairs(layout.footprints)))
+    return 0 if layout.complete else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,348 @@
+import argparse
+import glob
+import io
+import json
+import os
+import shutil
+import sys
+import tarfile
+import time
+import numpy as np
+from camera_rig import load_rig
+from haze_io import read_label
+
+'''
+Pack rendered rounds into tar shards instead of thousands of small files
+
+Writing every image, depth map and label as its own file on the SMB
+share costs a network round trip per file. With the archive output of
+haze_generator_new.py a round is rendered to a local staging
+directory, packed into an append-only tar shard there and deleted;
+whole shards are copied to the destination once they reach their size
+limit (and when the job ends).
+
+Shards follow the WebDataset layout: one sample per camera view, its
+files named <key>.<ext> and stored next to each other:
+
+    <key>.png               hazy image (or the extension Blender wrote)
+    <key>.depth.png         mist depth map of the same view
+    <key>.transmission.npy  transmission map of the view, if written
+    <key>.<size>.png        size x size pyramid level of the image, if written
+    <key>.<size>.depth.png  same level of the depth map (see image_pyramid.py)
+    <key>.label.npy         label record of the image set (see haze_io.write_label)
+    <key>.camera.json       pose, intrinsics and mist range of this camera
+
+with key = <round>_<scene mode><image set>_<camera>, dots replaced by
+dashes. camera.json holds the round, image set and camera name, the
+location, matrix_world and look_at of the label, and from camera.npz
+K, R, t (see camera_rig.py), image_size, the (width, height) K is
+for, and mist, the (start, depth) of the depth map, so a shard alone
+gives poses and metric depth (ShardReader.rig()). Every shard <name>.tar has an index <name>.tar.idx with one
+JSON line per sample giving the offset and size of each of its files,
+so ShardReader reads one sample without unpacking the shard. A shard
+is named after its first sample, which is unique within a job.
+
+The index line of a sample is written after its data, so a shard left
+behind by a killed worker can be closed up to its last complete sample
+and copied to the destination with
+    python shard_writer.py recover <staging directory> <destination>
+
+Usage:
+    python shard_writer.py list /data/haze/000012_moderate0_Camera.tar
+    python shard_writer.py extract /data/haze/000012_moderate0_Camera.tar 000012_moderate0_Camera-001 out/
+'''
+
+BLOCK = tarfile.BLOCKSIZE
+# arrays of camera.npz copied into camera.json: one per camera, and
+# one for the whole round
+CAMERA_FIELDS = ('K', 'R', 't', 'matrix_world')
+ROUND_FIELDS = ('image_size', 'mist')
+
+
+def index_path(shard):
+    return shard + '.idx'
+
+def read_index(shard):
+    '''
+    Return {key: {ext: (offset, size)}} of a shard, in sample order
+    '''
+    samples = {}
+    f = open(index_path(shard), 'r')
+    for line in f:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            entry = json.loads(line)
+        except ValueError:
+            # last line of a shard whose worker was killed
+            break
+        samples[entry['key']] = dict((ext, tuple(span)) for ext, span in entry['files'].items())
+    f.close()
+    return samples
+
+def copy_atomic(source, target):
+    '''
+    Copy source to target through a temporary name, so readers of the
+    destination never see a partly copied file
+    '''
+    partial = target + '.part'
+    shutil.copyfile(source, partial)
+    os.replace(partial, target)
+
+
+class ShardWriter(object):
+    '''
+    Append samples to tar shards in staging and move every shard
+    to destination once it holds max_bytes
+    '''
+    def __init__(self, destination, staging, max_bytes=1 << 30):
+        self.destination = destination
+        self.staging = staging
+        self.max_bytes = max_bytes
+        self.file = None
+        self.tar = None
+        self.index = None
+        self.path = None
+        self.shards = 0
+        for directory in (destination, staging):
+            if not os.path.exists(directory):
+                os.makedirs(directory)
+
+    def _open(self, key):
+        self.path = os.path.join(self.staging, key + '.tar')
+        self.file = open(self.path, 'wb')
+        self.tar = tarfile.open(fileobj=self.file, mode='w', format=tarfile.PAX_FORMAT)
+        self.index = open(index_path(self.path), 'w')
+
+    def write(self, key, files):
+        '''
+        Append one sample, files being a dict of extension -> bytes
+        '''
+        if self.tar is None:
+            self._open(key)
+        spans = {}
+        now = int(time.time())
+        for ext, data in files.items():
+            info = tarfile.TarInfo('%s.%s' % (key, ext))
+            info.size = len(data)
+            info.mtime = now
+            self.tar.addfile(info, io.BytesIO(data))
+            # addfile works on a copy of info, the data ends where the
+            # archive now ends less the padding to a whole block
+            padded = (info.size + BLOCK - 1) // BLOCK * BLOCK
+            spans[ext] = [self.tar.offset - padded, info.size]
+        self.file.flush()
+        self.index.write(json.dumps({'key': key, 'files': spans}) + '\n')
+        self.index.flush()
+        if self.file.tell() >= self.max_bytes:
+            self.flush()
+
+    def flush(self):
+        '''
+        Close the current shard and move it to the destination
+        '''
+        if self.tar is None:
+            return
+        self.tar.close()
+        self.file.close()
+        self.index.close()
+        name = os.path.basename(self.path)
+        copy_atomic(self.path, os.path.join(self.destination, name))
+        copy_atomic(index_path(self.path), os.path.join(self.destination, name + '.idx'))
+        os.remove(self.path)
+        os.remove(index_path(self.path))
+        self.tar = None
+        self.shards += 1
+        print("wrote shard %s" % os.path.join(self.destination, name))
+
+    def close(self):
+        self.flush()
+
+
+class ShardReader(object):
+    '''
+    Read single samples of a shard through its index
+    '''
+    def __init__(self, shard):
+        self.shard = shard
+        self.samples = read_index(shard)
+
+    def keys(self):
+        return list(self.samples)
+
+    def read(self, key, ext, length=None):
+        '''
+        The bytes of one file of a sample, or its first length bytes
+        '''
+        offset, size = self.samples[key][ext]
+        f = open(self.shard, 'rb')
+        f.seek(offset)
+        data = f.read(size if length is None else min(size, length))
+        f.close()
+        return data
+
+    def sample(self, key):
+        '''
+        Return {ext: bytes} of one sample
+        '''
+        return dict((ext, self.read(key, ext)) for ext in self.samples[key])
+
+    def label(self, key):
+        return np.load(io.BytesIO(self.read(key, 'label.npy')))
+
+    def camera(self, key):
+        return json.loads(self.read(key, 'camera.json').decode('utf-8'))
+
+    def rig(self, key):
+        '''
+        K, R, t, matrix_world, image_size and, if recorded, mist of
+        the camera of a sample as arrays
+        '''
+        camera = self.camera(key)
+        if 'K' not in camera:
+            raise ValueError("%s: sample %s was packed without its intrinsics" % (self.shard, key))
+        return dict((name, np.array(camera[name])) for name in CAMERA_FIELDS + ROUND_FIELDS
+                    if name in camera)
+
+
+def read_file(path):
+    f = open(path, 'rb')
+    data = f.read()
+    f.close()
+    return data
+
+def pack_round(writer, round, round_directory):
+    '''
+    Append the views of a round rendered by haze_generator_new.run()
+    to writer and delete the round directory.
+    Return the number of images (hazy images and depth maps) packed
+    '''
+    images = 0
+    rig_path = os.path.join(round_directory, 'camera.npz')
+    rig = load_rig(rig_path) if os.path.exists(rig_path) else None
+    rig_names = [str(name) for name in rig['names']] if rig is not None else []
+    pyramid = sorted((int(name[len('pyramid_'):]), os.path.join(round_directory, name))
+                     for name in os.listdir(round_directory) if name.startswith('pyramid_'))
+    for set_name in sorted(os.listdir(round_directory)):
+        set_directory = os.path.join(round_directory, set_name)
+        if not set_name.startswith('image_set_') or not os.path.isdir(set_directory):
+            continue
+        suffix = set_name[len('image_set_'):]
+        depth_directory = os.path.join(round_directory, 'depth_set_' + suffix)
+        transmission_directory = os.path.join(round_directory, 'transmission_set_' + suffix)
+        labels = glob.glob(os.path.join(set_directory, 'label*.npy'))
+        label_data = read_file(labels[0]) if labels else None
+        label = read_label(labels[0], mmap_mode=None) if labels else None
+        for name in sorted(os.listdir(set_directory)):
+            camera, ext = os.path.splitext(name)
+            if name.startswith('label') or not ext:
+                continue
+            ext = ext[1:].lower()
+            files = {ext: read_file(os.path.join(set_directory, name))}
+            images += 1
+            depth = os.path.join(depth_directory, name)
+            if os.path.exists(depth):
+                files['depth.' + ext] = read_file(depth)
+                images += 1
+            transmission = os.path.join(transmission_directory, camera + '.npy')
+            if os.path.exists(transmission):
+                files['transmission.npy'] = read_file(transmission)
+            for size, pyramid_directory in pyramid:
+                for member, directory in (('%d.%s', set_name), ('%d.depth.%s', 'depth_set_' + suffix)):
+                    path = os.path.join(pyramid_directory, directory, name)
+                    if os.path.exists(path):
+                        files[member % (size, ext)] = read_file(path)
+                        images += 1
+            pose = {'round': round, 'image_set': suffix, 'camera': camera}
+            if label is not None:
+                files['label.npy'] = label_data
+                names = list(label['camera_names'])
+                if camera in names:
+                    k = names.index(camera)
+                    pose.update({'location': label['camera_location'][k].tolist(),
+                                 'matrix_world': label['camera_matrix_world'][k].tolist(),
+                                 'look_at': label['look_at'].tolist()})
+            if camera in rig_names:
+                k = rig_names.index(camera)
+                pose.update((field, rig[field][k].tolist()) for field in CAMERA_FIELDS)
+                pose.update((field, rig[field].tolist()) for field in ROUND_FIELDS if field in rig)
+            if len(pose) > 3:
+                files['camera.json'] = json.dumps(pose).encode('utf-8')
+            writer.write('%06d_%s_%s' % (round, suffix, camera.replace('.', '-')), files)
+    shutil.rmtree(round_directory)
+    return images
+
+
+def recover(staging, destination):
+    '''
+    Close the shards a killed worker left in staging after their last
+    complete sample and move them to destination
+    '''
+    recovered = 0
+    for path in sorted(glob.glob(os.path.join(staging, '*.tar'))):
+        samples = read_index(path) if os.path.exists(index_path(path)) else {}
+        if not samples:
+            os.remove(path)
+            if os.path.exists(index_path(path)):
+                os.remove(index_path(path))
+            continue
+        end = max(offset + size for files in samples.values() for offset, size in files.values())
+        end = (end + BLOCK - 1) // BLOCK * BLOCK
+        f = open(path, 'r+b')
+        f.truncate(end)
+        f.seek(end)
+        # end of archive marker
+        f.write(b'\0' * 2 * BLOCK)
+        f.close()
+        # rewrite the index without a partly written last line
+        f = open(index_path(path), 'w')
+        for key, files in samples.items():
+            f.write(json.dumps({'key': key, 'files': dict((ext, list(span)) for ext, span in files.items())}) + '\n')
+        f.close()
+        name = os.path.basename(path)
+        copy_atomic(path, os.path.join(destination, name))
+        copy_atomic(index_path(path), os.path.join(destination, name + '.idx'))
+        os.remove(path)
+        os.remove(index_path(path))
+        print("recovered %d samples of %s" % (len(samples), name))
+        recovered += 1
+    return recovered
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect and recover haze output shards")
+    commands = parser.add_subparsers(dest='command')
+    lister = commands.add_parser('list', help="print the samples of a shard")
+    lister.add_argument('shard')
+    extractor = commands.add_parser('extract', help="write the files of one sample to a directory")
+    extractor.add_argument('shard')
+    extractor.add_argument('key')
+    extractor.add_argument('directory')
+    recoverer = commands.add_parser('recover', help="move shards left in a staging directory to the destination")
+    recoverer.add_argument('staging')
+    recoverer.add_argument('destination')
+    args = parser.parse_args(argv)
+
+    if args.command == 'list':
+        reader = ShardReader(args.shard)
+        for key in reader.keys():
+            print("%s %s" % (key, " ".join(sorted(reader.samples[key]))))
+    elif args.command == 'extract':
+        reader = ShardReader(args.shard)
+        if not os.path.exists(args.directory):
+            os.makedirs(args.directory)
+        for ext, data in reader.sample(args.key).items():
+            f = open(os.path.join(args.directory, '%s.%s' % (args.key, ext)), 'wb')
+            f.write(data)
+            f.close()
+    elif args.command == 'recover':
+        recover(args.staging, args.destination)
+    else:
+        parser.print_help()
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,52 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+# the modules live in the repository root and the Blender stand-in in
+# benchmarks/, neither is an installed package
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'benchmarks')]
+
+from camera_rig import export_rig, intrinsics, look_at, pose_matrices, ring
+from haze_io import write_label
+from image_writer import linear_to_srgb, to_uint, write_png
+
+
+def write_round(round_directory, size=(32, 24), cameras=('Camera', 'Camera.001'), mist=(0.0, 40.0),
+                density_shape=(2, 3, 4), seed=0):
+    '''
+    A round in the layout of haze_generator_new.run(): camera.npz, and
+    an image set with a hazy image, a mist depth map and a label for
+    every camera. Returns the arrays written
+    '''
+    rng = np.random.RandomState(seed)
+    width, height = size
+    positions = ring(20.0, 5.0, len(cameras))
+    matrix_world = pose_matrices(positions, look_at(positions, (0.0, 0.0, 2.0)))
+    K = intrinsics(width, height, 35.0, 32.0)
+    os.makedirs(round_directory)
+    export_rig(os.path.join(round_directory, 'camera.npz'), list(cameras), matrix_world, K, size, mist)
+    image_set = os.path.join(round_directory, 'image_set_moderate0')
+    depth_set = os.path.join(round_directory, 'depth_set_moderate0')
+    os.makedirs(image_set)
+    os.makedirs(depth_set)
+    density = rng.uniform(0.0, 1.0, density_shape)
+    write_label(image_set, 0, density, {'names': list(cameras), 'location': positions,
+                                        'matrix_world': matrix_world, 'look_at': [0.0, 0.0, 2.0]})
+    images = {}
+    depths = {}
+    for name in cameras:
+        image = rng.randint(0, 256, (height, width, 3)).astype(np.uint8)
+        # whole steps of the 8 bit sRGB mist values, exact once read back
+        mist_values = to_uint(linear_to_srgb(rng.uniform(0.05, 1.0, (height, width))), 8)
+        write_png(os.path.join(image_set, name + '.png'), image)
+        write_png(os.path.join(depth_set, name + '.png'), np.repeat(mist_values[:, :, np.newaxis], 3, axis=2))
+        images[name] = image
+        depths[name] = mist_values
+    return {'images': images, 'mist_values': depths, 'density': density, 'K': K, 'matrix_world': matrix_world}
+
+
+@pytest.fixture
+def round_writer():
+    return write_round
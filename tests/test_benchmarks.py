@@ -0,0 +1,32 @@
+import json
+import os
+import subprocess
+import sys
+
+'''
+Smoke test of the scene construction benchmark in its --quick
+configuration. It runs in its own interpreter, since it sets globals
+of haze_generator_new.py for the whole process
+'''
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks',
+                      'bench_scene_construction.py')
+
+
+def test_quick_scene_construction_runs(tmp_path):
+    rows = str(tmp_path / 'rows.json')
+    result = subprocess.run([sys.executable, SCRIPT, '--quick', '--json', rows],
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True,
+                            timeout=300)
+    assert result.returncode == 0, result.stdout
+    assert 'grid sweep, batch geometry' in result.stdout
+    assert 'building sweep, ops geometry' in result.stdout
+    f = open(rows)
+    results = json.load(f)
+    f.close()
+    for geometry in ('batch', 'ops'):
+        grid = [row for row in results if row['sweep'] == 'grid' and row['geometry'] == geometry]
+        buildings = [row for row in results if row['sweep'] == 'buildings' and row['geometry'] == geometry]
+        assert [row['size'] for row in grid] == [1, 8, 64, 512]
+        assert [row['size'] for row in buildings] == [1, 10, 100]
+        assert all(row['seconds'] >= 0 for row in grid + buildings)
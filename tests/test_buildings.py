@@ -0,0 +1,33 @@
+import pytest
+import blender_standin
+blender_standin.install()
+import haze_generator_new as generator
+from scene_layout import Layout, place_footprints
+
+'''
+Buildings of create_scene() and update_scene(), run with the Blender
+stand-in of benchmarks/blender_standin.py
+'''
+
+
+@pytest.mark.parametrize('batch', [True, False])
+def test_update_places_as_many_buildings_as_created(monkeypatch, batch):
+    blender_standin.reset()
+    calls = []
+
+    def footprints(region, count, min_radius, max_radius, **kwargs):
+        calls.append((count, max_radius))
+        layout = place_footprints(region, count, min_radius, max_radius, **kwargs)
+        # the first layout only fits 2 of them
+        return Layout(layout.footprints[:2], False) if len(calls) == 1 else layout
+
+    monkeypatch.setattr(generator, 'place_footprints', footprints)
+    builder = generator.GeometryBatch() if batch else None
+    buildings = generator.create_scene(10.0, 6.0, num=6, batch=builder)
+    assert len(buildings) == 6
+    assert [obj.hide_render for obj, _, _ in buildings] == [False] * 2 + [True] * 4
+
+    generator.update_scene(buildings, 10.0, 6.0)
+    # same number asked for, so the same building size
+    assert calls[1] == calls[0]
+    assert not any(obj.hide_render for obj, _, _ in buildings)
@@ -0,0 +1,121 @@
+import os
+import threading
+import time
+import numpy as np
+import pytest
+from camera_rig import extrinsics
+from haze_dataset import HazeDataset, Prefetcher, shard_samples
+from haze_synthesis import mist_to_distance
+from image_writer import srgb_to_linear
+from shard_writer import ShardWriter, pack_round
+
+'''
+Samples and batches of HazeDataset over tiny synthetic rounds, and the
+same views read back from tar shards
+'''
+
+CAMERAS = ('Camera', 'Camera.001', 'Camera.002')
+MIST = (0.0, 40.0)
+
+
+@pytest.fixture
+def root(tmp_path, round_writer):
+    '''
+    Two rounds of three 32 x 24 views; returns the root and what the
+    views hold, by (round, camera)
+    '''
+    root = str(tmp_path / 'haze')
+    views = {}
+    for round in range(2):
+        written = round_writer(os.path.join(root, str(round)), size=(32, 24), cameras=CAMERAS, mist=MIST,
+                               seed=round)
+        R, t = extrinsics(written['matrix_world'])
+        for k, name in enumerate(CAMERAS):
+            mist = srgb_to_linear(written['mist_values'][name] / 255.0)
+            views[(str(round), name)] = {'image': written['images'][name] / 255.0,
+                                         'depth': mist_to_distance(mist, *MIST),
+                                         'density': written['density'], 'K': written['K'],
+                                         'R': R[k], 't': t[k]}
+    return root, views
+
+
+def check_view(sample, view):
+    for key in ('image', 'depth', 'density', 'K', 'R', 't'):
+        assert np.allclose(sample[key], view[key], atol=1e-5), key
+
+
+def test_samples_hold_every_view_once(root):
+    root, views = root
+    dataset = HazeDataset(root)
+    assert len(dataset) == 6
+    assert dataset.shapes() == ((24, 32, 3), (24, 32), (2, 3, 4))
+    seen = []
+    for sample in dataset.samples(threads=3, prefetch=2):
+        seen.append((sample['round'], sample['camera']))
+        assert sample['image'].dtype == sample['depth'].dtype == np.float32
+        check_view(sample, views[seen[-1]])
+    assert sorted(seen) == sorted(views)
+
+
+def test_batches_cover_every_view_once(root):
+    root, views = root
+    dataset = HazeDataset(root)
+    batches = []
+    for batch in dataset.batches(4, shuffle=True, seed=1, threads=2, prefetch=1):
+        assert batch['image'].shape[1:] == (24, 32, 3)
+        assert batch['depth'].shape[1:] == (24, 32)
+        assert batch['density'].shape[1:] == (2, 3, 4)
+        assert batch['K'].shape[1:] == (3, 3) and batch['t'].shape[1:] == (3,)
+        for row, k in enumerate(batch['index']):
+            sample = dataset.views[k]
+            check_view(dict((key, array[row]) for key, array in batch.items()),
+                       views[(sample['round'], sample['camera'])])
+        # a batch is only valid until the next one is asked for
+        batches.append(batch['index'].copy())
+    assert [len(indices) for indices in batches] == [4, 2]
+    assert sorted(np.concatenate(batches).tolist()) == list(range(6))
+    assert len(list(dataset.batches(4, drop_last=True))) == 1
+
+
+def test_index_is_reused(root, tmp_path):
+    root, views = root
+    index = str(tmp_path / 'index.json')
+    first = HazeDataset(root, index)
+    assert os.path.exists(index)
+    second = HazeDataset(root, index)
+    assert second.views == first.views
+    check_view(second.load(3), views[(first.views[3]['round'], first.views[3]['camera'])])
+
+
+def test_prefetcher_yields_each_item_once_in_order():
+    lock = threading.Lock()
+    running = [0, 0]
+
+    def work(item):
+        with lock:
+            running[0] += 1
+            running[1] = max(running)
+        # later items finish first
+        time.sleep(0.001 * (item % 5))
+        with lock:
+            running[0] -= 1
+        return item * item
+
+    assert list(Prefetcher(threads=4, depth=3).map(work, range(40))) == [k * k for k in range(40)]
+    # never more than depth items at once
+    assert running[1] <= 3
+
+
+def test_shard_samples_match_the_directory(root, tmp_path):
+    root, views = root
+    writer = ShardWriter(str(tmp_path / 'shards'), str(tmp_path / 'staging'))
+    for round in range(2):
+        pack_round(writer, round, os.path.join(root, str(round)))
+    writer.close()
+    shards = sorted(os.path.join(str(tmp_path / 'shards'), name) for name in os.listdir(str(tmp_path / 'shards'))
+                    if name.endswith('.tar'))
+    seen = []
+    for sample in shard_samples(shards, threads=2, prefetch=2):
+        seen.append((sample['round'], sample['camera']))
+        check_view(sample, views[seen[-1]])
+    assert sorted(seen) == sorted(views)
@@ -0,0 +1,21 @@
+import pytest
+from haze_fields import FieldGenerator, check_covariance
+
+'''
+Covariance of the fields drawn by FieldGenerator against their kernel
+'''
+
+
+@pytest.mark.parametrize('kernel, nu', [('exponential', 1.5), ('gaussian', 1.5),
+                                        ('matern', 1.5), ('matern', 2.5)])
+def test_fields_have_the_kernel_covariance(kernel, nu):
+    generator = FieldGenerator((8, 8, 8), kernel, length=2.0, nu=nu, seed=0)
+    score, passed = check_covariance(generator)
+    assert passed, "%s kernel is %.1f standard errors off" % (kernel, score)
+
+def test_check_covariance_catches_the_wrong_length():
+    generator = FieldGenerator((8, 8, 8), 'exponential', length=2.0, seed=0)
+    # fields of length 2 compared with a kernel of length 4
+    generator.length = 4.0
+    score, passed = check_covariance(generator)
+    assert not passed
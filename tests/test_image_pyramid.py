@@ -0,0 +1,88 @@
+import os
+import numpy as np
+import pytest
+from image_pyramid import (check_sizes, downsample_color, downsample_depth, level_crop, level_intrinsics,
+                           level_path, write_round_levels)
+from image_reader import load_png
+
+'''
+Pyramid levels of image_pyramid.py: their sizes, the area average of
+the hazy image and the depth reductions, on arrays small enough to
+work out by hand
+'''
+
+
+def test_levels_are_centred_squares():
+    assert level_crop(960, 540) == (210, 0, 540)
+    assert level_crop(24, 32) == (0, 4, 24)
+    check_sizes(960, 540, [128, 256, 512])
+    with pytest.raises(ValueError):
+        check_sizes(960, 540, [1024])
+
+
+def test_level_intrinsics_follow_the_crop():
+    K = np.array([[800.0, 0.0, 480.0], [0.0, 800.0, 270.0], [0.0, 0.0, 1.0]])
+    level = level_intrinsics(K, 960, 540, 135)
+    # a point seen at render pixel (u, v) is at ((u - 210) / 4, v / 4)
+    point = np.array([0.3, -0.2, 1.0])
+    u, v, w = K @ point
+    x, y, z = level @ point
+    assert np.allclose([x / z, y / z], [(u / w - 210) / 4.0, v / w / 4.0])
+
+
+def test_color_is_averaged_in_linear_light():
+    image = np.zeros((4, 6, 3), dtype=np.uint8)
+    # the centred 4 x 4: black and white columns, grey on the right
+    image[:, 1::2] = 255
+    image[:, 3:5] = 128
+    level = downsample_color(image, 2)
+    assert level.shape == (2, 2, 3) and level.dtype == np.uint8
+    # half black, half white is 0.5 in linear light, sRGB 188
+    assert (level[:, 0] == 188).all()
+    assert (level[:, 1] == 128).all()
+    assert (downsample_color(image[:, 1:5], 4) == image[:, 1:5]).all()
+
+
+def depth_map(rows):
+    return np.array(rows, dtype=np.uint8)[:, :, np.newaxis].repeat(3, axis=2)
+
+
+def test_depth_min_keeps_the_nearest_surface():
+    depth = depth_map([[9, 10, 20, 30, 40, 9],
+                       [9, 50, 60, 70, 5, 9],
+                       [9, 255, 255, 90, 80, 9],
+                       [9, 255, 255, 255, 100, 9]])
+    assert downsample_depth(depth, 2, 'min')[:, :, 0].tolist() == [[10, 5], [255, 80]]
+    assert downsample_depth(depth, 1, 'min')[:, :, 0].tolist() == [[5]]
+    # level pixels of 4/3 render pixels take the minimum of every pixel they touch
+    square = depth[:, 1:5, 0].astype(int)
+    level = downsample_depth(depth, 3, 'min')[:, :, 0]
+    for i, rows in enumerate([(0, 1), (1, 2), (2, 3)]):
+        for j, columns in enumerate([(0, 1), (1, 2), (2, 3)]):
+            assert level[i, j] == square[rows[0]:rows[1] + 1, columns[0]:columns[1] + 1].min()
+
+
+def test_depth_nearest_skips_misses():
+    depth = depth_map([[255, 10, 11, 12],
+                       [30, 40, 13, 14],
+                       [255, 255, 21, 22],
+                       [255, 255, 23, 24]])
+    level = downsample_depth(depth, 2, 'nearest')[:, :, 0]
+    # the four pixels of a level pixel are equally near its centre:
+    # the first that hit something, in row order, else a miss
+    assert level.tolist() == [[10, 11], [255, 21]]
+    with pytest.raises(ValueError):
+        downsample_depth(depth, 2, 'mean')
+
+
+def test_round_levels_are_written_next_to_the_round(tmp_path, round_writer):
+    round_directory = str(tmp_path / '0')
+    round_writer(round_directory, size=(32, 24))
+    assert write_round_levels(round_directory, [8, 24]) == 2
+    for size in (8, 24):
+        for name in ('image_set_moderate0', 'depth_set_moderate0'):
+            path = os.path.join(round_directory, name, 'Camera.png')
+            level = load_png(level_path(path, size))
+            assert level.shape == (size, size, 3)
+    # the full resolution views are left as they were
+    assert load_png(os.path.join(round_directory, 'image_set_moderate0', 'Camera.png')).shape == (24, 32, 3)
@@ -0,0 +1,36 @@
+import numpy as np
+import blender_standin
+blender_standin.install()
+import bpy
+import haze_generator_new as generator
+from haze_io import write_bundle
+from image_writer import ImageWriter
+from scene_cleanup import OrphanCollector
+
+'''
+OrphanCollector between rounds, run with the Blender stand-in of
+benchmarks/blender_standin.py
+'''
+
+
+def test_collect_keeps_the_viewer_image(tmp_path, monkeypatch):
+    bundle = str(tmp_path / 'fields.npy')
+    write_bundle(bundle, np.random.RandomState(0).uniform(0.1, 0.3, (2, 4, 4, 4)))
+    monkeypatch.setattr(generator, 'INPUT_FILE_MODE', True)
+    monkeypatch.setattr(generator, 'SAVE_DIRECTORY', str(tmp_path / 'output'))
+    monkeypatch.setattr(generator, 'NUM_CAMERAS', 2)
+    blender_standin.reset()
+    collector = OrphanCollector()
+    writer = ImageWriter(2, 1)
+
+    rig = generator.run(bundle, 0, rig=None, writer=writer)
+    viewer = bpy.data.images['Viewer Node']
+    density = bpy.data.images.new('HazeDensity', width=4, height=4)
+    collector.collect()
+    # the render writes into the viewer image, an unused image of the job goes
+    assert not viewer.removed
+    assert density.removed
+
+    generator.run(bundle, 1, rig=rig, writer=writer)
+    writer.wait()
+    assert bpy.data.images['Viewer Node'] is viewer
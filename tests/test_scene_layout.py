@@ -0,0 +1,52 @@
+import pytest
+from scene_layout import overlapping_pairs, place_footprints
+
+'''
+Footprints of scene_layout.place_footprints(), sparse (dart throwing)
+and dense (Poisson-disk) layouts
+'''
+
+# (count, attempts, gap) in a disk of radius 10. The dense ones are
+# more footprints than dart_throw() places with 3 attempts each, so
+# poisson_disk() fills the disk and count of them are picked
+LAYOUTS = pytest.mark.parametrize('count, attempts, gap', [(20, 30, 0.0), (20, 30, 0.1), (200, 3, 0.0),
+                                                           (170, 3, 0.1)],
+                                  ids=['sparse', 'sparse-gap', 'dense', 'dense-gap'])
+
+
+@LAYOUTS
+def test_footprints_do_not_overlap(count, attempts, gap):
+    layout = place_footprints(10.0, count, 0.3, 0.5, attempts, gap, seed=1)
+    assert layout.complete
+    assert len(layout.footprints) == count
+    assert overlapping_pairs(layout.footprints, gap) == 0
+
+
+@LAYOUTS
+def test_footprints_lie_inside_the_region(count, attempts, gap):
+    layout = place_footprints(10.0, count, 0.3, 0.5, attempts, gap, seed=6)
+    assert len(layout.footprints) == count
+    for x, y, radius in layout.footprints:
+        assert 0.3 <= radius <= 0.5
+        assert (x ** 2 + y ** 2) ** 0.5 + radius <= 10.0 + 1e-9
+
+
+def test_overfull_region_returns_what_fits():
+    layout = place_footprints(3.0, 1000, 0.4, 0.5, seed=3)
+    assert not layout.complete
+    # no more footprints than cover the disk by area
+    assert 0 < len(layout.footprints) <= (3.0 / 0.4) ** 2
+    assert overlapping_pairs(layout.footprints) == 0
+
+
+def test_region_smaller_than_a_footprint():
+    assert place_footprints(0.4, 5, 0.3, 0.5, seed=4) == ([], False)
+    assert place_footprints(0.4, 0, 0.3, 0.5, seed=4) == ([], True)
+
+
+@LAYOUTS
+def test_same_seed_gives_the_same_layout(count, attempts, gap):
+    first = place_footprints(10.0, count, 0.3, 0.5, attempts, gap, seed=5)
+    second = place_footprints(10.0, count, 0.3, 0.5, attempts, gap, seed=5)
+    assert first == second
+    assert place_footprints(10.0, count, 0.3, 0.5, attempts, gap, seed=6) != first
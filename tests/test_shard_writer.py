@@ -0,0 +1,117 @@
+import os
+import tarfile
+import numpy as np
+from camera_rig import extrinsics
+from shard_writer import ShardReader, ShardWriter, index_path, pack_round, read_file, read_index, recover
+
+'''
+Tar shards and their .idx index written by shard_writer.py, read back
+through the index and with tarfile
+'''
+
+# around the 512 byte tar blocks, and a key long enough for a PAX header
+SIZES = [0, 1, 511, 512, 513, 3000]
+LONG_KEY = '000001_moderate0_' + 'Camera' * 20
+
+
+def samples(count):
+    rng = np.random.RandomState(0)
+    for k in range(count):
+        key = LONG_KEY if k == 1 else '%06d_moderate0_Camera-%03d' % (k, k)
+        yield key, dict(('%d.bin' % size, rng.bytes(size)) for size in SIZES)
+
+
+def shards(directory):
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.tar'))
+
+
+def test_index_offsets_point_at_the_data(tmp_path):
+    destination = str(tmp_path / 'out')
+    writer = ShardWriter(destination, str(tmp_path / 'staging'), max_bytes=12000)
+    written = dict(samples(5))
+    for key, files in written.items():
+        writer.write(key, files)
+    writer.close()
+    paths = shards(destination)
+    # the size limit starts new shards
+    assert len(paths) > 1 and writer.shards == len(paths)
+    assert not os.listdir(str(tmp_path / 'staging'))
+    read = {}
+    for path in paths:
+        reader = ShardReader(path)
+        tar = tarfile.open(path)
+        members = dict((member.name, member) for member in tar.getmembers())
+        for key in reader.keys():
+            read[key] = reader.sample(key)
+            for ext, (offset, size) in reader.samples[key].items():
+                member = members['%s.%s' % (key, ext)]
+                assert (member.offset_data, member.size) == (offset, size)
+                assert tar.extractfile(member).read() == read[key][ext]
+        tar.close()
+    assert read == written
+
+
+def test_read_a_header(tmp_path):
+    destination = str(tmp_path / 'out')
+    writer = ShardWriter(destination, str(tmp_path / 'staging'))
+    key, files = next(samples(1))
+    writer.write(key, files)
+    writer.close()
+    reader = ShardReader(shards(destination)[0])
+    assert reader.read(key, '3000.bin', 24) == files['3000.bin'][:24]
+    assert reader.read(key, '1.bin', 24) == files['1.bin']
+
+
+def test_recover_keeps_complete_samples(tmp_path):
+    staging = str(tmp_path / 'staging')
+    destination = str(tmp_path / 'out')
+    writer = ShardWriter(destination, staging)
+    written = list(samples(3))
+    for key, files in written[:2]:
+        writer.write(key, files)
+    # killed while writing the third sample: part of its data, part
+    # of its index line and no end of archive marker
+    writer.file.write(b'\1' * 700)
+    writer.file.flush()
+    writer.index.write('{"key": "%s", "files": {"0.bin"' % written[2][0])
+    writer.index.flush()
+    path = writer.path
+
+    assert recover(staging, destination) == 1
+    assert not os.path.exists(path) and not os.path.exists(index_path(path))
+    shard = os.path.join(destination, os.path.basename(path))
+    assert list(read_index(shard)) == [key for key, _ in written[:2]]
+    tar = tarfile.open(shard)
+    names = tar.getnames()
+    tar.close()
+    assert names == ['%s.%s' % (key, ext) for key, files in written[:2] for ext in files]
+    reader = ShardReader(shard)
+    assert dict((key, reader.sample(key)) for key in reader.keys()) == dict(written[:2])
+
+
+def test_pack_round_keeps_the_camera(tmp_path, round_writer):
+    round_directory = str(tmp_path / '7')
+    expected = round_writer(round_directory, size=(32, 24), mist=(2.0, 30.0))
+    image = read_file(os.path.join(round_directory, 'image_set_moderate0', 'Camera.001.png'))
+    writer = ShardWriter(str(tmp_path / 'out'), str(tmp_path / 'staging'))
+    # two images and two depth maps
+    assert pack_round(writer, 7, round_directory) == 4
+    writer.close()
+    assert not os.path.exists(round_directory)
+
+    reader = ShardReader(shards(str(tmp_path / 'out'))[0])
+    key = '000007_moderate0_Camera-001'
+    # in the order of the file names
+    assert reader.keys() == [key, '000007_moderate0_Camera']
+    assert sorted(reader.samples[key]) == ['camera.json', 'depth.png', 'label.npy', 'png']
+    assert reader.read(key, 'png') == image
+    camera = reader.camera(key)
+    assert (camera['round'], camera['image_set'], camera['camera']) == (7, 'moderate0', 'Camera.001')
+    rig = reader.rig(key)
+    R, t = extrinsics(expected['matrix_world'])
+    assert np.allclose(rig['K'], expected['K'])
+    assert np.allclose(rig['R'], R[1]) and np.allclose(rig['t'], t[1])
+    assert np.allclose(rig['matrix_world'], expected['matrix_world'][1])
+    assert rig['image_size'].tolist() == [32, 24]
+    assert rig['mist'].tolist() == [2.0, 30.0]
+    assert np.allclose(reader.label(key)['density'], expected['density'])
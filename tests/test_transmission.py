@@ -0,0 +1,121 @@
+import numpy as np
+import pytest
+from haze_synthesis import VoxelGrid, camera_rays, march
+from transmission import camera_transmission, optical_depth, traverse
+
+'''
+The exact voxel walk of transmission.py against a dense ray march
+(haze_synthesis.march with a step far below the voxel size) on a
+small random grid
+'''
+
+# march step in voxels; the march is off by at most about a step
+# times the density at every voxel boundary a ray crosses
+STEP = 1e-3
+
+
+def dense_depth(grid, density, origin, directions, far):
+    origin = np.asarray(origin, dtype=float)
+    far = np.broadcast_to(far, (len(directions),))
+    tau = []
+    for k, direction in enumerate(directions):
+        start = origin if origin.ndim == 1 else origin[k]
+        # rays missing the grid sample no finite points
+        with np.errstate(invalid='ignore'):
+            index, lengths = march(grid, start, direction[np.newaxis], far[k:k + 1], STEP * grid.spacing)
+        tau.append(np.dot(density.ravel()[index[0]], lengths[0]))
+    return np.array(tau)
+
+
+@pytest.fixture
+def grid():
+    # not at the origin and not of unit voxels, so that neither is assumed
+    return VoxelGrid((4, 5, 6), (-1.3, 0.7, 0.2), 0.5)
+
+
+@pytest.fixture
+def density():
+    return np.random.RandomState(0).uniform(0.0, 2.0, (4, 5, 6))
+
+
+def unit(vectors):
+    vectors = np.asarray(vectors, dtype=float)
+    return vectors / np.linalg.norm(vectors, axis=-1, keepdims=True)
+
+
+def test_rays_from_outside_match_a_dense_march(grid, density):
+    rng = np.random.RandomState(1)
+    lo, hi = grid.bounds()
+    origin = np.array([-4.0, -3.0, 5.0])
+    # aimed at random points of the grid, and a few away from it
+    targets = lo + rng.uniform(0.0, 1.0, (40, 3)) * (hi - lo)
+    directions = unit(np.concatenate([targets - origin, [[-1.0, 0.0, 0.0], [0.0, -1.0, -1.0]]]))
+    far = np.full(len(directions), np.inf)
+    tau = optical_depth(grid, density[np.newaxis], origin, directions, far)[0]
+    expected = dense_depth(grid, density, origin, directions, far)
+    assert np.allclose(tau, expected, atol=0.02)
+    assert tau[-2:].tolist() == [0.0, 0.0]
+
+
+def test_rays_from_inside_stop_at_far(grid, density):
+    rng = np.random.RandomState(2)
+    lo, hi = grid.bounds()
+    origins = lo + rng.uniform(0.1, 0.9, (40, 3)) * (hi - lo)
+    directions = unit(rng.normal(size=(40, 3)))
+    far = rng.uniform(0.0, 3.0, 40)
+    tau = optical_depth(grid, density[np.newaxis], origins, directions, far)[0]
+    assert np.allclose(tau, dense_depth(grid, density, origins, directions, far), atol=0.02)
+
+
+def test_axis_parallel_rays(grid, density):
+    lo, hi = grid.bounds()
+    # off the voxel boundaries, where the voxel of a ray is ambiguous
+    inside = lo + np.array([0.3, 0.35, 0.4]) * (hi - lo)
+    directions = np.concatenate([np.eye(3), -np.eye(3)])
+    origins = np.array([inside - 10.0 * d for d in directions])
+    tau = optical_depth(grid, density[np.newaxis], origins, directions, np.inf)[0]
+    assert np.allclose(tau, dense_depth(grid, density, origins, directions, np.inf), atol=0.02)
+    # along x the ray crosses one row of voxels end to end
+    ix, iy, iz = np.floor((inside - lo) / grid.spacing).astype(int)
+    assert np.isclose(tau[0], density[iz, iy, :].sum() * grid.spacing)
+
+
+def test_steps_cover_each_ray_once(grid):
+    rng = np.random.RandomState(3)
+    origin = np.array([4.0, 6.0, -2.0])
+    directions = unit(rng.normal(size=(200, 3)) - origin)
+    lengths = np.zeros(len(directions))
+    visited = [set() for _ in directions]
+    for rays, index, step in traverse(grid, origin, directions, np.inf):
+        np.add.at(lengths, rays, step)
+        for ray, voxel in zip(rays, index):
+            assert voxel not in visited[ray]
+            visited[ray].add(voxel)
+    # with density 1 the dense march measures the length inside the grid
+    expected = dense_depth(grid, np.ones(grid.shape), origin, directions, np.inf)
+    assert np.allclose(lengths, expected, atol=0.01)
+
+
+def test_unknown_depth_stays_unknown(grid, density):
+    # a camera 3 m in front of the grid looking along +y at its centre
+    K = np.array([[4.0, 0.0, 2.0], [0.0, 4.0, 2.0], [0.0, 0.0, 1.0]])
+    R = np.array([[1.0, 0.0, 0.0], [0.0, 0.0, -1.0], [0.0, 1.0, 0.0]])
+    lo, hi = grid.bounds()
+    centre = 0.5 * (lo + hi)
+    position = centre - [0.0, 3.0, 0.0]
+    t = -R @ position
+    distance = np.full((4, 4), 4.0)
+    distance[0, 1] = np.nan
+    distance[2, 3] = np.nan
+    distance[3, 0] = 0.0
+    transmission = camera_transmission(grid, density, K, R, t, distance)
+    assert transmission.shape == (4, 4) and transmission.dtype == np.float32
+    assert np.isnan(transmission).sum() == 2
+    assert np.isnan(transmission[0, 1]) and np.isnan(transmission[2, 3])
+    assert transmission[3, 0] == 1.0
+    origin, directions = camera_rays(K, R, t, 4, 4)
+    known = ~np.isnan(distance.ravel())
+    expected = np.exp(-dense_depth(grid, density, origin, directions[known], distance.ravel()[known]))
+    assert np.allclose(transmission.ravel()[known], expected, atol=0.01)
+    # the rays reach into the grid, so the check is not trivial
+    assert (transmission < 0.9).sum() > 8
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+import blender_standin
+blender_standin.install()
+import haze_generator_new as generator
+from haze_io import write_bundle
+
+'''
+Voxel materials under a small MaterialCache, run with the Blender
+stand-in of benchmarks/blender_standin.py
+'''
+
+
+def dead_materials(voxels):
+    '''
+    Number of voxels whose material is missing or removed from bpy.data
+    '''
+    dead = 0
+    for voxel in voxels:
+        material = voxel.material_slots[0].material
+        if material is None or material.removed:
+            dead += 1
+    return dead
+
+@pytest.mark.parametrize('batch', [True, False])
+def test_evicted_materials_stay_on_their_voxels(tmp_path, monkeypatch, batch):
+    # 8^3 distinct densities through a cache of 16 materials
+    bundle = str(tmp_path / 'fields.npy')
+    write_bundle(bundle, np.random.RandomState(0).uniform(0.1, 0.3, (2, 8, 8, 8)))
+    monkeypatch.setattr(generator, 'INPUT_FILE_MODE', True)
+    monkeypatch.setattr(generator, 'SAVE_DIRECTORY', str(tmp_path / 'output'))
+    monkeypatch.setattr(generator, 'NUM_CAMERAS', 2)
+    monkeypatch.setattr(generator, 'BATCH_GEOMETRY', batch)
+    blender_standin.reset()
+    cache = generator.MaterialCache(1e-6, 16)
+
+    rig = generator.run(bundle, 0, cache)
+    assert len(rig['voxels']) == 512
+    assert dead_materials(rig['voxels']) == 0
+    assert cache.evictions > 0
+
+    # the next round reuses the cubes and replaces their materials
+    rig = generator.run(bundle, 1, cache, rig)
+    assert dead_materials(rig['voxels']) == 0
@@ -0,0 +1,262 @@
+import argparse
+import os
+import sys
+import time
+import numpy as np
+from camera_rig import load_rig
+from haze_io import read_label
+from haze_synthesis import (MIST_DEPTH, MIST_START, VoxelGrid, camera_rays, load_distance, mist_range,
+                            ray_box, unknown_pixels)
+from shard_writer import ShardReader
+
+'''
+Ground truth transmission maps of rendered rounds
+
+For every pixel of every camera the optical depth tau, the integral of
+the haze density along the pixel ray up to the surface it hits, is
+computed exactly: the ray is walked from voxel to voxel (Amanatides and
+Woo, "A Fast Voxel Traversal Algorithm for Ray Tracing") and each
+voxel adds its density times the length of the ray inside it. All rays
+of an image take their steps together as numpy arrays, so an image
+needs at most nx + ny + nz passes over its rays, and the walk stops at
+the distance of the mist depth map. That distance is only known where
+the mist pass was not clamped, i.e. everywhere for rounds rendered from
+mist start 0 (haze_generator_new.py --transmission does so); the maps
+hold NaN at pixels closer than a larger start.
+
+The grid has the geometry of the cubes built by run() in
+haze_generator_new.py (see VoxelGrid.from_layout in haze_synthesis.py),
+the density is the one stored in label<i>.npy and the poses come from
+camera.npz. The maps t = exp(-tau) are written as float32 arrays
+
+    <round>/transmission_set_<scene mode><i>/<camera>.npy
+
+next to depth_set_<scene mode><i>, one (height, width) array per
+camera, top row first. haze_generator_new.py writes them after every
+round with --transmission.
+
+Rounds already packed into tar shards by shard_writer.py are read
+from the shard instead: the pose, K and mist range from the
+camera.json of each sample, the density from its label.npy. Their
+maps are written as <output>/<sample key>.npy.
+
+Usage:
+    python transmission.py /data/haze/0 /data/haze/1
+    python transmission.py /data/shards/*.tar --output /data/transmission
+'''
+
+DEPTH_EXTENSIONS = ('.png', '.npy')
+
+
+def traverse(grid, origin, directions, far):
+    '''
+    Walk every ray through the voxels of grid from where it enters the
+    grid to where it leaves it or reaches far. Yields, for each step
+    taken by the rays still inside, the indices of those rays, the flat
+    [z, y, x] index of the voxel each of them crosses and the length of
+    the crossing. origin is (3,) or one point per ray
+    '''
+    directions = np.asarray(directions, dtype=float).reshape(-1, 3)
+    count = len(directions)
+    origin = np.broadcast_to(np.asarray(origin, dtype=float), (count, 3))
+    far = np.broadcast_to(far, (count,))
+    lo, hi = grid.bounds()
+    t_in, t_out = ray_box(origin, directions, lo, hi)
+    t_end = np.minimum(t_out, far)
+    rays = np.flatnonzero(t_in < t_end)
+    origin = origin[rays]
+    directions = directions[rays]
+    t = t_in[rays]
+    t_end = t_end[rays]
+
+    nz, ny, nx = grid.shape
+    size = np.array([nx, ny, nz])
+    strides = np.array([1, nx, nx * ny])
+    entry = origin + t[:, None] * directions
+    cell = np.clip(np.floor((entry - lo) / grid.spacing).astype(np.int64), 0, size - 1)
+    step = np.sign(directions).astype(np.int64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # distance to the next voxel boundary along each axis, and
+        # between two boundaries; never for an axis the ray runs along
+        boundary = lo + (cell + (step > 0)) * grid.spacing
+        t_max = np.where(step != 0, (boundary - origin) / directions, np.inf)
+        t_delta = np.where(step != 0, grid.spacing / np.abs(directions), np.inf)
+    index = cell @ strides
+    index_step = step * strides
+
+    while len(rays):
+        axis = np.argmin(t_max, axis=1)
+        k = np.arange(len(rays))
+        leave = np.minimum(t_max[k, axis], t_end)
+        yield rays, index, np.maximum(leave - t, 0.0)
+        t = np.maximum(t, leave)
+        cell[k, axis] += step[k, axis]
+        index = index + index_step[k, axis]
+        t_max[k, axis] += t_delta[k, axis]
+        moved = cell[k, axis]
+        inside = (t < t_end) & (moved >= 0) & (moved < size[axis])
+        if not inside.all():
+            rays, t, t_end, cell, step = rays[inside], t[inside], t_end[inside], cell[inside], step[inside]
+            t_max, t_delta = t_max[inside], t_delta[inside]
+            index, index_step = index[inside], index_step[inside]
+
+def optical_depth(grid, fields, origin, directions, far, chunk=2**18):
+    '''
+    Exact integral of the density along every ray up to far, for each
+    field of fields (count, nz, ny, nx). Returns (count, rays).
+    Rays are walked chunk at a time to bound the memory
+    '''
+    fields = np.asarray(fields, dtype=np.float32).reshape(len(fields), -1)
+    # voxel major, so the densities of all fields at a voxel are adjacent
+    by_voxel = np.ascontiguousarray(fields.T)
+    directions = np.asarray(directions, dtype=float).reshape(-1, 3)
+    origin = np.asarray(origin, dtype=float)
+    far = np.broadcast_to(far, (len(directions),))
+    tau = np.zeros((len(fields), len(directions)))
+    for first in range(0, len(directions), chunk):
+        last = min(first + chunk, len(directions))
+        start = origin[first:last] if origin.ndim == 2 else origin
+        for rays, index, lengths in traverse(grid, start, directions[first:last], far[first:last]):
+            # a ray is in one voxel per step, so rays holds no duplicates
+            tau[:, first + rays] += (by_voxel[index] * lengths[:, None]).T
+    return tau.astype(np.float32)
+
+def scale_intrinsics(K, image_size, shape):
+    '''
+    K of camera.npz for an image of shape (height, width) rendered
+    at another resolution percentage than image_size (width, height)
+    '''
+    if tuple(int(n) for n in image_size) == tuple(shape[::-1]):
+        return K
+    scale = shape[1] / float(image_size[0])
+    return K * np.array([[scale], [scale], [1]])
+
+def camera_transmission(grid, density, K, R, t, distance):
+    '''
+    Transmission exp(-tau) of every pixel of one camera view,
+    float32 of the shape (height, width) of its distance map, NaN
+    where the distance is NaN
+    '''
+    height, width = distance.shape
+    origin, directions = camera_rays(K, R, t, width, height)
+    far = distance.ravel()
+    known = ~np.isnan(far)
+    tau = np.full(far.shape, np.nan, dtype=np.float32)
+    tau[known] = optical_depth(grid, np.asarray(density)[np.newaxis], origin, directions[known],
+                               far[known])[0]
+    return np.exp(-tau).reshape(height, width)
+
+
+def depth_file(directory, name):
+    for ext in DEPTH_EXTENSIONS:
+        path = os.path.join(directory, name + ext)
+        if os.path.exists(path):
+            return path
+    return None
+
+def write_round_maps(round_directory, rad=0.5, mist_start=None, mist_depth=None):
+    '''
+    Write the transmission map of every camera of every image set of
+    a round rendered by haze_generator_new.run(). Cameras without a
+    depth map are skipped. The mist range defaults to the one in
+    camera.npz. Return the number of maps written
+    '''
+    rig = load_rig(os.path.join(round_directory, 'camera.npz'))
+    mist_start, mist_depth = mist_range(rig, mist_start, mist_depth)
+    names = [str(n) for n in rig['names']]
+    written = 0
+    for set_name in sorted(os.listdir(round_directory)):
+        if not set_name.startswith('image_set_'):
+            continue
+        suffix = set_name[len('image_set_'):]
+        set_directory = os.path.join(round_directory, set_name)
+        labels = sorted(name for name in os.listdir(set_directory)
+                        if name.startswith('label') and name.endswith('.npy'))
+        if not labels:
+            continue
+        density = np.array(read_label(os.path.join(set_directory, labels[0]))['density'])
+        grid = VoxelGrid.from_layout(density.shape, rad)
+        depth_directory = os.path.join(round_directory, 'depth_set_' + suffix)
+        output = os.path.join(round_directory, 'transmission_set_' + suffix)
+        for k, name in enumerate(names):
+            path = depth_file(depth_directory, name)
+            if path is None:
+                continue
+            distance = load_distance(path, mist_start, mist_depth)
+            unknown = unknown_pixels(distance)
+            if unknown:
+                print("warning: %s has %d pixels closer than the mist start %g, left NaN"
+                      % (path, unknown, mist_start))
+            K = scale_intrinsics(rig['K'][k], rig['image_size'], distance.shape)
+            transmission = camera_transmission(grid, density, K, rig['R'][k], rig['t'][k], distance)
+            if not os.path.exists(output):
+                os.makedirs(output)
+            np.save(os.path.join(output, name + '.npy'), transmission)
+            written += 1
+    return written
+
+
+def shard_transmission(reader, key, rad=0.5, mist_start=None, mist_depth=None):
+    '''
+    Transmission map of the sample key of a tar shard read by a
+    shard_writer.ShardReader, or None without a depth map
+    '''
+    depth = [name for name in reader.samples[key] if name.startswith('depth.')]
+    if not depth:
+        return None
+    rig = reader.rig(key)
+    mist_start, mist_depth = mist_range(rig, mist_start, mist_depth)
+    distance = load_distance(reader.read(key, depth[0]), mist_start, mist_depth)
+    unknown = unknown_pixels(distance)
+    if unknown:
+        print("warning: %s of %s has %d pixels closer than the mist start %g, left NaN"
+              % (key, reader.shard, unknown, mist_start))
+    density = np.array(reader.label(key)['density'])
+    grid = VoxelGrid.from_layout(density.shape, rad)
+    K = scale_intrinsics(rig['K'], rig['image_size'], distance.shape)
+    return camera_transmission(grid, density, K, rig['R'], rig['t'], distance)
+
+def write_shard_maps(shard, output, rad=0.5, mist_start=None, mist_depth=None):
+    '''
+    Write the transmission map of every sample of a tar shard to
+    output. Return the number of maps written
+    '''
+    reader = ShardReader(shard)
+    written = 0
+    for key in reader.keys():
+        transmission = shard_transmission(reader, key, rad, mist_start, mist_depth)
+        if transmission is None:
+            continue
+        if not os.path.exists(output):
+            os.makedirs(output)
+        np.save(os.path.join(output, key + '.npy'), transmission)
+        written += 1
+    return written
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write ground truth transmission maps of rendered rounds")
+    parser.add_argument('rounds', nargs='+', help="round directories holding camera.npz, or tar shards")
+    parser.add_argument('--output', help="directory the maps of tar shards are written to")
+    parser.add_argument('--rad', type=float, default=0.5, help="half size of a voxel cube")
+    parser.add_argument('--mist-start', type=float, default=None,
+                        help="default: the range in camera.npz, else %g" % MIST_START)
+    parser.add_argument('--mist-depth', type=float, default=None,
+                        help="default: the range in camera.npz, else %g" % MIST_DEPTH)
+    args = parser.parse_args(argv)
+    if args.output is None and any(path.endswith('.tar') for path in args.rounds):
+        parser.error("--output is needed for tar shards")
+
+    for round_directory in args.rounds:
+        start = time.time()
+        if round_directory.endswith('.tar'):
+            written = write_shard_maps(round_directory, args.output, args.rad, args.mist_start, args.mist_depth)
+        else:
+            written = write_round_maps(round_directory, args.rad, args.mist_start, args.mist_depth)
+        print("wrote %d transmission maps for %s in %.1f s"
+              % (written, round_directory, time.time() - start))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())